@@ -0,0 +1,161 @@
+"""
+Resumable batch evaluation
+Runs evaluate.py on every 'predicted target' pair listed in a batch file and
+records each job in a SQLite ledger, keyed by the content hashes of both
+structures and of the evaluation options. Rerunning the same command skips
+the finished jobs and retries the failed or interrupted ones.
+Any option not listed here is passed on to evaluate.py, e.g.
+    python batchEvaluate.py -b pairs.txt -d results/ --modelangelo True --output-jsonl results/all.jsonl
+--output-structure and --trace-timeline name one file per job, prefixed with
+the prediction name and job key.
+"""
+import argparse
+import os
+import traceback
+
+from evaluate import add_args as evaluate_add_args
+from evaluate import main as evaluate_main
+from phenixCC import read_batch_file
+from utils.ledger_utils import JobLedger, get_job_key, hash_file, hash_options
+from utils.result_utils import RecordingSink, ResultSink
+
+# Options that don't change the metrics of a job
+UNHASHED_OPTIONS = [
+    "predicted_structure", "target_structure", "output_file", "verbose",
+    "output_jsonl", "output_parquet", "parallel", "trace_timeline",
+    "log_compression", "log_verbosity",
+]
+# Per-pair output files, written as <prediction>_<job key>_<file name> for every job
+PER_JOB_OPTIONS = ["output_structure", "trace_timeline"]
+
+
+def add_args(parser):
+    parser.add_argument(
+        "--batch-file",
+        "-b",
+        required=True,
+        help="File with one 'predicted target' pair of paths per line",
+    )
+    parser.add_argument(
+        "--output-dir",
+        "-d",
+        required=True,
+        help="Directory for the per-job output files and, by default, the ledger",
+    )
+    parser.add_argument(
+        "--ledger",
+        help="Path to the job ledger, defaults to <output-dir>/ledger.sqlite",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=3,
+        help="Jobs that failed this many times are not retried",
+    )
+
+    return parser
+
+
+def get_job_path(path, job_name, output_dir):
+    """
+    Per-job version of an output path given for the whole batch, e.g.
+    structures/recall.cif.gz becomes structures/<job_name>_recall.cif.gz,
+    in the output directory if the path has no directory
+    """
+    directory = os.path.dirname(path) or output_dir
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{job_name}_{os.path.basename(path)}")
+
+
+def get_failed_stages(stage_outputs):
+    # Stages report timeouts as <stage>_status and errors as no output at all
+    failed = []
+    for name, output in stage_outputs.items():
+        if output is None:
+            failed.append(f"{name}: error")
+        else:
+            failed.extend(f"{key}: {value}" for key, value in output.items() if key.endswith("_status"))
+    return failed
+
+
+def main(parsed_args, evaluate_argv):
+    os.makedirs(parsed_args.output_dir, exist_ok=True)
+    ledger_path = parsed_args.ledger or os.path.join(parsed_args.output_dir, "ledger.sqlite")
+
+    evaluate_parser = evaluate_add_args(argparse.ArgumentParser(prog="evaluate.py"))
+    # Placeholders, only to get the evaluation options
+    options = vars(evaluate_parser.parse_args(["-p", "", "-t", "", "-o", ""] + evaluate_argv))
+    options_hash = hash_options({key: value for key, value in options.items() if key not in UNHASHED_OPTIONS})
+
+    pairs = read_batch_file(parsed_args.batch_file)
+    skipped = 0
+    with JobLedger(ledger_path) as ledger, ResultSink(
+        options["output_jsonl"], options["output_parquet"]
+    ) as sink:
+        for n, (predicted_structure, target_structure) in enumerate(pairs):
+            try:
+                predicted_hash = hash_file(predicted_structure)
+                target_hash = hash_file(target_structure)
+            except OSError as e:
+                print(f"[{n + 1}/{len(pairs)}] Skipping, cannot read input: {e}")
+                continue
+            job_key = get_job_key(predicted_hash, target_hash, options_hash)
+            if not ledger.should_run(job_key, parsed_args.max_attempts):
+                skipped += 1
+                continue
+
+            pred_name = os.path.splitext(os.path.basename(predicted_structure))[0]
+            job_name = f"{pred_name}_{job_key[:8]}"
+            output_file = os.path.join(parsed_args.output_dir, f"{job_name}.log")
+            print(f"[{n + 1}/{len(pairs)}] {predicted_structure} vs {target_structure}")
+            ledger.start(
+                job_key, predicted_structure, target_structure,
+                predicted_hash, target_hash, options_hash, output_file,
+            )
+
+            # Held back until the job finishes, so a retried job is recorded once
+            recording_sink = RecordingSink()
+            try:
+                job_args = evaluate_parser.parse_args(
+                    ["-p", predicted_structure, "-t", target_structure, "-o", output_file] + evaluate_argv
+                )
+                # Every job writes its own files instead of overwriting one another's
+                for key in PER_JOB_OPTIONS:
+                    if options[key] is not None:
+                        setattr(job_args, key, get_job_path(options[key], job_name, parsed_args.output_dir))
+                cryoEVAL_output, modelangelo_output, phenix_output = evaluate_main(job_args, sink=recording_sink)
+            except Exception:
+                print(traceback.format_exc())
+                ledger.fail(job_key, traceback.format_exc())
+                continue
+
+            durations = {
+                key: value for key, value in recording_sink.record.items() if key.endswith("_seconds")
+            }
+            stage_outputs = {}
+            if job_args.cryoEVAL:
+                stage_outputs["cryoEVAL"] = cryoEVAL_output
+            if job_args.modelangelo:
+                stage_outputs["modelangelo"] = modelangelo_output
+            if job_args.phenix:
+                stage_outputs["phenix"] = phenix_output
+            failed = get_failed_stages(stage_outputs)
+            if failed:
+                ledger.fail(job_key, "\n".join(failed), durations)
+            else:
+                if recording_sink.record:
+                    sink.write(recording_sink.record)
+                ledger.finish(job_key, durations)
+
+        summary = ledger.summary()
+
+    print(f"\nSkipped {skipped} finished or given up jobs")
+    for status, count in summary.items():
+        print(f"  - {status}: {count}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser = add_args(parser)
+    parsed_args, evaluate_argv = parser.parse_known_args()
+    main(parsed_args, evaluate_argv)
@@ -0,0 +1,142 @@
+"""
+Native chain comparison against phenix.chain_comparison
+Runs mmtbx.validation.chain_comparison with the given phenix.python (or any
+python with cctbx-base installed) and utils.chain_comparison_utils on the same
+pairs, and reports the largest absolute difference of every summary metric,
+unrounded. Run from src/:
+
+    python -m benchmarks.chain_comparison --phenix-python phenix.python
+    python -m benchmarks.chain_comparison --phenix-python /path/to/cctbx/bin/python \
+        --pairs ../example/3j9s_ref.pdb ../example/3j9s_agl.cif
+
+The native engine compares the whole target, so PHENIX is run with
+test_unique_part_of_target_only=False and unique_part_of_target_only=False.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import warnings
+
+from benchmarks.regression import get_fixtures
+from utils.chain_comparison_utils import chain_comparison
+from utils.protein import get_protein_from_file_path
+
+METRICS = [
+    "rmsd", "close_n", "far_n", "forward", "reverse", "mixed", "found",
+    "ca_score", "seq_match", "seq_score", "mean_length", "fragments", "bad_connections",
+]
+# Same summary values as mmtbx.validation.chain_comparison.write_summary
+PHENIX_CODE = """
+import io, json, sys
+from mmtbx.validation.chain_comparison import run
+target, predicted, chain_type = sys.argv[1:]
+rv = run([target, predicted, "chain_type=" + chain_type,
+          "test_unique_part_of_target_only=False", "unique_part_of_target_only=False"],
+         out=io.StringIO())
+rmsd, close_n = rv.get_values("close")
+target_length = rv.get_target_length("close") or 0
+found = rv.get_close_to_target_percent("close")
+seq_match = rv.get_match_percent("close")
+fragments = rv.get_n_fragments("forward") + rv.get_n_fragments("reverse")
+print(json.dumps({
+    "rmsd": rmsd or 0.0,
+    "close_n": close_n,
+    "far_n": rv.get_values("far_away")[1],
+    "forward": rv.get_values("forward")[1],
+    "reverse": rv.get_values("reverse")[1],
+    "mixed": rv.get_values("unaligned")[1],
+    "found": found,
+    "ca_score": close_n / (max(1, target_length) * max(0.1, rmsd or 0)),
+    "seq_match": seq_match,
+    "seq_score": seq_match * found / 10000,
+    "mean_length": close_n / max(1, fragments),
+    "fragments": rv.input_fragments or 0,
+    "bad_connections": rv.incorrect_connections or 0,
+}))
+"""
+
+
+def add_args(parser):
+    parser.add_argument(
+        "--phenix-python",
+        default="phenix.python",
+        help="Python interpreter that can import mmtbx",
+    )
+    parser.add_argument(
+        "--fixtures",
+        nargs="+",
+        help="Names of the regression fixtures to compare, all by default",
+    )
+    parser.add_argument(
+        "--pairs",
+        nargs="+",
+        default=[],
+        help="Extra 'target predicted' pairs of paths to compare",
+    )
+    parser.add_argument(
+        "--chain-types",
+        nargs="+",
+        default=["PROTEIN", "RNA"],
+        choices=["PROTEIN", "RNA", "DNA"],
+        help="chain_type of the comparisons",
+    )
+    parser.add_argument(
+        "--json",
+        help="If set, path to save the per-pair values and the differences as JSON",
+    )
+
+    return parser
+
+
+def run_phenix(phenix_python, target_path, predicted_path, chain_type):
+    result = subprocess.run(
+        [phenix_python, "-c", PHENIX_CODE, target_path, predicted_path, chain_type],
+        capture_output=True, text=True, check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(parsed_args):
+    pairs = get_fixtures()
+    if parsed_args.fixtures:
+        pairs = {name: pairs[name] for name in parsed_args.fixtures}
+    if len(parsed_args.pairs) % 2:
+        raise ValueError("--pairs takes 'target predicted' pairs of paths")
+    for target_path, predicted_path in zip(parsed_args.pairs[::2], parsed_args.pairs[1::2]):
+        pairs[target_path] = (target_path, predicted_path)
+
+    report = {"pairs": {}, "max_abs_difference": {key: 0.0 for key in METRICS}}
+    for name, (target_path, predicted_path) in pairs.items():
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            target_protein = get_protein_from_file_path(target_path)
+            predicted_protein = get_protein_from_file_path(predicted_path)
+        for chain_type in parsed_args.chain_types:
+            native = chain_comparison(target_protein, predicted_protein, chain_type=chain_type)
+            phenix = run_phenix(parsed_args.phenix_python, target_path, predicted_path, chain_type)
+            differences = {key: abs(float(native[key]) - float(phenix[key])) for key in METRICS}
+            report["pairs"][f"{name} {chain_type}"] = {
+                "native": native, "phenix": phenix, "differences": differences,
+            }
+            for key, difference in differences.items():
+                report["max_abs_difference"][key] = max(report["max_abs_difference"][key], difference)
+            worst = max(differences, key=differences.get)
+            print(f"{name:28s} {chain_type:8s} max difference {differences[worst]:.3g} ({worst})")
+
+    print("\nLargest absolute difference per metric:")
+    for key, difference in report["max_abs_difference"].items():
+        print(f"  {key:16s} {difference:.3g}")
+
+    if parsed_args.json is not None:
+        with open(parsed_args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser = add_args(parser)
+    parsed_args = parser.parse_args()
+    main(parsed_args)
+    sys.exit(0)
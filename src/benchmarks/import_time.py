@@ -0,0 +1,114 @@
+"""
+Import-time benchmark
+Imports each module in a fresh interpreter a number of times and reports the
+median wall-clock time, together with the heaviest imports it pulls in
+according to `python -X importtime`. Run from src/:
+
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --modules utils.residue_constants evaluate --json import_time.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+DEFAULT_MODULES = [
+    "utils.residue_constants",
+    "utils.protein",
+    "utils.save_pdb_utils",
+    "utils.cas_utils",
+    "cryoEVAL",
+    "modelangeloEval",
+    "evaluate",
+]
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def add_args(parser):
+    parser.add_argument(
+        "--modules",
+        nargs="+",
+        default=DEFAULT_MODULES,
+        help="Modules to import, relative to src/",
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=5,
+        help="Number of fresh interpreters per module",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=5,
+        help="Number of heaviest imports listed per module",
+    )
+    parser.add_argument(
+        "--json",
+        help="If set, path to save the results as JSON",
+    )
+
+    return parser
+
+
+def time_import(module: str) -> float:
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - start)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=SRC_DIR, capture_output=True, text=True, check=True,
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def get_heaviest_imports(module: str, top: int):
+    """
+    Cumulative import times in seconds of the top-level packages `module` imports
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=SRC_DIR, capture_output=True, text=True, check=True,
+    )
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        name = name.strip()
+        package = name.split(".")[0]
+        # The outermost entry of a package holds its whole cumulative time
+        packages[package] = max(packages.get(package, 0), int(cumulative) / 1e6)
+    packages.pop(module.split(".")[0], None)
+    return sorted(packages.items(), key=lambda item: -item[1])[:top]
+
+
+def main(parsed_args):
+    results = {}
+    for module in parsed_args.modules:
+        times = [time_import(module) for _ in range(parsed_args.repeats)]
+        results[module] = {
+            "median_seconds": statistics.median(times),
+            "min_seconds": min(times),
+            "heaviest_imports": dict(get_heaviest_imports(module, parsed_args.top)),
+        }
+        heaviest = ", ".join(
+            f"{name} {seconds:.3f}s" for name, seconds in results[module]["heaviest_imports"].items()
+        )
+        print(f"{module:28s} {results[module]['median_seconds']:.3f}s  ({heaviest})")
+
+    if parsed_args.json is not None:
+        with open(parsed_args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser = add_args(parser)
+    parsed_args = parser.parse_args()
+    main(parsed_args)
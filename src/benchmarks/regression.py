@@ -0,0 +1,349 @@
+"""
+Golden regression fixtures
+Pins the outputs of the parser, the correspondence, lDDT and the metric stages
+on a set of small structures, so a faster implementation can be checked to
+give the same numbers. Run from src/:
+
+    python -m benchmarks.regression                # compare with the golden outputs
+    python -m benchmarks.regression --update       # rewrite them, after an intended change
+
+The fixtures in benchmarks/fixtures are <name>_target.{pdb,cif} and
+<name>_pred.cif pairs: three protein chains and a chain with insertion codes
+cut from example/3j9s_ref.pdb, a DNA duplex with an RNA strand and a
+protein-DNA complex built from the rigid group literature positions, and the
+predictions are noisy copies of the targets missing a few residues, with a
+few residues changed to glycine.
+
+The cached residue constant tables are checked to equal the tables built from
+the definitions. The parsed Protein arrays, the lDDT of a fixed correspondence and the native
+chain comparison are deterministic and compared within tolerances.
+kdtree_correspondence shuffles the targets, so the correspondence and the
+metrics depending on it are run several times and their distributions are
+compared instead: how often each target is matched to each prediction residue,
+and the mean of every metric within a few standard errors.
+"""
+import argparse
+import glob
+import json
+import math
+import os
+import random
+import sys
+import warnings
+
+import numpy as np
+
+from modelangeloEval import add_args as modelangelo_add_args
+from modelangeloEval import main as modelangelo_main
+from utils.cas_utils import get_correspondence, get_lddt
+from utils.chain_comparison_utils import chain_comparison
+from utils.protein import get_protein_from_file_path
+from utils.residue_constants import (
+    atom_order,
+    make_constant_tables,
+    read_constant_tables,
+    write_constant_tables,
+)
+from utils.tm_utils import tm_align
+from utils.trace_utils import TraceLog
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURE_DIR = os.path.join(SRC_DIR, "benchmarks", "fixtures")
+GOLDEN_DIR = os.path.join(FIXTURE_DIR, "golden")
+
+# (atol, rtol) of the parsed arrays, the positions are read from files with
+# three decimals and the frames/torsions are derived from them in float32
+ARRAY_TOLERANCES = {
+    "atom_positions": (1e-4, 0),
+    "atomc_positions": (1e-4, 0),
+    "b_factors": (1e-4, 0),
+    "rigidgroups_gt_frames": (1e-4, 1e-4),
+    "rigidgroups_alt_gt_frames": (1e-4, 1e-4),
+    "torsion_angles_sin_cos": (1e-4, 1e-4),
+    "alt_torsion_angles_sin_cos": (1e-4, 1e-4),
+}
+# Compared exactly
+EXACT_ARRAYS = [
+    "aatype", "atom_mask", "atomc_mask", "residue_index", "chain_index",
+    "chain_id", "rigidgroups_gt_exists", "rigidgroups_group_exists",
+    "rigidgroups_group_is_ambiguous", "torsion_angles_mask", "residue_to_seq_id",
+    "prot_mask", "chain_idx_to_residues",
+]
+LDDT_ATOL = 1e-5
+METRIC_ATOL = 1e-5
+# Number of standard errors the means of a stochastic metric may differ by
+METRIC_SIGMAS = 4
+# Mean over the targets of the total variation distance between how often
+# each target is matched to each prediction residue
+MAX_CORRESPONDENCE_DISTANCE = 0.1
+
+
+def add_args(parser):
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="Rewrite the golden outputs instead of comparing with them",
+    )
+    parser.add_argument(
+        "--fixtures",
+        nargs="+",
+        help="Names of the fixtures to check, all by default",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=20,
+        help="Number of runs of the stochastic correspondence and metrics",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the shuffles in the correspondence",
+    )
+    parser.add_argument(
+        "--json",
+        help="If set, path to save the comparison report as JSON",
+    )
+
+    return parser
+
+
+def get_fixtures():
+    fixtures = {}
+    for target_path in sorted(glob.glob(os.path.join(FIXTURE_DIR, "*_target.*"))):
+        name = os.path.basename(target_path).rsplit("_target.", 1)[0]
+        fixtures[name] = (target_path, os.path.join(FIXTURE_DIR, f"{name}_pred.cif"))
+    return fixtures
+
+
+def get_protein_arrays(protein):
+    arrays = {key: np.asarray(getattr(protein, key)) for key in ARRAY_TOLERANCES}
+    for key in EXACT_ARRAYS:
+        if key == "chain_idx_to_residues":
+            # Ragged, kept as the concatenation and the length of every chain
+            arrays[key] = np.concatenate(protein.chain_idx_to_residues)
+            arrays["chain_lengths"] = np.array([len(c) for c in protein.chain_idx_to_residues])
+        else:
+            arrays[key] = np.asarray(getattr(protein, key))
+    return arrays
+
+
+def get_cas(protein):
+    # CA for amino acids and P for nucleotides, as in the fit reports
+    cas = np.zeros_like(protein.atom_positions[:, 0])
+    cas[protein.prot_mask] = protein.atom_positions[protein.prot_mask, atom_order["CA"]]
+    cas[~protein.prot_mask] = protein.atom_positions[~protein.prot_mask, atom_order["P"]]
+    return cas
+
+
+def run_modelangelo(predicted_protein, target_protein):
+    parsed_args = modelangelo_add_args(argparse.ArgumentParser()).parse_args(
+        ["-p", "", "-t", "", "-o", ""]
+    )
+    return modelangelo_main(
+        parsed_args, predicted_protein=predicted_protein, target_protein=target_protein, log=TraceLog()
+    )
+
+
+def compute_outputs(target_path, predicted_path, runs, seed):
+    with warnings.catch_warnings():
+        # The insertion code fixture warns on purpose
+        warnings.simplefilter("ignore")
+        target_protein = get_protein_from_file_path(target_path)
+        predicted_protein = get_protein_from_file_path(predicted_path)
+    arrays = {f"target_{key}": value for key, value in get_protein_arrays(target_protein).items()}
+    arrays.update(
+        {f"predicted_{key}": value for key, value in get_protein_arrays(predicted_protein).items()}
+    )
+
+    target_cas, predicted_cas = get_cas(target_protein), get_cas(predicted_protein)
+    random.seed(seed)
+    pair_counts = {}
+    metric_runs = {}
+    for _ in range(runs):
+        target_correspondence, input_correspondence = get_correspondence(predicted_cas, target_cas)
+        for pair in zip(target_correspondence.tolist(), input_correspondence.tolist()):
+            pair_counts[pair] = pair_counts.get(pair, 0) + 1
+        run_metrics = {"num_matches": len(target_correspondence)}
+        run_metrics.update(run_modelangelo(predicted_protein, target_protein))
+        tm_result = tm_align(predicted_protein, target_protein)
+        # The superposition itself (rot, trans) is left out
+        run_metrics.update(
+            {f"tm_{key}": value for key, value in tm_result.items() if np.ndim(value) == 0}
+        )
+        for key, value in run_metrics.items():
+            metric_runs.setdefault(key, []).append(float(value))
+
+    # lDDT of the pairs matched in most runs, so it does not depend on the shuffles
+    modal_pairs = sorted(pair for pair, count in pair_counts.items() if count * 2 > runs)
+    modal_target = np.array([t for t, _ in modal_pairs], dtype=np.int64)
+    modal_input = np.array([i for _, i in modal_pairs], dtype=np.int64)
+    arrays["modal_target_correspondence"] = modal_target
+    arrays["modal_input_correspondence"] = modal_input
+    arrays["lddt"] = (
+        get_lddt(predicted_cas[modal_input], target_cas[modal_target]) if len(modal_pairs) else np.zeros(0)
+    )
+
+    metrics = {
+        "runs": runs,
+        "pair_frequencies": [[t, i, count / runs] for (t, i), count in sorted(pair_counts.items())],
+        "metric_runs": metric_runs,
+        "chain_comparison": {
+            key: float(value) for key, value in chain_comparison(target_protein, predicted_protein).items()
+        },
+    }
+    return arrays, metrics
+
+
+def compare_arrays(golden, new):
+    failures = []
+    for key in golden:
+        field = key.split("_", 1)[-1]
+        if key not in new:
+            failures.append(f"{key}: missing")
+            continue
+        if golden[key].shape != new[key].shape:
+            failures.append(f"{key}: shape {new[key].shape} instead of {golden[key].shape}")
+            continue
+        if key == "lddt":
+            atol, rtol = LDDT_ATOL, 0
+        else:
+            atol, rtol = ARRAY_TOLERANCES.get(field, (None, None))
+        if atol is None or golden[key].dtype.kind not in "fc":
+            if not np.array_equal(golden[key], new[key]):
+                failures.append(f"{key}: {np.sum(golden[key] != new[key])} values differ")
+        elif not np.allclose(new[key], golden[key], atol=atol, rtol=rtol, equal_nan=True):
+            deviation = np.nanmax(np.abs(new[key] - golden[key]))
+            failures.append(f"{key}: max deviation {deviation:.3g} above atol {atol:g}, rtol {rtol:g}")
+    return failures
+
+
+def get_correspondence_distance(golden_frequencies, new_frequencies):
+    """
+    Mean over the targets of the total variation distance between the
+    distributions of the prediction residue each target is matched to,
+    being unmatched counting as one more outcome
+    """
+    golden_pairs = {(t, i): f for t, i, f in golden_frequencies}
+    new_pairs = {(t, i): f for t, i, f in new_frequencies}
+    targets = {t for t, _ in golden_pairs} | {t for t, _ in new_pairs}
+    if not targets:
+        return 0.0
+    distance = 0.0
+    for target in targets:
+        golden_target = {i: f for (t, i), f in golden_pairs.items() if t == target}
+        new_target = {i: f for (t, i), f in new_pairs.items() if t == target}
+        outcomes = set(golden_target) | set(new_target)
+        difference = sum(abs(golden_target.get(i, 0) - new_target.get(i, 0)) for i in outcomes)
+        difference += abs((1 - sum(golden_target.values())) - (1 - sum(new_target.values())))
+        distance += difference / 2
+    return distance / len(targets)
+
+
+def compare_metrics(golden, new):
+    failures = []
+    distance = get_correspondence_distance(golden["pair_frequencies"], new["pair_frequencies"])
+    if distance > MAX_CORRESPONDENCE_DISTANCE:
+        failures.append(
+            f"correspondence: distance {distance:.3f} above {MAX_CORRESPONDENCE_DISTANCE}"
+        )
+
+    for key, golden_values in golden["metric_runs"].items():
+        if key not in new["metric_runs"]:
+            failures.append(f"{key}: missing")
+            continue
+        golden_values, new_values = np.array(golden_values), np.array(new["metric_runs"][key])
+        # Standard error of the difference of the two means
+        standard_error = math.sqrt(
+            golden_values.var(ddof=1) / len(golden_values) + new_values.var(ddof=1) / len(new_values)
+        ) if min(len(golden_values), len(new_values)) > 1 else 0.0
+        difference = abs(new_values.mean() - golden_values.mean())
+        if difference > METRIC_ATOL + METRIC_SIGMAS * standard_error:
+            failures.append(
+                f"{key}: mean {new_values.mean():.6g} instead of {golden_values.mean():.6g} "
+                f"(standard error {standard_error:.3g})"
+            )
+
+    for key, golden_value in golden["chain_comparison"].items():
+        new_value = new["chain_comparison"].get(key)
+        if new_value is None or not math.isclose(new_value, golden_value, abs_tol=METRIC_ATOL):
+            failures.append(f"chain_comparison {key}: {new_value} instead of {golden_value}")
+    return failures
+
+
+def compare_constant_tables():
+    """
+    The cached residue_constants_tables.npz against the tables built from the definitions
+    """
+    cached = read_constant_tables()
+    if cached is None:
+        return ["residue_constants_tables.npz is missing or outdated, run with --update"]
+    failures = []
+    tables = make_constant_tables()
+    for key in sorted(set(tables) | set(cached)):
+        if key not in cached or key not in tables:
+            failures.append(f"constant table {key}: only in {'the definitions' if key in tables else 'the npz'}")
+        elif cached[key].dtype != tables[key].dtype or not np.array_equal(cached[key], tables[key]):
+            failures.append(f"constant table {key}: differs from the definitions")
+    return failures
+
+
+def get_golden_paths(name):
+    return (
+        os.path.join(GOLDEN_DIR, f"{name}_arrays.npz"),
+        os.path.join(GOLDEN_DIR, f"{name}_metrics.json"),
+    )
+
+
+def main(parsed_args):
+    fixtures = get_fixtures()
+    names = parsed_args.fixtures or list(fixtures)
+    unknown = set(names) - set(fixtures)
+    if unknown:
+        raise ValueError(f"Unknown fixtures: {', '.join(sorted(unknown))}")
+
+    report = {}
+    if parsed_args.update:
+        write_constant_tables()
+        print(f"{'constant_tables':28s} residue_constants_tables.npz written")
+    else:
+        report["constant_tables"] = compare_constant_tables()
+        print(f"{'constant_tables':28s} {'FAIL' if report['constant_tables'] else 'ok'}")
+        for failure in report["constant_tables"]:
+            print(f"  - {failure}")
+    for name in names:
+        arrays, metrics = compute_outputs(*fixtures[name], parsed_args.runs, parsed_args.seed)
+        arrays_path, metrics_path = get_golden_paths(name)
+        if parsed_args.update:
+            os.makedirs(GOLDEN_DIR, exist_ok=True)
+            np.savez_compressed(arrays_path, **arrays)
+            with open(metrics_path, "w") as f:
+                json.dump(metrics, f, indent=1)
+            print(f"{name:28s} golden outputs written")
+            continue
+
+        if not os.path.exists(arrays_path):
+            report[name] = ["no golden outputs, run with --update"]
+        else:
+            with np.load(arrays_path) as golden_arrays:
+                failures = compare_arrays(dict(golden_arrays), arrays)
+            with open(metrics_path) as f:
+                failures += compare_metrics(json.load(f), metrics)
+            report[name] = failures
+        print(f"{name:28s} {'FAIL' if report[name] else 'ok'}")
+        for failure in report[name]:
+            print(f"  - {failure}")
+
+    if parsed_args.json is not None:
+        with open(parsed_args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser = add_args(parser)
+    parsed_args = parser.parse_args()
+    report = main(parsed_args)
+    sys.exit(1 if any(report.values()) else 0)
@@ -0,0 +1,280 @@
+"""
+Scaling benchmark
+Builds synthetic targets of increasing size by tiling copies of a reference
+structure on a grid, and predictions by perturbing their coordinates and
+dropping residues, then times the hot paths at every size: parsing,
+correspondence, lDDT, the all-atom fit report, the mmCIF writer and a full
+evaluate.main. Besides the wall time, every step reports its CPU time, the
+process peak RSS and the breakdown into its profiled sub-steps (see
+utils/profile_utils.py). Run from src/:
+
+    python -m benchmarks.scaling --json scaling.json
+    python -m benchmarks.scaling --sizes 1000 10000 --steps get_correspondence get_lddt
+
+The peak RSS is the high-water mark of the benchmark process, sizes run in
+increasing order so it grows with the size that needed it.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from evaluate import add_args as evaluate_add_args
+from evaluate import main as evaluate_main
+from modelangeloEval import get_all_atom_fit_report
+from utils.cas_utils import get_correspondence, get_lddt
+from utils.profile_utils import Profiler, profile_step
+from utils.protein import get_protein_empty_except, get_protein_from_file_path
+from utils.residue_constants import atom_order
+from utils.result_utils import RecordingSink
+from utils.save_pdb_utils import chain_atom14_to_cif, protein_to_cif
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_REFERENCE = os.path.join(SRC_DIR, "..", "example", "3j9s_ref.pdb")
+DEFAULT_SIZES = [1000, 10000, 50000, 200000]
+STEPS = [
+    "get_protein_from_file_path",
+    "get_correspondence",
+    "get_lddt",
+    "get_all_atom_fit_report",
+    "chain_atom14_to_cif",
+    "evaluate",
+]
+# The in-process engines, so the benchmark runs without USalign or PHENIX
+DEFAULT_EVALUATE_ARGS = "--modelangelo True --tm-engine numpy --phenix True --phenix-engine native --parallel False"
+
+
+def add_args(parser):
+    parser.add_argument(
+        "--reference",
+        default=DEFAULT_REFERENCE,
+        help="Structure tiled into the synthetic targets",
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=DEFAULT_SIZES,
+        help="Number of residues of the synthetic targets",
+    )
+    parser.add_argument(
+        "--steps",
+        nargs="+",
+        default=STEPS,
+        choices=STEPS,
+        help="Steps to time",
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        help="Number of timed runs per step and size, the median is reported",
+    )
+    parser.add_argument(
+        "--noise",
+        type=float,
+        default=0.5,
+        help="In angstrom (Å), standard deviation of the coordinate noise of the predictions",
+    )
+    parser.add_argument(
+        "--drop-fraction",
+        type=float,
+        default=0.02,
+        help="Fraction of the target residues missing from the predictions",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the synthetic structures",
+    )
+    parser.add_argument(
+        "--evaluate-args",
+        default=DEFAULT_EVALUATE_ARGS,
+        help="Options of the timed evaluate.main runs",
+    )
+    parser.add_argument(
+        "--work-dir",
+        help="Directory for the synthetic structures and outputs, a temporary one by default",
+    )
+    parser.add_argument(
+        "--json",
+        help="If set, path to save the results as JSON",
+    )
+
+    return parser
+
+
+def make_synthetic_pair(reference, num_residues, noise, drop_fraction, rng):
+    """
+    Target: copies of the reference on a grid far enough apart not to touch,
+    truncated to num_residues. Prediction: the target with Gaussian noise on
+    every atom and a random fraction of its residues left out.
+    """
+    num_copies = -(-num_residues // len(reference.aatype))
+    positions = reference.atomc_positions[reference.atomc_mask > 0.5]
+    spacing = np.max(positions.max(axis=0) - positions.min(axis=0)) + 20
+    grid_size = int(np.ceil(num_copies ** (1 / 3)))
+    num_chains = len(reference.chain_id)
+
+    offsets = np.stack(np.unravel_index(np.arange(num_copies), (grid_size,) * 3), axis=-1) * spacing
+    residue_copy = np.repeat(np.arange(num_copies), len(reference.aatype))[:num_residues]
+    residue_idx = np.tile(np.arange(len(reference.aatype)), num_copies)[:num_residues]
+
+    target = get_protein_empty_except(
+        aatype=reference.aatype[residue_idx],
+        atomc_positions=(
+            reference.atomc_positions[residue_idx] + offsets[residue_copy][:, None]
+        ).astype(np.float32),
+        atomc_mask=reference.atomc_mask[residue_idx],
+        residue_index=reference.residue_index[residue_idx],
+        chain_index=residue_copy * num_chains + reference.chain_index[residue_idx],
+        chain_id=np.array([
+            f"{chain_id}{copy}" for copy in range(num_copies) for chain_id in reference.chain_id
+        ]),
+        prot_mask=reference.prot_mask[residue_idx],
+    )
+
+    keep = np.sort(rng.permutation(num_residues)[: int(round(num_residues * (1 - drop_fraction)))])
+    prediction = get_protein_empty_except(
+        aatype=target.aatype[keep],
+        atomc_positions=(
+            target.atomc_positions[keep] + rng.normal(0, noise, target.atomc_positions[keep].shape)
+        ).astype(np.float32),
+        atomc_mask=target.atomc_mask[keep],
+        residue_index=target.residue_index[keep],
+        chain_index=target.chain_index[keep],
+        chain_id=target.chain_id,
+        prot_mask=target.prot_mask[keep],
+    )
+    return target, prediction
+
+
+def get_cas(protein):
+    # CA for amino acids and P for nucleotides, as in the fit reports
+    cas = np.zeros_like(protein.atom_positions[:, 0])
+    cas[protein.prot_mask] = protein.atom_positions[protein.prot_mask, atom_order["CA"]]
+    cas[~protein.prot_mask] = protein.atom_positions[~protein.prot_mask, atom_order["P"]]
+    return cas
+
+
+def get_step_calls(size_dir, target_path, predicted_path, target, prediction, evaluate_args):
+    target_cas, predicted_cas = get_cas(target), get_cas(prediction)
+    target_correspondence, input_correspondence = get_correspondence(predicted_cas, target_cas)
+    evaluate_parser = evaluate_add_args(argparse.ArgumentParser(prog="evaluate.py"))
+
+    def run_evaluate():
+        output_file = os.path.join(size_dir, "evaluate", "result.log")
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        recording_sink = RecordingSink()
+        evaluate_main(evaluate_parser.parse_args(
+            ["-p", predicted_path, "-t", target_path, "-o", output_file] + evaluate_args.split()
+        ), sink=recording_sink)
+        # evaluate.main profiles itself, its breakdown comes with its record
+        return {
+            f"evaluate.{key}": value for key, value in recording_sink.record.items()
+            if key.endswith(("_seconds", "_peak_rss_growth_mb", "_calls")) and key != "total_seconds"
+        }
+
+    return {
+        "get_protein_from_file_path": lambda: get_protein_from_file_path(target_path),
+        "get_correspondence": lambda: get_correspondence(predicted_cas, target_cas),
+        "get_lddt": lambda: get_lddt(
+            predicted_cas[input_correspondence], target_cas[target_correspondence]
+        ),
+        "get_all_atom_fit_report": lambda: get_all_atom_fit_report(prediction, target),
+        "chain_atom14_to_cif": lambda: chain_atom14_to_cif(
+            [target.aatype[c] for c in target.chain_idx_to_residues],
+            [target.atomc_positions[c] for c in target.chain_idx_to_residues],
+            [target.atomc_mask[c] for c in target.chain_idx_to_residues],
+            path_to_save=os.path.join(size_dir, "chain_atom14.cif"),
+        ),
+        "evaluate": run_evaluate,
+    }
+
+
+def time_step(step_call, step, repeats):
+    runs = []
+    for _ in range(repeats):
+        profiler = Profiler()
+        with profiler.activate(), profile_step(step):
+            output = step_call()
+        fields = profiler.get_record_fields()
+        if step == "evaluate":
+            fields.update(output)
+        runs.append(fields)
+    # Median of every field over the runs, sub-steps included. The peak RSS only
+    # grows in the first run that reaches it, so its growth is the largest one
+    return {
+        key: (max if key.endswith("_peak_rss_growth_mb") else statistics.median)(
+            [run[key] for run in runs if key in run]
+        )
+        for key in runs[0]
+    }
+
+
+def main(parsed_args):
+    rng = np.random.default_rng(parsed_args.seed)
+    reference = get_protein_from_file_path(parsed_args.reference)
+    results = {
+        "config": {
+            "reference": os.path.abspath(parsed_args.reference),
+            "noise": parsed_args.noise,
+            "drop_fraction": parsed_args.drop_fraction,
+            "seed": parsed_args.seed,
+            "repeats": parsed_args.repeats,
+            "evaluate_args": parsed_args.evaluate_args,
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "timestamp": time.time(),
+        },
+        "sizes": {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = parsed_args.work_dir or tmp_dir
+        for size in sorted(parsed_args.sizes):
+            size_dir = os.path.join(work_dir, f"size_{size}")
+            os.makedirs(size_dir, exist_ok=True)
+            target, prediction = make_synthetic_pair(
+                reference, size, parsed_args.noise, parsed_args.drop_fraction, rng
+            )
+            target_path = os.path.join(size_dir, "target.cif")
+            predicted_path = os.path.join(size_dir, "prediction.cif")
+            protein_to_cif(target, target_path)
+            protein_to_cif(prediction, predicted_path)
+            # The parsed structures, so every step sees what evaluate.py sees
+            target = get_protein_from_file_path(target_path)
+            prediction = get_protein_from_file_path(predicted_path)
+
+            step_calls = get_step_calls(
+                size_dir, target_path, predicted_path, target, prediction, parsed_args.evaluate_args
+            )
+            results["sizes"][size] = {"num_predicted_residues": len(prediction.aatype), "steps": {}}
+            for step in parsed_args.steps:
+                fields = time_step(step_calls[step], step, parsed_args.repeats)
+                results["sizes"][size]["steps"][step] = fields
+                print(
+                    f"{size:>8d} residues  {step:28s} {fields[f'{step}_seconds']:9.3f}s wall "
+                    f"{fields[f'{step}_cpu_seconds']:9.3f}s cpu {fields[f'{step}_peak_rss_growth_mb']:9.1f} MB peak growth"
+                )
+
+    if parsed_args.json is not None:
+        with open(parsed_args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser = add_args(parser)
+    parsed_args = parser.parse_args()
+    main(parsed_args)
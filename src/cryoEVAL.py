@@ -3,6 +3,10 @@ import argparse
 import re
 import os
 
+from utils.result_utils import format_value
+from utils.subprocess_utils import get_limits, run_command
+from utils.trace_utils import TraceLog
+
 
 def add_args(parser):
     parser.add_argument(
@@ -32,11 +36,35 @@ def add_args(parser):
         action="store_true",
         help="If set, prints the results to the console",
     )
+    parser.add_argument(
+        "--tm-engine",
+        default="usalign",
+        choices=["usalign", "numpy"],
+        help="Compute the TM-score with the USalign binary or in-process with NumPy",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="In seconds, wall-clock limit for each external tool call",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=float,
+        default=None,
+        help="In GB, address space limit for each external tool call",
+    )
+    parser.add_argument(
+        "--max-cpu-time",
+        type=float,
+        default=None,
+        help="In seconds, CPU time limit for each external tool call",
+    )
     
     return parser
 
 
-def main(parsed_args):
+def run_usalign(parsed_args, log):
     # Get the full path of the script
     script_path = os.path.abspath(__file__) 
     # Extract the directory of the script
@@ -54,120 +82,193 @@ def main(parsed_args):
         "-outfmt", "-1",  
         ]
     
+    result = run_command(command, **get_limits(parsed_args))
+    output_log = result.stdout
+                
+    if log.full:
+        log.write("*" * 52 + "\n")
+        log.write("Credit from Zhang Lab: US-align (Version 20230609)\n")
+        log.write("Reference: C Zhang, M Shine, AM Pyle, Y Zhang. (2022) Nat Methods\n")
+        log.write("*" * 52 + "\n")
+        log.write(output_log)
+
+
+    ## Parse output ##
+    aligned_length_pattern = r"Aligned length= (\d+)"
+    tm_score_pattern = r"TM-score= ([0-9.]+) \(normalized by length of Structure_2"
+    len_predict_pattern = r"Length of Structure_1: (\d+) residues"
+    len_target_pattern = r"Length of Structure_2: (\d+) residues"
     
-    try:
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
-        output_log = result.stdout
-                    
-        if parsed_args.output_file is not None:
-            with open(parsed_args.output_file, 'a') as f:
-                f.write("*" * 52 + "\n")
-                f.write("Credit from Zhang Lab: US-align (Version 20230609)\n")
-                f.write("Reference: C Zhang, M Shine, AM Pyle, Y Zhang. (2022) Nat Methods\n")
-                f.write("*" * 52 + "\n")
-                f.write(output_log)
-
-
-        ## Parse output ##
-        aligned_length_pattern = r"Aligned length= (\d+)"
-        tm_score_pattern = r"TM-score= ([0-9.]+) \(normalized by length of Structure_2"
-        len_predict_pattern = r"Length of Structure_1: (\d+) residues"
-        len_target_pattern = r"Length of Structure_2: (\d+) residues"
-        
-        # Search for 'Aligned length all d', not constrained by the distance threshold
-        aligned_length_match = re.search(aligned_length_pattern, output_log)
-        if aligned_length_match:
-            aligned_length_alld = int(aligned_length_match.group(1))
-        else:
-            # Raise an exception if 'Aligned length' is not found
-            raise ValueError("Aligned length not found in the output")
+    # Search for 'Aligned length all d', not constrained by the distance threshold
+    aligned_length_match = re.search(aligned_length_pattern, output_log)
+    if aligned_length_match:
+        aligned_length_alld = int(aligned_length_match.group(1))
+    else:
+        # Raise an exception if 'Aligned length' is not found
+        raise ValueError("Aligned length not found in the output")
 
-        # Search for 'TM-score'
-        tm_score_match = re.search(tm_score_pattern, output_log)
-        if tm_score_match:
-            tm_score = float(tm_score_match.group(1))
-        else:
-            # Raise an exception if 'TM-score' is not found
-            raise ValueError("TM-score not found in the output")
-        
-        # Search for 'Length of predicted and target structures'
-        len_predict_match = re.search(len_predict_pattern, output_log)
-        len_target_match = re.search(len_target_pattern, output_log)
-        if len_predict_pattern and len_target_pattern:
-            len_predict = int(len_predict_match.group(1))
-            len_target = int(len_target_match.group(1))
+    # Search for 'TM-score'
+    tm_score_match = re.search(tm_score_pattern, output_log)
+    if tm_score_match:
+        tm_score = float(tm_score_match.group(1))
+    else:
+        # Raise an exception if 'TM-score' is not found
+        raise ValueError("TM-score not found in the output")
+    
+    # Search for 'Length of predicted and target structures'
+    len_predict_match = re.search(len_predict_pattern, output_log)
+    len_target_match = re.search(len_target_pattern, output_log)
+    if len_predict_pattern and len_target_pattern:
+        len_predict = int(len_predict_match.group(1))
+        len_target = int(len_target_match.group(1))
+    else:
+        raise ValueError("Length of Predicted structure or Length of Target structure not found in the output")
+    
+    # extract the paired residues
+    start_marker = '(":" denotes residue pairs of d < 3.0 Angstrom, "." denotes other aligned residues)'
+    end_marker = "#Total CPU time is"
+    start_index = output_log.find(start_marker) + len(start_marker)
+    end_index = output_log.find(end_marker)
+    extracted_text = output_log[start_index:end_index].strip()
+    lines = extracted_text.split('\n')
+    
+    pred_seq = lines[0]
+    target_seq = lines[2]
+    match_notation = lines[1]
+    
+    assert len(pred_seq) == len(target_seq) == len(match_notation)
+    assert match_notation.count(':') + match_notation.count('.') == aligned_length_alld
+    
+    aligned_length = match_notation.count(':')
+    
+    # count the number of matched residues that have the same type of amino acid
+    aa_match = 0
+    for i in range(len(pred_seq)):
+        if (pred_seq[i] == target_seq[i]) and match_notation[i] == ':':
+            aa_match += 1
+            # print(pred_seq[i], target_seq[i], match_notation[i])
+
+    return tm_score, aligned_length, aa_match, len_predict, len_target, output_log
+
+
+def run_tm_engine(parsed_args, log, predicted_protein=None, target_protein=None):
+    # Only the in-process engine needs the structure parser
+    from utils.protein import get_protein_from_file_path
+    from utils.tm_utils import tm_align
+
+    if predicted_protein is None:
+        predicted_protein = get_protein_from_file_path(parsed_args.predicted_structure)
+    if target_protein is None:
+        target_protein = get_protein_from_file_path(parsed_args.target_structure)
+    result = tm_align(predicted_protein, target_protein, d_cut=3.0)
+
+    output_log = (
+        f"Length of Structure_1: {result['len_predict']} residues\n"
+        f"Length of Structure_2: {result['len_target']} residues\n\n"
+        f"Aligned length= {result['aligned_length_all']}, "
+        f"RMSD= {result['rmsd']:6.2f}\n"
+        f"TM-score= {result['tm_score']:.5f} (normalized by length of Structure_2: "
+        f"L={result['len_target']}, d0={result['d0']:.2f})\n"
+    )
+
+    if log.full:
+        log.write("*" * 52 + "\n")
+        log.write("In-process TM-score engine (NumPy)\n")
+        log.write("*" * 52 + "\n")
+        log.write(output_log)
+
+    return (
+        result["tm_score"],
+        result["aligned_length"],
+        result["aa_match"],
+        result["len_predict"],
+        result["len_target"],
+        output_log,
+    )
+
+
+def get_ratio(numerator, denominator):
+    # 0 when nothing is aligned, like modelangeloEval.get_f1score
+    if denominator == 0:
+        return 0.0
+    return numerator / denominator
+
+
+def get_harmonic_mean(a, b):
+    if a + b == 0:
+        return 0.0
+    return 2 * a * b / (a + b)
+
+
+def main(parsed_args, predicted_protein=None, target_protein=None, log=None):
+    # Run on its own, the stage traces to its own output file
+    own_log = log is None
+    if own_log:
+        log = TraceLog(parsed_args.output_file)
+    try:
+        if getattr(parsed_args, "tm_engine", "usalign") == "numpy":
+            tm_score, aligned_length, aa_match, len_predict, len_target, output_log = run_tm_engine(
+                parsed_args, log, predicted_protein, target_protein
+            )
         else:
-            raise ValueError("Length of Predicted structure or Length of Target structure not found in the output")
-        
-        # extract the paired residues
-        start_marker = '(":" denotes residue pairs of d < 3.0 Angstrom, "." denotes other aligned residues)'
-        end_marker = "#Total CPU time is"
-        start_index = output_log.find(start_marker) + len(start_marker)
-        end_index = output_log.find(end_marker)
-        extracted_text = output_log[start_index:end_index].strip()
-        lines = extracted_text.split('\n')
-        
-        pred_seq = lines[0]
-        target_seq = lines[2]
-        match_notation = lines[1]
-        
-        assert len(pred_seq) == len(target_seq) == len(match_notation)
-        assert match_notation.count(':') + match_notation.count('.') == aligned_length_alld
-        
-        aligned_length = match_notation.count(':')
+            tm_score, aligned_length, aa_match, len_predict, len_target, output_log = run_usalign(parsed_args, log)
         
         # calculate precision and recall and f1 score
-        precision = aligned_length / len_predict
-        recall = aligned_length / len_target
-        f1score = 2 * precision * recall / (precision + recall)
-        
-        # count the number of matched residues that have the same type of amino acid
-        aa_match = 0
-        for i in range(len(pred_seq)):
-            if (pred_seq[i] == target_seq[i]) and match_notation[i] == ':':
-                aa_match += 1
-                # print(pred_seq[i], target_seq[i], match_notation[i])
+        precision = get_ratio(aligned_length, len_predict)
+        recall = get_ratio(aligned_length, len_target)
+        f1score = get_harmonic_mean(precision, recall)
         
         # calculate sequence match and sequence recall       
-        residue_match = aa_match / aligned_length
-        residue_recall = aa_match / len_target
+        residue_match = get_ratio(aa_match, aligned_length)
+        residue_recall = get_ratio(aa_match, len_target)
         
         # TMRR-score
-        tmrr_score = 2 * tm_score * residue_recall / (tm_score + residue_recall)
+        tmrr_score = get_harmonic_mean(tm_score, residue_recall)
         
         # completeness
-        completeness = len_predict / len_target
+        completeness = get_ratio(len_predict, len_target)
         
         output = {
-            "tm_score": "{:.3f}".format(tm_score),
+            "tm_score": float(tm_score),
             "aligned_length": aligned_length,
             "len_predict": len_predict,
             "len_target": len_target,
-            "precision": "{:.3f}".format(precision),
-            "recall": "{:.3f}".format(recall),
-            "f1score": "{:.3f}".format(f1score),
-            "residue_match": "{:.3f}".format(residue_match),
-            "residue_recall": "{:.3f}".format(residue_recall),
-            "tmrr_score": "{:.3f}".format(tmrr_score),
-            "completeness": "{:.3f}".format(completeness),
+            "precision": float(precision),
+            "recall": float(recall),
+            "f1score": float(f1score),
+            "residue_match": float(residue_match),
+            "residue_recall": float(residue_recall),
+            "tmrr_score": float(tmrr_score),
+            "completeness": float(completeness),
         }
         
-        if parsed_args.output_file is not None:
-            with open(parsed_args.output_file, 'a') as f:
-                f.write(f"\n")
-                for key, value in output.items():
-                    f.write(f"{key}: {value}\n")
+        log.write("\n")
+        for key, value in output.items():
+            log.write(f"{key}: {format_value(value)}\n")
         
         if parsed_args.verbose:
             print(output_log)
             for key, value in output.items():
-                print(f"{key}: {value}")
+                print(f"{key}: {format_value(value)}")
                 
         return output
 
+    except subprocess.TimeoutExpired as e:
+        # Record the timed out job instead of stalling the run
+        print("Timeout: USalign did not finish in", e.timeout, "seconds")
+        log.write(f"\nTIMEOUT: USalign killed after {e.timeout} seconds\n")
+        return {"cryoEVAL_status": "timeout"}
+
     except subprocess.CalledProcessError as e:
-        # Handle errors if the command fails
+        # A negative return code is a signal, e.g. from --max-cpu-time
+        status = "killed" if e.returncode < 0 else "error"
         print("Error:", e.stderr)
+        log.write(f"\n{status.upper()}: USalign exited with code {e.returncode}\n")
+        return {"cryoEVAL_status": status}
+
+    finally:
+        if own_log:
+            log.close()
     
 
 if __name__ == "__main__":
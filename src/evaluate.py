@@ -1,9 +1,20 @@
 import argparse
+import contextvars
+import copy
 import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from modelangeloEval import MATCH_TYPES
 from modelangeloEval import main as modelangeloEval_main
 from phenixCC import main as phenixCC_main
 from cryoEVAL import main as cryoEVAL_main
+from utils.profile_utils import Profiler, profile_step
+from utils.protein import get_protein_from_file_path
+from utils.result_utils import ResultSink, format_value
+from utils.save_pdb_utils import protein_to_cif
+from utils.trace_utils import TraceLog
 
 # Define a function to convert string input to boolean
 def str2bool(v):
@@ -51,6 +62,12 @@ def add_args(parser):
         default=True,
         help="If True, do cryoEVAL evaluation",
     )    
+    parser.add_argument(
+        "--tm-engine",
+        default="usalign",
+        choices=["usalign", "numpy"],
+        help="Compute the cryoEVAL TM-score with the USalign binary or in-process with NumPy",
+    )
     parser.add_argument(
         "--modelangelo",
         type=str2bool,
@@ -63,6 +80,72 @@ def add_args(parser):
         default=False,
         help="If True, do phenix.chain_comparison evaluation",
     )
+    parser.add_argument(
+        "--phenix-engine",
+        default="phenix",
+        choices=["phenix", "native"],
+        help="Compute the chain comparison metrics with phenix.chain_comparison "
+        "or in-process with NumPy, which needs no PHENIX install",
+    )
+    parser.add_argument(
+        "--normalize-inputs",
+        type=str2bool,
+        default=True,
+        help="If True, parse each structure once and give USalign and PHENIX "
+        "a normalized mmCIF written from it, so all stages see the same residues",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=str2bool,
+        default=True,
+        help="If True, run the USalign and PHENIX stages in the background "
+        "while the ModelAngelo stage runs",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="In seconds, wall-clock limit for each external tool call",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=float,
+        default=None,
+        help="In GB, address space limit for each external tool call",
+    )
+    parser.add_argument(
+        "--max-cpu-time",
+        type=float,
+        default=None,
+        help="In seconds, CPU time limit for each external tool call",
+    )
+    parser.add_argument(
+        "--output-jsonl",
+        help="If set, appends one JSON record with all metrics and stage timings "
+        "of this evaluation to this file",
+    )
+    parser.add_argument(
+        "--output-parquet",
+        help="If set, writes the same record as a Parquet part file into this "
+        "directory (needs pyarrow)",
+    )
+    parser.add_argument(
+        "--log-compression",
+        default="none",
+        choices=["none", "gzip", "zstd"],
+        help="Compress the trace log, zstd needs the zstandard package",
+    )
+    parser.add_argument(
+        "--log-verbosity",
+        default="full",
+        choices=["summary", "full"],
+        help="With summary, the raw USalign/PHENIX outputs are left out of the trace log",
+    )
+    parser.add_argument(
+        "--trace-timeline",
+        help="If set, writes the timeline of the stages and their sub-steps to this "
+        "file in the Chrome trace format (chrome://tracing, ui.perfetto.dev)",
+    )
     parser.add_argument(
         "--max-dist",
         type=float,
@@ -72,20 +155,114 @@ def add_args(parser):
     parser.add_argument(
         "--match-type",
         default="both",
-        choices=["both", "protein", "nucleotide"],
+        choices=MATCH_TYPES,
+        help="With all, the residues are matched once and the ModelAngelo results are "
+        "also reported for the protein residues, the nucleotides and every target chain",
     )
     parser.add_argument(
         "--output-structure",
         help="If set, saves the sequence recall results to an mmCIF file, "
         "B-factors of 100 correspond to correct classifications and "
-        "B-factors of 0 correspond to wrong classifications",
+        "B-factors of 0 correspond to wrong classifications. "
+        "The per residue lDDT, CA deviation, match and matched target residue "
+        "are in the _cryoeval_residue loop. Gzipped if the path ends in .gz",
     )
     
     return parser
 
 
-def main(parsed_args):
-    
+def prepare_inputs(parsed_args, tmp_dir, load_protein=get_protein_from_file_path):
+    """
+    Parses the prediction and the target once. The in-process stages get the
+    parsed Protein objects and the external tools get a normalized mmCIF written
+    from them, so every stage sees the same residues.
+    load_protein can be swapped for a cached parser by long-running callers.
+    Returns the arguments for the external tools and the Protein keyword arguments
+    """
+    proteins = {
+        "predicted_protein": load_protein(parsed_args.predicted_structure),
+        "target_protein": load_protein(parsed_args.target_structure),
+    }
+    tool_args = copy.copy(parsed_args)
+    uses_usalign = parsed_args.cryoEVAL and getattr(parsed_args, "tm_engine", "usalign") == "usalign"
+    uses_phenix = parsed_args.phenix and getattr(parsed_args, "phenix_engine", "phenix") == "phenix"
+    if uses_usalign or uses_phenix:
+        for key, protein in [("predicted_structure", proteins["predicted_protein"]),
+                             ("target_structure", proteins["target_protein"])]:
+            file_name = os.path.splitext(os.path.basename(getattr(parsed_args, key)))[0]
+            normalized_path = os.path.join(tmp_dir, f"{key}_{file_name}.cif")
+            protein_to_cif(protein, normalized_path)
+            setattr(tool_args, key, normalized_path)
+    return tool_args, proteins
+
+
+def build_record(parsed_args, stage_outputs, timings):
+    """
+    One flat record per evaluated pair for the structured outputs
+    """
+    record = {
+        "prediction_name": os.path.basename(parsed_args.predicted_structure),
+        "predicted_structure": os.path.abspath(parsed_args.predicted_structure),
+        "target_structure": os.path.abspath(parsed_args.target_structure),
+        "timestamp": time.time(),
+    }
+    for output in stage_outputs:
+        record.update(output or {})
+    record.update(timings)
+    return record
+
+
+def run_stage(stage_main, parsed_args, stage_log, stage_kwargs):
+    return stage_main(parsed_args, log=stage_log, **stage_kwargs)
+
+
+def run_stages_concurrently(stage_calls, log):
+    """
+    USalign and phenix.chain_comparison are external processes, so they run in
+    worker threads while ModelAngelo runs in this one. Each stage traces into
+    its own in-memory log, merged into the trace log in the usual order once
+    everything is done.
+    stage_calls maps each enabled stage to its main function, args and kwargs
+    """
+    stages = [
+        ("cryoEVAL", "Run cryoEVAL ...", "[Measure - cryoEVAL] \n"),
+        ("modelangelo", "Run ModelAngelo ...", "[Measure - ModelAngelo]\n"),
+        ("phenix", "Run PHENIX ...", "[Measure - PHENIX] \n"),
+    ]
+    stages = [stage for stage in stages if stage[0] in stage_calls]
+    stage_logs = {name: log.child() for name, _, _ in stages}
+    outputs = {}
+
+    with ThreadPoolExecutor(max_workers=max(len(stages), 1)) as executor:
+        futures = {}
+        for name, message, _ in stages:
+            print(message)
+            if name != "modelangelo":
+                # In a copy of this context, so the worker threads are profiled too
+                futures[name] = executor.submit(
+                    contextvars.copy_context().run,
+                    run_stage, *stage_calls[name][:2], stage_logs[name], stage_calls[name][2],
+                )
+        try:
+            if "modelangelo" in stage_calls:
+                stage_main, stage_args, stage_kwargs = stage_calls["modelangelo"]
+                outputs["modelangelo"] = run_stage(
+                    stage_main, stage_args, stage_logs["modelangelo"], stage_kwargs
+                )
+            for name, future in futures.items():
+                outputs[name] = future.result()
+        finally:
+            for name, _, header in stages:
+                log.write(header)
+                log.write(stage_logs[name].getvalue())
+                if name in outputs:
+                    log.write("\nDONE!\n\n\n\n\n")
+
+    return outputs
+
+
+def main(parsed_args, sink=None, load_protein=get_protein_from_file_path):
+    start = time.perf_counter()
     given_output_file = parsed_args.output_file
     dir_path = os.path.dirname(given_output_file)
     file_name_without_ext = os.path.basename(given_output_file).split('.')[0]
@@ -93,38 +270,66 @@ def main(parsed_args):
     #### Write log file ####
     log_file = os.path.join(dir_path, f"{file_name_without_ext}_TraceLog.log")
     parsed_args.output_file = log_file    
+    log = TraceLog(
+        log_file,
+        compression=getattr(parsed_args, "log_compression", None),
+        verbosity=getattr(parsed_args, "log_verbosity", "full"),
+    )
     
     cryoEVAL_output = {}
     modelangelo_output = {}
     phenix_output = {}
 
-    if parsed_args.cryoEVAL:
-        print("Run cryoEVAL ...")
-        with open(log_file, 'a') as f:
-            f.write("[Measure - cryoEVAL] \n")
-            f.flush()
-            cryoEVAL_output = cryoEVAL_main(parsed_args)
-            f.write("\nDONE!\n\n\n\n\n")
-            f.flush()
-    
-    if parsed_args.modelangelo:
-        print("Run ModelAngelo ...")
-        with open(log_file, 'a') as f:
-            f.write("[Measure - ModelAngelo]\n")
-            f.flush()
-            modelangelo_output = modelangeloEval_main(parsed_args)
-            f.write("\nDONE!\n\n\n\n\n")
-            f.flush()
-            
-    if parsed_args.phenix:
-        print("Run PHENIX ...")
-        with open(log_file, 'a') as f:
-            f.write("[Measure - PHENIX] \n")
-            f.flush()
-            phenix_output = phenixCC_main(parsed_args)
-            f.write("\nDONE!\n\n\n\n\n")
-            f.flush()
-    
+    #### Parse the inputs once for all stages ####
+    # Wall time, CPU time and peak RSS of every stage and sub-step
+    profiler = Profiler()
+    # The normalized inputs are removed even if a stage fails
+    with tempfile.TemporaryDirectory() as tmp_dir, profiler.activate():
+        if getattr(parsed_args, "normalize_inputs", False):
+            with profile_step("prepare_inputs"):
+                tool_args, proteins = prepare_inputs(parsed_args, tmp_dir, load_protein)
+        else:
+            tool_args, proteins = parsed_args, {}
+
+        stage_calls = {}
+        if parsed_args.cryoEVAL:
+            stage_calls["cryoEVAL"] = (profile_step("cryoEVAL")(cryoEVAL_main), tool_args, proteins)
+        if parsed_args.modelangelo:
+            stage_calls["modelangelo"] = (profile_step("modelangelo")(modelangeloEval_main), parsed_args, proteins)
+        if parsed_args.phenix:
+            phenix_kwargs = proteins if getattr(parsed_args, "phenix_engine", "phenix") == "native" else {}
+            stage_calls["phenix"] = (profile_step("phenix")(phenixCC_main), tool_args, phenix_kwargs)
+
+        # Whatever was traced is kept even if a stage fails
+        try:
+            parallel = getattr(parsed_args, "parallel", False)
+            if parallel:
+                outputs = run_stages_concurrently(stage_calls, log)
+                cryoEVAL_output = outputs.get("cryoEVAL", {})
+                modelangelo_output = outputs.get("modelangelo", {})
+                phenix_output = outputs.get("phenix", {})
+
+            if parsed_args.cryoEVAL and not parallel:
+                print("Run cryoEVAL ...")
+                log.write("[Measure - cryoEVAL] \n")
+                cryoEVAL_output = stage_calls["cryoEVAL"][0](tool_args, **proteins, log=log)
+                log.write("\nDONE!\n\n\n\n\n")
+
+            if parsed_args.modelangelo and not parallel:
+                print("Run ModelAngelo ...")
+                log.write("[Measure - ModelAngelo]\n")
+                modelangelo_output = stage_calls["modelangelo"][0](parsed_args, **proteins, log=log)
+                log.write("\nDONE!\n\n\n\n\n")
+
+            if parsed_args.phenix and not parallel:
+                print("Run PHENIX ...")
+                log.write("[Measure - PHENIX] \n")
+                phenix_output = stage_calls["phenix"][0](tool_args, **stage_calls["phenix"][2], log=log)
+                log.write("\nDONE!\n\n\n\n\n")
+        finally:
+            log.close()
+            if getattr(parsed_args, "trace_timeline", None) is not None:
+                profiler.write_trace(parsed_args.trace_timeline)
     
     #### Write final output file ####
     parsed_args.output_file = given_output_file
@@ -142,29 +347,39 @@ def main(parsed_args):
             f.write("########## cryoEVAL Results #############\n")
             f.flush()
             for key, value in cryoEVAL_output.items():
-                f.write(f"{key}: {value}\n") 
-                print(f"  - {key}: {value}")  
+                f.write(f"{key}: {format_value(value)}\n")
+                print(f"  - {key}: {format_value(value)}")  
         
         if parsed_args.modelangelo:
             # From ModelAngelo
             f.write("########## ModelAngelo Results #############\n")
             f.flush()
             for key, value in modelangelo_output.items():
-                f.write(f"{key}: {value}\n") 
-                print(f"  - {key}: {value}")
+                f.write(f"{key}: {format_value(value)}\n")
+                print(f"  - {key}: {format_value(value)}")
         
         if parsed_args.phenix:
             # From PHENIX
             f.write("########## PHENIX Results #############\n")
             f.flush()
             for key, value in phenix_output.items():
-                f.write(f"{key}: {value}\n") 
-                print(f"  - {key}: {value}")
+                f.write(f"{key}: {format_value(value)}\n")
+                print(f"  - {key}: {format_value(value)}")
                 
         f.write(f"\n") 
         f.write(f"\n")
         f.flush()
         
+    #### Write structured results ####
+    timings = profiler.get_record_fields()
+    timings["total_seconds"] = time.perf_counter() - start
+    record = build_record(parsed_args, [cryoEVAL_output, modelangelo_output, phenix_output], timings)
+    if sink is not None:
+        sink.write(record)
+    elif parsed_args.output_jsonl is not None or parsed_args.output_parquet is not None:
+        with ResultSink(parsed_args.output_jsonl, parsed_args.output_parquet) as sink:
+            sink.write(record)
+
     return (cryoEVAL_output, modelangelo_output, phenix_output)
             
             
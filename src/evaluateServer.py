@@ -0,0 +1,278 @@
+"""
+Warm evaluation server
+Keeps Biopython, scipy and the residue constant tables loaded, caches
+parsed structures, and answers scoring requests over local HTTP or a Unix
+socket with the same metrics evaluate.py produces.
+
+    python evaluateServer.py --port 8765
+    curl -X POST localhost:8765/evaluate \
+        -d '{"predicted_structure": "../example/3j9s_agl.cif", "target_structure": "../example/3j9s_ref.pdb", "modelangelo": true}'
+
+The request takes any evaluate.py option by its long name with underscores,
+and is parsed by the evaluate.py argument parser. The options naming output
+files (output_file, output_structure, ...) are rejected, unless the server is
+started with --output-dir, in which case they are paths relative to it.
+Without an "output_file" the text outputs go to a temporary directory.
+"""
+import argparse
+import collections
+import json
+import os
+import signal
+import socketserver
+import sys
+import tempfile
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from evaluate import add_args as evaluate_add_args
+from evaluate import main as evaluate_main
+from utils.protein import get_protein_from_file_path
+from utils.result_utils import RecordingSink, to_builtin
+
+
+def add_args(parser):
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="Address to listen on",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="Port to listen on",
+    )
+    parser.add_argument(
+        "--unix-socket",
+        help="If set, listen on this Unix socket instead of a TCP port",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=32,
+        help="Number of parsed structures kept in memory",
+    )
+    parser.add_argument(
+        "--max-concurrent",
+        type=int,
+        default=1,
+        help="Number of evaluations run at the same time, the rest wait",
+    )
+    parser.add_argument(
+        "--output-dir",
+        help="If set, requests may name output files, which are written inside "
+        "this directory. Without it, requests with output files are rejected",
+    )
+
+    return parser
+
+
+# Options of evaluate.py that name files the evaluation writes
+OUTPUT_OPTIONS = ["output_file", "output_structure", "output_jsonl", "output_parquet", "trace_timeline"]
+
+
+class RequestArgumentParser(argparse.ArgumentParser):
+    """
+    Reports bad options of a request to the client instead of the server's stderr
+    """
+
+    def error(self, message):
+        raise SystemExit(message)
+
+
+class ProteinCache:
+    """
+    LRU cache of parsed structures, keyed by path, modification time and size,
+    so a structure that changed on disk is parsed again. The cached Protein
+    objects are shared between requests and must not be modified.
+    """
+
+    def __init__(self, max_size=32):
+        self.max_size = max_size
+        self.proteins = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, file_path):
+        stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if key in self.proteins:
+                self.hits += 1
+                self.proteins.move_to_end(key)
+                return self.proteins[key]
+            self.misses += 1
+
+        # Parsed outside the lock, a concurrent request for the same file at
+        # worst parses it twice
+        protein = get_protein_from_file_path(file_path)
+        with self.lock:
+            self.proteins[key] = protein
+            self.proteins.move_to_end(key)
+            while len(self.proteins) > self.max_size:
+                self.proteins.popitem(last=False)
+        return protein
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.proteins), "hits": self.hits, "misses": self.misses}
+
+
+class EvaluationServer:
+    def __init__(self, cache_size=32, max_concurrent=1, output_dir=None):
+        self.cache = ProteinCache(cache_size)
+        self.slots = threading.Semaphore(max_concurrent)
+        self.output_dir = os.path.realpath(output_dir) if output_dir is not None else None
+        self.parser = evaluate_add_args(RequestArgumentParser(prog="evaluate.py"))
+        self.actions = {
+            action.dest: action for action in self.parser._actions if action.dest != "help"
+        }
+
+    def get_output_path(self, key, path):
+        if self.output_dir is None:
+            raise ValueError(f"{key} is not allowed, the server was started without --output-dir")
+        output_path = os.path.realpath(os.path.join(self.output_dir, str(path)))
+        if output_path == self.output_dir or os.path.commonpath([output_path, self.output_dir]) != self.output_dir:
+            raise ValueError(f"{key} must be a path inside the output directory")
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        return output_path
+
+    def get_argv(self, request: dict, output_file):
+        """
+        Command line of evaluate.py equivalent to the request
+        """
+        unknown = set(request) - set(self.actions)
+        if unknown:
+            raise ValueError(f"Unknown options: {', '.join(sorted(unknown))}")
+        for key in ["predicted_structure", "target_structure"]:
+            if not request.get(key):
+                raise ValueError(f"{key} is required")
+        request = dict(request)
+        for key in OUTPUT_OPTIONS:
+            if request.get(key) is not None:
+                request[key] = self.get_output_path(key, request[key])
+        request.setdefault("output_file", output_file)
+
+        argv = []
+        for key, value in request.items():
+            action = self.actions[key]
+            option = action.option_strings[0]
+            if value is None:
+                continue
+            if action.nargs == 0:
+                # Flags such as --verbose
+                if not isinstance(value, bool):
+                    raise ValueError(f"{key} must be true or false")
+                if value != action.default:
+                    argv.append(option)
+            elif isinstance(value, list):
+                argv += [option] + [str(item) for item in value]
+            else:
+                # As an "--option=value" pair, so a value starting with - is not an option
+                argv.append(f"{option}={value}")
+        return argv
+
+    def get_args(self, request: dict, output_file=None):
+        argv = self.get_argv(request, output_file)
+        try:
+            return self.parser.parse_args(argv)
+        except SystemExit as e:
+            raise ValueError(f"Invalid options: {e.code}")
+
+    def evaluate(self, request: dict) -> dict:
+        recording_sink = RecordingSink()
+        with self.slots, tempfile.TemporaryDirectory() as tmp_dir:
+            parsed_args = self.get_args(request, os.path.join(tmp_dir, "evaluation.log"))
+            cryoEVAL_output, modelangelo_output, phenix_output = evaluate_main(
+                parsed_args, sink=recording_sink, load_protein=self.cache
+            )
+        return {
+            "cryoEVAL": cryoEVAL_output,
+            "modelangelo": modelangelo_output,
+            "phenix": phenix_output,
+            "timings": {
+                key: value for key, value in recording_sink.record.items() if key.endswith("_seconds")
+            },
+        }
+
+
+class EvaluationRequestHandler(BaseHTTPRequestHandler):
+    server_version = "cryoEVAL"
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def send_json(self, status, body):
+        payload = json.dumps(to_builtin(body), allow_nan=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok", "cache": self.server.evaluation.cache.stats()})
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/evaluate":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("The request must be a JSON object")
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+
+        try:
+            self.send_json(200, self.server.evaluation.evaluate(request))
+        except (ValueError, OSError) as e:
+            self.send_json(400, {"error": str(e)})
+        except Exception:
+            self.send_json(500, {"error": traceback.format_exc()})
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main(parsed_args):
+    if parsed_args.unix_socket is not None:
+        if os.path.exists(parsed_args.unix_socket):
+            os.remove(parsed_args.unix_socket)
+        server = ThreadingUnixHTTPServer(parsed_args.unix_socket, EvaluationRequestHandler)
+        address = parsed_args.unix_socket
+    else:
+        server = ThreadingHTTPServer((parsed_args.host, parsed_args.port), EvaluationRequestHandler)
+        address = f"http://{parsed_args.host}:{parsed_args.port}"
+    server.evaluation = EvaluationServer(
+        parsed_args.cache_size, parsed_args.max_concurrent, parsed_args.output_dir
+    )
+
+    # Clean up the socket on a plain kill too
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"cryoEVAL server listening on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if parsed_args.unix_socket is not None and os.path.exists(parsed_args.unix_socket):
+            os.remove(parsed_args.unix_socket)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser = add_args(parser)
+    parsed_args = parser.parse_args()
+    main(parsed_args)
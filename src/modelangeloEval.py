@@ -5,13 +5,107 @@ Compare a predicted model with a ground truth model. You need:
 2) A target mmCIF file, passed to --target-structure/--t/-t
 """
 import numpy as np
-import torch
 from Bio.SVDSuperimposer import SVDSuperimposer
 
 from utils.save_pdb_utils import chain_atom14_to_cif
 from utils.cas_utils import get_correspondence, get_lddt
-from utils.protein import Protein, get_protein_from_file_path, slice_protein
+from utils.protein import Protein, ProteinView, get_protein_from_file_path
 from utils.residue_constants import atom_order, atomc_backbone_mask
+from utils.trace_utils import TraceLog
+
+MATCH_TYPES = ["both", "protein", "nucleotide", "all"]
+
+
+def get_group_fit_metrics(
+    num_groups, pair_groups, input_groups, target_groups, input_correspondence,
+    target_correspondence, pair_mask, distance, lddt_score, sequence_correct,
+):
+    """
+    Fit metrics of groups of matched residue pairs, one array per metric in
+    the order of get_all_atom_fit_report. pair_groups is the group of every
+    pair, -1 leaves it out, and input_groups/target_groups the group of every
+    residue, the precision is NaN without input_groups
+    """
+    keep = pair_groups >= 0
+    pair_groups = pair_groups[keep]
+
+    def group_sum(values):
+        return np.bincount(pair_groups, weights=values[keep], minlength=num_groups)
+
+    def count_unmatched(residue_groups, correspondence):
+        if residue_groups is None:
+            return np.full(num_groups, np.nan)
+        matched = np.zeros(len(residue_groups), dtype=bool)
+        matched[correspondence[keep]] = True
+        return np.bincount(residue_groups[~matched], minlength=num_groups)
+
+    true_positive_count = np.bincount(pair_groups, minlength=num_groups)
+    false_positive_count = count_unmatched(input_groups, input_correspondence)
+    false_negative_count = count_unmatched(target_groups, target_correspondence)
+    backbone_mask = pair_mask * atomc_backbone_mask
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (
+            group_sum(np.sum(backbone_mask * distance, axis=-1))
+            / group_sum(np.sum(backbone_mask, axis=-1)),
+            group_sum(pair_mask[:, 1] * distance[:, 1]) / group_sum(pair_mask[:, 1]),
+            group_sum(lddt_score) / true_positive_count,
+            true_positive_count / (true_positive_count + false_negative_count),
+            true_positive_count / (true_positive_count + false_positive_count),
+            group_sum(sequence_correct) / true_positive_count,
+        )
+
+
+def get_partitioned_fit_report(
+    input_protein, target_protein, input_correspondence, target_correspondence,
+    pair_mask, distance, lddt_score,
+):
+    """
+    Fit reports of all the residues, of the protein and of the nucleotide
+    residues and of every target chain, all from the same correspondence and
+    superposition. A pair only counts for a residue type if both residues are
+    of that type. Chains have no precision, the predicted residues are not
+    assigned to target chains
+    """
+    input_prot = input_protein.prot_mask[input_correspondence]
+    target_prot = target_protein.prot_mask[target_correspondence]
+    sequence_correct = (
+        input_protein.aatype[input_correspondence]
+        == target_protein.aatype[target_correspondence]
+    ).astype(np.float64)
+    # Pair, input residue and target residue groups
+    groupings = {
+        "both": (
+            np.zeros(len(target_correspondence), dtype=np.int64),
+            np.zeros(len(input_protein.aatype), dtype=np.int64),
+            np.zeros(len(target_protein.aatype), dtype=np.int64),
+        ),
+        "types": (
+            np.where(input_prot & target_prot, 0, np.where(~input_prot & ~target_prot, 1, -1)),
+            (~input_protein.prot_mask).astype(np.int64),
+            (~target_protein.prot_mask).astype(np.int64),
+        ),
+        "chains": (
+            target_protein.chain_index[target_correspondence],
+            None,
+            target_protein.chain_index,
+        ),
+    }
+    group_names = {
+        "both": ["both"],
+        "types": ["protein", "nucleotide"],
+        "chains": [f"chain_{chain_id}" for chain_id in target_protein.chain_id],
+    }
+
+    reports = {}
+    for key, (pair_groups, input_groups, target_groups) in groupings.items():
+        metrics = get_group_fit_metrics(
+            len(group_names[key]), pair_groups, input_groups, target_groups,
+            input_correspondence, target_correspondence, pair_mask, distance,
+            lddt_score, sequence_correct,
+        )
+        for i, name in enumerate(group_names[key]):
+            reports[name] = tuple(float(values[i]) for values in metrics)
+    return reports
 
 
 def get_all_atom_fit_report(
@@ -23,14 +117,15 @@ def get_all_atom_fit_report(
     output_structure=None,
     match_type: str = "both",
 ):
+    # Views of the caller's proteins, only the fields read below are sliced
     if match_type == "protein":
-        input_protein = slice_protein(input_protein, input_protein.prot_mask)
-        target_protein = slice_protein(target_protein, target_protein.prot_mask)
+        input_protein = ProteinView(input_protein, input_protein.prot_mask)
+        target_protein = ProteinView(target_protein, target_protein.prot_mask)
     elif match_type == "nucleotide":
-        input_protein = slice_protein(input_protein, ~input_protein.prot_mask)
-        target_protein = slice_protein(target_protein, ~target_protein.prot_mask)
-    elif match_type != "both":
-        raise RuntimeError("Only support match types: protein, nucleotide, both")
+        input_protein = ProteinView(input_protein, ~input_protein.prot_mask)
+        target_protein = ProteinView(target_protein, ~target_protein.prot_mask)
+    elif match_type not in MATCH_TYPES:
+        raise RuntimeError(f"Only support match types: {', '.join(MATCH_TYPES)}")
 
     input_cas = np.zeros_like(input_protein.atom_positions[:, 0])
     target_cas = np.zeros_like(target_protein.atom_positions[:, 0])
@@ -53,7 +148,15 @@ def get_all_atom_fit_report(
     )
 
     if len(target_correspondence) == 0:
-        return 0, 0, 0, 0, 0
+        # The same report in every mode, NaN for what needs matched pairs
+        num_atomc = input_protein.atomc_mask.shape[-1]
+        fit_reports = get_partitioned_fit_report(
+            input_protein, target_protein,
+            np.asarray(input_correspondence, dtype=np.int64),
+            np.asarray(target_correspondence, dtype=np.int64),
+            np.zeros((0, num_atomc)), np.zeros((0, num_atomc)), np.zeros(0),
+        )
+        return fit_reports if match_type == "all" else fit_reports["both"]
 
     false_positive_count = len(
         set(range(len(input_cas))).difference(input_correspondence)
@@ -86,10 +189,8 @@ def get_all_atom_fit_report(
         (input_mask * target_mask)[..., 1]
     )
 
-    if len(input_cas_cor) > 80000:
-        lddt_score = 0
-    else:
-        lddt_score = get_lddt(torch.Tensor(input_cas_cor), torch.Tensor(target_cas_cor))
+    # Sparse over the neighbours within the cutoff, so large complexes fit in memory
+    lddt_score = get_lddt(input_cas_cor, target_cas_cor)
     sequence_match = np.sum(
         input_protein.aatype[input_correspondence]
         == target_protein.aatype[target_correspondence]
@@ -102,6 +203,35 @@ def get_all_atom_fit_report(
             == target_protein.aatype[target_correspondence]
         ).astype(np.float32)
         new_bfactors[input_correspondence] = 100 * correct_idxs
+        # Per residue channels of the _cryoeval_residue loop, "." where unmatched
+        num_residues = len(input_protein.aatype)
+        matched = np.zeros(num_residues, dtype=bool)
+        matched[input_correspondence] = True
+        residue_lddt = np.full(num_residues, np.nan)
+        residue_lddt[input_correspondence] = lddt_score
+        # CA, or P for nucleotides, after the superposition
+        ca_deviation = np.full(num_residues, np.nan)
+        ca_deviation[input_correspondence] = np.where(
+            (input_mask * target_mask)[:, 1] > 0.5, distance[:, 1], np.nan
+        )
+        sequence_correct = np.full(num_residues, "", dtype=object)
+        sequence_correct[input_correspondence] = correct_idxs.astype(np.int64).astype(str)
+        target_asym_id = np.full(num_residues, "", dtype=object)
+        target_asym_id[input_correspondence] = np.asarray(target_protein.chain_id)[
+            target_protein.chain_index[target_correspondence]
+        ]
+        target_seq_id = np.full(num_residues, "", dtype=object)
+        target_seq_id[input_correspondence] = target_protein.residue_index[
+            target_correspondence
+        ].astype(str)
+        residue_annotations = {
+            "matched": matched,
+            "lddt": residue_lddt,
+            "ca_deviation": ca_deviation,
+            "sequence_correct": sequence_correct,
+            "target_asym_id": target_asym_id,
+            "target_seq_id": target_seq_id,
+        }
         chain_atom14_to_cif(
             [input_protein.aatype[c] for c in input_protein.chain_idx_to_residues],
             [
@@ -111,8 +241,17 @@ def get_all_atom_fit_report(
             [input_protein.atomc_mask[c] for c in input_protein.chain_idx_to_residues],
             path_to_save=output_structure,
             bfactors=[new_bfactors[c] for c in input_protein.chain_idx_to_residues],
+            residue_annotations={
+                name: [values[c] for c in input_protein.chain_idx_to_residues]
+                for name, values in residue_annotations.items()
+            },
         )
 
+    if match_type == "all":
+        return get_partitioned_fit_report(
+            input_protein, target_protein, input_correspondence, target_correspondence,
+            input_mask * target_mask, distance, lddt_score,
+        )
     return (
         backbone_rms,
         ca_rms,
@@ -123,6 +262,54 @@ def get_all_atom_fit_report(
     )
 
 
+def format_fit_report(fit_report) -> str:
+    backbone_rms, ca_rms, lddt_score, recall, precision, sequence_match = fit_report
+    return (
+        f"**** Backbone RMSD:      {backbone_rms:.3f} Å\n"
+        f"**** Cα RMSD:            {ca_rms:.3f} Å\n"
+        f"**** Recall:             {recall:.3f}\n"
+        f"**** Precision:          {precision:.3f}\n"
+        f"**** lDDT score:         {lddt_score:.3f}\n"
+        f"**** Sequence match:     {sequence_match:.3f}\n"
+        f"**** Sequence coverage:  {sequence_match * recall:.3f}\n"
+    )
+
+
+def format_chain_fit_reports(fit_reports) -> str:
+    lines = [
+        f"{'Chain':>10s} {'Backbone':>9s} {'Cα':>9s} {'Recall':>7s} {'lDDT':>7s} {'Sequence':>9s}\n"
+    ]
+    for name, fit_report in fit_reports.items():
+        if not name.startswith("chain_"):
+            continue
+        backbone_rms, ca_rms, lddt_score, recall, _, sequence_match = fit_report
+        lines.append(
+            f"{name[len('chain_'):]:>10s} {backbone_rms:9.3f} {ca_rms:9.3f} "
+            f"{recall:7.3f} {lddt_score:7.3f} {sequence_match:9.3f}\n"
+        )
+    return "".join(lines)
+
+
+def get_f1score(precision, recall):
+    if precision + recall == 0:
+        return 0.0
+    return 2 * precision * recall / (precision + recall)
+
+
+def get_fit_output(fit_report, prefix: str) -> dict:
+    backbone_rms, ca_rms, lddt_score, recall, precision, sequence_match = fit_report
+    return {
+        f"{prefix}_backbone_rmsd": float(backbone_rms),
+        f"{prefix}_ca_rmsd": float(ca_rms),
+        f"{prefix}_recall": float(recall),
+        f"{prefix}_precision": float(precision),
+        f"{prefix}_f1score": float(get_f1score(precision, recall)),
+        f"{prefix}_lddt_score": float(lddt_score),
+        f"{prefix}_sequence_match": float(sequence_match),
+        f"{prefix}_sequence_coverage": float(sequence_match * recall),
+    }
+
+
 def add_args(parser):
     parser.add_argument(
         "--predicted-structure",
@@ -154,12 +341,16 @@ def add_args(parser):
         "--output-structure",
         help="If set, saves the sequence recall results to an mmCIF file, "
         "B-factors of 100 correspond to correct classifications and "
-        "B-factors of 0 correspond to wrong classifications",
+        "B-factors of 0 correspond to wrong classifications. "
+        "The per residue lDDT, CA deviation, match and matched target residue "
+        "are in the _cryoeval_residue loop. Gzipped if the path ends in .gz",
     )
     parser.add_argument(
         "--match-type",
         default="both",
-        choices=["both", "protein", "nucleotide"],
+        choices=MATCH_TYPES,
+        help="With all, the residues are matched once and the results are also "
+        "reported for the protein residues, the nucleotides and every target chain",
     )
     parser.add_argument(
         "--verbose",
@@ -169,18 +360,18 @@ def add_args(parser):
     return parser
 
 
-def main(parsed_args):
+def main(parsed_args, predicted_protein=None, target_protein=None, log=None):
+    # Run on its own, the stage traces to its own output file
+    own_log = log is None
+    if own_log:
+        log = TraceLog(parsed_args.output_file)
 
-    predicted_protein = get_protein_from_file_path(parsed_args.predicted_structure)
-    target_protein = get_protein_from_file_path(parsed_args.target_structure)
-    (
-        rmsd,
-        ca_rms,
-        lddt_score,
-        recall,
-        precision,
-        sequence_match,
-    ) = get_all_atom_fit_report(
+    # Structures already parsed by the caller are reused as they are
+    if predicted_protein is None:
+        predicted_protein = get_protein_from_file_path(parsed_args.predicted_structure)
+    if target_protein is None:
+        target_protein = get_protein_from_file_path(parsed_args.target_structure)
+    fit_report = get_all_atom_fit_report(
         predicted_protein,
         target_protein,
         max_dist=parsed_args.max_dist,
@@ -189,32 +380,36 @@ def main(parsed_args):
         output_structure=parsed_args.output_structure,
         match_type=parsed_args.match_type,
     )
+    # With --match-type all, one report per partition of the same correspondence
+    if parsed_args.match_type == "all":
+        fit_reports = fit_report
+    else:
+        fit_reports = {"both": fit_report}
+    results = format_fit_report(fit_reports["both"])
+    if parsed_args.match_type == "all":
+        results += (
+            "**** Protein residues\n"
+            + format_fit_report(fit_reports["protein"])
+            + "**** Nucleotide residues\n"
+            + format_fit_report(fit_reports["nucleotide"])
+            + "**** Target chains\n"
+            + format_chain_fit_reports(fit_reports)
+        )
 
-    if parsed_args.output_file is not None:
-        
-        with open(parsed_args.output_file, "a") as file:
-            
-            file.write("*" * 50 + "\n")
-            file.write("Credit from ModelAngelo evaluation functions\n")
-            file.write("*" * 50 + "\n")
-            
-            file.write(
-                f"Results for \nPrediction file: {parsed_args.predicted_structure}\n"
-                f"Target file: {parsed_args.target_structure}\n"
-                f"Maximum distance of {parsed_args.max_dist} Å are\n"
-            )
-            file.write("*" * 50 + "\n")
-
-            file.write(
-                f"**** Backbone RMSD:      {rmsd:.3f} Å\n"
-                f"**** Cα RMSD:            {ca_rms:.3f} Å\n"
-                f"**** Recall:             {recall:.3f}\n"
-                f"**** Precision:          {precision:.3f}\n"
-                f"**** lDDT score:         {lddt_score:.3f}\n"
-                f"**** Sequence match:     {sequence_match:.3f}\n"
-                f"**** Sequence coverage:  {sequence_match * recall:.3f}\n"
-            )
-            
+    log.write("*" * 50 + "\n")
+    log.write("Credit from ModelAngelo evaluation functions\n")
+    log.write("*" * 50 + "\n")
+
+    log.write(
+        f"Results for \nPrediction file: {parsed_args.predicted_structure}\n"
+        f"Target file: {parsed_args.target_structure}\n"
+        f"Maximum distance of {parsed_args.max_dist} Å are\n"
+    )
+    log.write("*" * 50 + "\n")
+
+    log.write(results)
+    if own_log:
+        log.close()
             
     if parsed_args.verbose:
         print("*" * 50)
@@ -226,27 +421,13 @@ def main(parsed_args):
             f"Maximum distance of {parsed_args.max_dist} Å are"
         )
         print("*" * 50)
-        print(
-            f"**** Backbone RMSD:      {rmsd:.3f} Å\n"
-            f"**** Cα RMSD:            {ca_rms:.3f} Å\n"
-            f"**** Recall:             {recall:.3f}\n"
-            f"**** Precision:          {precision:.3f}\n"
-            f"**** lDDT score:         {lddt_score:.3f}\n"
-            f"**** Sequence match:     {sequence_match:.3f}\n"
-            f"**** Sequence coverage:  {sequence_match * recall:.3f}"
-        )
+        print(results, end="")
         
         
-    output = {
-        "modelangelo_backbone_rmsd": "{:.3f}".format(rmsd),
-        "modelangelo_ca_rmsd": "{:.3f}".format(ca_rms),
-        "modelangelo_recall": "{:.3f}".format(recall),
-        "modelangelo_precision": "{:.3f}".format(precision),
-        "modelangelo_f1score": "{:.3f}".format(2 * precision * recall / (precision + recall)),
-        "modelangelo_lddt_score": "{:.3f}".format(lddt_score),
-        "modelangelo_sequence_match": "{:.3f}".format(sequence_match),
-        "modelangelo_sequence_coverage": "{:.3f}".format(sequence_match * recall),
-        }
+    output = get_fit_output(fit_reports["both"], "modelangelo")
+    if parsed_args.match_type == "all":
+        output.update(get_fit_output(fit_reports["protein"], "modelangelo_protein"))
+        output.update(get_fit_output(fit_reports["nucleotide"], "modelangelo_nucleotide"))
     
     return output    
              
@@ -1,6 +1,24 @@
 import subprocess
 import argparse
+import collections
+import copy
+import json
+import os
+import queue
 import re
+import threading
+
+from utils.profile_utils import profile_step
+from utils.subprocess_utils import (
+    get_limits,
+    kill_process_group,
+    popen_with_limits,
+    run_command,
+)
+from utils.trace_utils import TraceLog
+
+PHENIX_DRIVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "utils", "phenix_driver.py")
+
 
 def add_args(parser):
     parser.add_argument(
@@ -8,7 +26,6 @@ def add_args(parser):
         "--p",
         "-p",
         type=str,
-        required=True,
         help="Path to predicted structure",
     )
     parser.add_argument(
@@ -16,7 +33,6 @@ def add_args(parser):
         "--t",
         "-t",
         type=str,
-        required=True,
         help="Path to target structure",
     )
     parser.add_argument(
@@ -30,11 +46,208 @@ def add_args(parser):
         action="store_true",
         help="If set, prints the results to the console",
     )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="In seconds, wall-clock limit for each external tool call",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=float,
+        default=None,
+        help="In GB, address space limit for each external tool call",
+    )
+    parser.add_argument(
+        "--max-cpu-time",
+        type=float,
+        default=None,
+        help="In seconds, CPU time limit for each external tool call",
+    )
+    parser.add_argument(
+        "--phenix-engine",
+        default="phenix",
+        choices=["phenix", "native"],
+        help="Compute the chain comparison metrics with phenix.chain_comparison "
+        "or in-process with NumPy, which needs no PHENIX install",
+    )
+    parser.add_argument(
+        "--batch-file",
+        help="If set, a file with one 'predicted target' pair of paths per line, "
+        "all compared by a single pooled PHENIX process",
+    )
+    parser.add_argument(
+        "--phenix-python",
+        default="phenix.python",
+        help="The phenix.python executable used by the pooled PHENIX process",
+    )
     
     return parser
 
 
-def main(parsed_args):
+class PhenixChainComparisonPool:
+    """
+    Keeps one phenix.python process alive and streams target/prediction pairs
+    through utils/phenix_driver.py, so PHENIX boots once per batch instead of
+    once per pair. The timeout and the limits apply to each pair, the driver
+    runs every pair in a forked child with the limits set. A pair going over
+    them is reported as failed, a timed out or crashed worker is restarted on
+    the next pair.
+    """
+
+    def __init__(self, phenix_python="phenix.python", timeout=None, max_memory=None, max_cpu_time=None):
+        self.command = [phenix_python, PHENIX_DRIVER]
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.max_cpu_time = max_cpu_time
+        self.process = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.process = popen_with_limits(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        # Pipes are drained by threads so a reply can be waited for with a timeout
+        self.replies = queue.Queue()
+        self.stderr_tail = collections.deque(maxlen=200)
+        threading.Thread(target=self._read_replies, args=(self.process.stdout, self.replies), daemon=True).start()
+        threading.Thread(target=self.stderr_tail.extend, args=(self.process.stderr,), daemon=True).start()
+
+    @staticmethod
+    def _read_replies(stream, replies):
+        for line in stream:
+            replies.put(line)
+        replies.put(None)
+
+    @profile_step("chain_comparison_pool")
+    def compare(self, target_structure, predicted_structure):
+        """
+        Returns the chain_comparison log, same as the stdout of phenix.chain_comparison
+        """
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self.start()
+            job = {
+                "target": os.path.abspath(target_structure),
+                "predicted": os.path.abspath(predicted_structure),
+                "max_memory": self.max_memory,
+                "max_cpu_time": self.max_cpu_time,
+            }
+            self.process.stdin.write(json.dumps(job) + "\n")
+            self.process.stdin.flush()
+
+            try:
+                reply = self.replies.get(timeout=self.timeout)
+            except queue.Empty:
+                self.close(graceful=False)
+                raise subprocess.TimeoutExpired(self.command, self.timeout)
+            if reply is None:
+                returncode = self.process.wait()
+                self.process = None
+                raise subprocess.CalledProcessError(
+                    returncode, self.command, stderr="".join(self.stderr_tail)
+                )
+
+            result = json.loads(reply)
+            if "error" in result:
+                raise subprocess.CalledProcessError(1, self.command, stderr=result["error"])
+            return result["output"]
+
+    def close(self, graceful=True):
+        if self.process is None:
+            return
+        if graceful:
+            # The driver exits on end of input
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        kill_process_group(self.process)
+        self.process.wait()
+        self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def parse_chain_comparison_output(output_log):
+    ## Parse output ##
+    pattern = r"_target\s+(\d+\.\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+\.\d+)\s+(\d+\.\d+)\s+(\d+\.\d+)\s+(\d+\.\d+)\s+(\d+\.\d+)\s+(\d+)\s+(\d+)"
+
+    match = re.search(pattern, output_log)
+    
+    if match:
+        rmsd = float(match.group(1))
+        close_n = int(match.group(2))
+        far_n = int(match.group(3))
+        forward = int(match.group(4))
+        reverse = int(match.group(5))
+        mixed = int(match.group(6))
+        found = float(match.group(7))
+        ca_score = float(match.group(8))
+        seq_match = float(match.group(9))
+        seq_score = float(match.group(10))
+        mean_length = float(match.group(11))
+        fragments = int(match.group(12))
+        bad_connections = int(match.group(13))
+
+        # print(f"RMSD: {rmsd}, CLOSE N: {close_n}, FAR N: {far_n}, FORWARD: {forward}, REVERSE: {reverse}, MIXED: {mixed}, CA Match: {ca_match}, CA SCORE: {ca_score}, SEQ MATCH: {seq_match}, SEQ SCORE: {seq_score}, MEAN LENGTH: {mean_length}, FRAGMENTS: {fragments}, BAD CONNECTIONS: {bad_connections}")
+    else:
+        raise ValueError("MatchScore output not found")
+    
+    
+    output = {
+        "phenix_found": found,
+        "phenix_ca_score": ca_score,
+        "phenix_seq_match": seq_match,
+        "phenix_seq_score": seq_score,
+        "phenix_mean_length":mean_length,
+        "phenix_fragments": fragments,
+        "phenix_bad_connections": bad_connections, 
+    }
+
+    return output
+
+
+def run_native(parsed_args, predicted_protein=None, target_protein=None):
+    from utils.chain_comparison_utils import chain_comparison
+    from utils.protein import get_protein_from_file_path
+
+    if predicted_protein is None:
+        predicted_protein = get_protein_from_file_path(parsed_args.predicted_structure)
+    if target_protein is None:
+        target_protein = get_protein_from_file_path(parsed_args.target_structure)
+    result = chain_comparison(target_protein, predicted_protein)
+
+    # Same layout and rounding as the phenix.chain_comparison summary, so the log
+    # reads the same and parses to the same values
+    columns = [
+        ("rmsd", "RMSD", "{:.2f}"), ("close_n", "CLOSE_N", "{}"), ("far_n", "FAR_N", "{}"),
+        ("forward", "FORWARD", "{}"), ("reverse", "REVERSE", "{}"), ("mixed", "MIXED", "{}"),
+        ("found", "FOUND", "{:.1f}"), ("ca_score", "CA_SCORE", "{:.2f}"),
+        ("seq_match", "SEQ_MATCH", "{:.1f}"), ("seq_score", "SEQ_SCORE", "{:.2f}"),
+        ("mean_length", "MEAN_LENGTH", "{:.1f}"), ("fragments", "FRAGMENTS", "{}"),
+        ("bad_connections", "BAD_CONNECTIONS", "{}"),
+    ]
+    output_log = "               " + " ".join(name for _, name, _ in columns) + "\n"
+    output_log += "SUMMARY_target " + " ".join(
+        fmt.format(result[key]) for key, _, fmt in columns
+    ) + "\n"
+    return output_log
+
+
+def main(parsed_args, pool=None, predicted_protein=None, target_protein=None, log=None):
+    # Run on its own, the stage traces to its own output file
+    own_log = log is None
+    if own_log:
+        log = TraceLog(parsed_args.output_file)
     MatchScore = 'phenix.chain_comparison'
     
     command = [
@@ -45,69 +258,95 @@ def main(parsed_args):
         ]
     
     
+    engine = getattr(parsed_args, "phenix_engine", "phenix")
+    credit = f"Credit from PHENIX: {MatchScore} function"
     try:
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
-        output_log = result.stdout
+        if engine == "native":
+            credit = "In-process chain comparison (NumPy), following phenix.chain_comparison"
+            output_log = run_native(parsed_args, predicted_protein, target_protein)
+        elif pool is not None:
+            output_log = pool.compare(parsed_args.target_structure, parsed_args.predicted_structure)
+        else:
+            result = run_command(command, **get_limits(parsed_args))
+            output_log = result.stdout
         
-        if parsed_args.output_file is not None:
-            with open(parsed_args.output_file, 'a') as f:
-                f.write("*" * 52 + "\n")
-                f.write("Credit from PHENIX: phenix.chain_comparison function\n")
-                f.write("*" * 52 + "\n")
-                f.write(output_log)
+        if log.full:
+            log.write("*" * 52 + "\n")
+            log.write(credit + "\n")
+            log.write("*" * 52 + "\n")
+            log.write(output_log)
 
 
         if parsed_args.verbose:
             print("*" * 52)
-            print("Credit from PHENIX: phenix.chain_comparison function")
+            print(credit)
             print("*" * 52)
             print(output_log)
         
-        ## Parse output ##
-        pattern = r"_target\s+(\d+\.\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+\.\d+)\s+(\d+\.\d+)\s+(\d+\.\d+)\s+(\d+\.\d+)\s+(\d+\.\d+)\s+(\d+)\s+(\d+)"
-
-        match = re.search(pattern, output_log)
-        
-        if match:
-            rmsd = float(match.group(1))
-            close_n = int(match.group(2))
-            far_n = int(match.group(3))
-            forward = int(match.group(4))
-            reverse = int(match.group(5))
-            mixed = int(match.group(6))
-            found = float(match.group(7))
-            ca_score = float(match.group(8))
-            seq_match = float(match.group(9))
-            seq_score = float(match.group(10))
-            mean_length = float(match.group(11))
-            fragments = int(match.group(12))
-            bad_connections = int(match.group(13))
-
-            # print(f"RMSD: {rmsd}, CLOSE N: {close_n}, FAR N: {far_n}, FORWARD: {forward}, REVERSE: {reverse}, MIXED: {mixed}, CA Match: {ca_match}, CA SCORE: {ca_score}, SEQ MATCH: {seq_match}, SEQ SCORE: {seq_score}, MEAN LENGTH: {mean_length}, FRAGMENTS: {fragments}, BAD CONNECTIONS: {bad_connections}")
-        else:
-            raise ValueError("MatchScore output not found")
-        
-        
-        output = {
-            "phenix_found": found,
-            "phenix_ca_score": ca_score,
-            "phenix_seq_match": seq_match,
-            "phenix_seq_score": seq_score,
-            "phenix_mean_length":mean_length,
-            "phenix_fragments": fragments,
-            "phenix_bad_connections": bad_connections, 
-        }
-
+        output = parse_chain_comparison_output(output_log)
+        # Both engines report the same keys, so the record says which one ran
+        output["phenix_engine"] = engine
         return output
     
+    except subprocess.TimeoutExpired as e:
+        # Record the timed out job instead of stalling the run
+        print("Timeout: phenix.chain_comparison did not finish in", e.timeout, "seconds")
+        log.write(f"\nTIMEOUT: phenix.chain_comparison killed after {e.timeout} seconds\n")
+        return {"phenix_status": "timeout"}
+
     except subprocess.CalledProcessError as e:
-        # Handle errors if the command fails
+        # A negative return code is a signal, e.g. from --max-cpu-time
+        status = "killed" if e.returncode < 0 else "error"
         print("Error:", e.stderr)
+        log.write(f"\n{status.upper()}: phenix.chain_comparison exited with code {e.returncode}\n")
+        return {"phenix_status": status}
+
+    finally:
+        if own_log:
+            log.close()
     
     
 
+def read_batch_file(batch_file):
+    pairs = []
+    with open(batch_file) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                predicted_structure, target_structure = line.split()[:2]
+                pairs.append((predicted_structure, target_structure))
+    return pairs
+
+
+def run_batch(pairs, parsed_args):
+    """
+    Runs chain_comparison on many (predicted, target) pairs through one pooled
+    PHENIX process, returns the output of main for every pair
+    """
+    outputs = []
+    with PhenixChainComparisonPool(
+        phenix_python=getattr(parsed_args, "phenix_python", "phenix.python"),
+        **get_limits(parsed_args),
+    ) as pool, TraceLog(parsed_args.output_file) as log:
+        for predicted_structure, target_structure in pairs:
+            pair_args = copy.copy(parsed_args)
+            pair_args.predicted_structure = predicted_structure
+            pair_args.target_structure = target_structure
+            outputs.append(main(pair_args, pool=pool, log=log))
+    return outputs
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser = add_args(parser)
     parsed_args = parser.parse_args()
-    main(parsed_args)
+    if parsed_args.batch_file is not None:
+        pairs = read_batch_file(parsed_args.batch_file)
+        for (predicted_structure, target_structure), output in zip(pairs, run_batch(pairs, parsed_args)):
+            print(f"# Prediction file: {predicted_structure} #")
+            for key, value in (output or {}).items():
+                print(f"{key}: {value}")
+    elif parsed_args.predicted_structure is None or parsed_args.target_structure is None:
+        parser.error("--predicted-structure and --target-structure are required without --batch-file")
+    else:
+        main(parsed_args)
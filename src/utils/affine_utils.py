@@ -3,22 +3,33 @@
 ######################################################
 
 
+# The affine functions take NumPy arrays or torch tensors and compute with the
+# library of their inputs, see is_numpy. The NumPy implementations are the
+# *_np functions, torch is only imported by the functions that need it
 import numpy as np
-import torch
-import torch.nn.functional as F
 
-from utils.torch_utils import is_ndarray, shared_cat
+
+def is_numpy(*arrays) -> bool:
+    """
+    Whether the inputs are NumPy arrays, otherwise they are torch tensors
+    """
+    return all(isinstance(x, np.ndarray) for x in arrays)
 
 
 def get_affine(rot_matrix, shift):
-    is_torch = torch.is_tensor(rot_matrix) and torch.is_tensor(shift)
-    is_numpy = is_ndarray(rot_matrix) and is_ndarray(shift)
+    is_numpy = isinstance(rot_matrix, np.ndarray) and isinstance(shift, np.ndarray)
+    is_torch = False
+    if not is_numpy:
+        import torch
+
+        is_torch = torch.is_tensor(rot_matrix) and torch.is_tensor(shift)
 
     if is_torch or is_numpy:
+        cat = torch.cat if is_torch else np.concatenate
         if len(rot_matrix.shape) == len(shift.shape):
-            return shared_cat((rot_matrix, shift), dim=-1, is_torch=is_torch)
+            return cat((rot_matrix, shift), -1)
         elif len(rot_matrix.shape) == len(shift.shape) + 1:
-            return shared_cat((rot_matrix, shift[..., None]), dim=-1, is_torch=is_torch)
+            return cat((rot_matrix, shift[..., None]), -1)
         else:
             raise ValueError(
                 f"get_affine does not support rotation matrix of shape {rot_matrix.shape}"
@@ -32,12 +43,16 @@ def get_affine(rot_matrix, shift):
 
 
 def random_affine_from_translation(translation):
+    import torch
+
     bcd = torch.rand(*translation.shape[:-1], 3, device=translation.device) * 2 - 1
     bcdt = torch.cat((bcd, translation), dim=-1)
     return bcdt_to_affine(bcdt)
 
 
 def init_affine_from_translation(translation):
+    import torch
+
     affine = torch.zeros(*translation.shape[:-1], 3, 4, device=translation.device)
     affine[..., 0, 0] = 1.0
     affine[..., 1, 1] = 1.0
@@ -47,12 +62,16 @@ def init_affine_from_translation(translation):
 
 
 def init_random_affine_from_translation(translation):
+    import torch
+
     v, w = torch.rand_like(translation), torch.rand_like(translation)
     rot = rots_from_two_vecs(v, w)
     return get_affine(rot, translation)
 
 
 def affine_mul_rots(affine, rots):
+    if is_numpy(affine, rots):
+        return affine_mul_rots_np(affine, rots)
     num_unsqueeze_dims = len(rots.shape) - len(affine.shape)
     if num_unsqueeze_dims > 0:
         new_shape = affine.shape[:-2] + num_unsqueeze_dims * (1,) + (3, 4)
@@ -62,6 +81,10 @@ def affine_mul_rots(affine, rots):
 
 
 def affine_mul_vecs(affine, vecs):
+    if is_numpy(affine, vecs):
+        return affine_mul_vecs_np(affine, vecs)
+    import torch
+
     num_unsqueeze_dims = len(vecs.shape) - len(affine.shape) + 1
     if num_unsqueeze_dims > 0:
         new_shape = affine.shape[:-2] + num_unsqueeze_dims * (1,) + (3, 4)
@@ -72,6 +95,10 @@ def affine_mul_vecs(affine, vecs):
 
 
 def affine_rot_vecs(affine, vecs):
+    if is_numpy(affine, vecs):
+        return affine_rot_vecs_np(affine, vecs)
+    import torch
+
     num_unsqueeze_dims = len(vecs.shape) - len(affine.shape) + 1
     if num_unsqueeze_dims > 0:
         new_shape = affine.shape[:-2] + num_unsqueeze_dims * (1,) + (3, 4)
@@ -96,16 +123,22 @@ def affine_composition(a1, a2):
     """
     Does the operation a1 o a2
     """
+    if is_numpy(a1, a2):
+        return affine_composition_np(a1, a2)
     rotation = get_affine_rot(a1) @ get_affine_rot(a2)
     translation = affine_mul_vecs(a1, get_affine_translation(a2))
     return get_affine(rotation, translation)
 
 
 def rots_from_two_vecs(e1_unnormalized, e2_unnormalized):
-    e1 = F.normalize(e1_unnormalized, p=2, dim=-1)
+    if is_numpy(e1_unnormalized, e2_unnormalized):
+        return rots_from_two_vecs_np(e1_unnormalized, e2_unnormalized)
+    import torch
+
+    e1 = torch.nn.functional.normalize(e1_unnormalized, p=2, dim=-1)
     c = torch.einsum("...i,...i->...", e2_unnormalized, e1)[..., None]  # dot product
     e2 = e2_unnormalized - c * e1
-    e2 = F.normalize(e2, p=2, dim=-1)
+    e2 = torch.nn.functional.normalize(e2, p=2, dim=-1)
     e3 = torch.cross(e1, e2, dim=-1)
     return torch.stack((e1, e2, e3), dim=-1)
 
@@ -119,19 +152,77 @@ def affine_from_3_points(point_on_neg_x_axis, origin, point_on_xy_plane):
 
 
 def invert_affine(affine):
+    if is_numpy(affine):
+        return invert_affine_np(affine)
+    import torch
+
     inv_rots = get_affine_rot(affine).transpose(-1, -2)
     t = torch.einsum("...ij,...j->...i", inv_rots, affine[..., :, -1])
     inv_shift = -t
     return get_affine(inv_rots, inv_shift)
 
 
+def normalize_np(x, eps=1e-12):
+    # Same as F.normalize(x, p=2, dim=-1)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), eps)
+
+
+def rots_from_two_vecs_np(e1_unnormalized, e2_unnormalized):
+    e1 = normalize_np(e1_unnormalized)
+    c = np.einsum("...i,...i->...", e2_unnormalized, e1)[..., None]  # dot product
+    e2 = normalize_np(e2_unnormalized - c * e1)
+    e3 = np.cross(e1, e2)
+    return np.stack((e1, e2, e3), axis=-1)
+
+
+def affine_mul_rots_np(affine, rots):
+    num_unsqueeze_dims = len(rots.shape) - len(affine.shape)
+    if num_unsqueeze_dims > 0:
+        affine = affine.reshape(affine.shape[:-2] + num_unsqueeze_dims * (1,) + (3, 4))
+    rotation = get_affine_rot(affine) @ rots.astype(affine.dtype)
+    translation = np.broadcast_to(get_affine_translation(affine), rotation.shape[:-1])
+    return get_affine(rotation, translation)
+
+
+def affine_mul_vecs_np(affine, vecs):
+    num_unsqueeze_dims = len(vecs.shape) - len(affine.shape) + 1
+    if num_unsqueeze_dims > 0:
+        affine = affine.reshape(affine.shape[:-2] + num_unsqueeze_dims * (1,) + (3, 4))
+    return np.einsum(
+        "...ij, ...j-> ...i", get_affine_rot(affine), vecs
+    ) + get_affine_translation(affine)
+
+
+def affine_rot_vecs_np(affine, vecs):
+    num_unsqueeze_dims = len(vecs.shape) - len(affine.shape) + 1
+    if num_unsqueeze_dims > 0:
+        affine = affine.reshape(affine.shape[:-2] + num_unsqueeze_dims * (1,) + (3, 4))
+    return np.einsum("...ij, ...j-> ...i", get_affine_rot(affine), vecs)
+
+
+def affine_composition_np(a1, a2):
+    rotation = get_affine_rot(a1) @ get_affine_rot(a2)
+    translation = affine_mul_vecs_np(a1, get_affine_translation(a2))
+    return get_affine(rotation, translation)
+
+
+def invert_affine_np(affine):
+    inv_rots = np.swapaxes(get_affine_rot(affine), -1, -2)
+    inv_shift = -np.einsum("...ij,...j->...i", inv_rots, get_affine_translation(affine))
+    return get_affine(inv_rots, inv_shift)
+
+
 def affine_to_tensor_flat9(affine):
+    import torch
+
     return torch.stack(
         [affine[..., :, 0], affine[..., :, 1], affine[..., :, -1]], dim=-1
     )
 
 
 def affine_to_tensor_flat12(affine):
+    import torch
+
     return torch.cat(
         [
             affine[..., 0, :3],
@@ -144,6 +235,8 @@ def affine_to_tensor_flat12(affine):
 
 
 def fill_rotation_matrix(xx, xy, xz, yx, yy, yz, zx, zy, zz):
+    import torch
+
     R = torch.zeros(*xx.shape, 3, 3).to(xx.device)
     R[..., 0, 0] = xx
     R[..., 0, 1] = xy
@@ -176,10 +269,12 @@ def fill_rotation_matrix_np(xx, xy, xz, yx, yy, yz, zx, zy, zz):
 
 
 def bcdt_to_affine(bcdt):
+    import torch
+
     # bcdt is the output of the network, the shape is (..., 6) where
     b, c, d, t = bcdt[..., 0], bcdt[..., 1], bcdt[..., 2], bcdt[..., 3:]
     a = torch.ones_like(b)
-    abcd = F.normalize(torch.stack([a, b, c, d], dim=-1), p=2, dim=-1)
+    abcd = torch.nn.functional.normalize(torch.stack([a, b, c, d], dim=-1), p=2, dim=-1)
     rotation = torch.zeros(*t.shape, 3).to(t.device)
     abcd2 = abcd ** 2
     ab, bc = 2 * abcd[..., 0] * abcd[..., 1], 2 * abcd[..., 1] * abcd[..., 2]
@@ -202,6 +297,8 @@ def bcdt_to_affine(bcdt):
 
 
 def affine_to_k3(affine):
+    import torch
+
     R = get_affine_rot(affine)
     k3 = torch.zeros(*R.shape[:-2], 4, 4).to(R.device)
 
@@ -243,6 +340,8 @@ def affine_to_k3(affine):
 
 
 def affine_to_bcdt(affines):
+    import torch
+
     k3 = affine_to_k3(affines)
     _, Q = torch.linalg.eigh(k3)
     bcd = Q[..., :3, -1]
@@ -7,11 +7,11 @@ from collections import namedtuple
 from random import shuffle
 
 import numpy as np
-import torch
 import tqdm
 from Bio.SVDSuperimposer import SVDSuperimposer
 from scipy.spatial import cKDTree
 
+from utils.profile_utils import profile_step
 
 
 
@@ -39,7 +39,7 @@ def get_fit_report(input_cas, target_cas, max_dist=5, verbose=False, two_rounds=
     sup.run()
 
     rms = sup.get_rms()
-    lddt_score = get_lddt(torch.Tensor(input_cas_cor), torch.Tensor(target_cas_cor))
+    lddt_score = get_lddt(input_cas_cor, target_cas_cor)
     return (
         rms,
         lddt_score,
@@ -48,12 +48,16 @@ def get_fit_report(input_cas, target_cas, max_dist=5, verbose=False, two_rounds=
     )
 
 
+@profile_step("matrix_based_correspondence")
 def matrix_based_correspondence(input_cas, target_cas, max_dist, verbose):
     # Distance matrix: input_num x target_num
     distance_matrix = np.linalg.norm(input_cas[:, None] - target_cas[None], axis=-1)
 
     target_correspondence = []
     input_correspondence = []
+    if distance_matrix.size == 0:
+        # Everything on one side is matched already
+        return target_correspondence, input_correspondence
 
     # if verbose:
     #     pbar = tqdm.tqdm(total=len(input_cas))
@@ -86,6 +90,8 @@ def get_tmscore(c1, c2):
     Returns residue TM-scores for two sets of coordinate c1 and c2 in shape (n_atoms, 3)
     Directly from https://github.com/psipred/DMPfold2/blob/master/dmpfold/train.py
     """
+    import torch
+
     r1 = c1.transpose(0, 1)
     r2 = c2.transpose(0, 1)
     P = r1 - r1.mean(1).view(3, 1)
@@ -112,6 +118,7 @@ def get_tmscore(c1, c2):
     return tmscores
 
 
+@profile_step("kdtree_correspondence")
 def kdtree_correspondence(input_cas, target_cas, max_dist=3, repeat=3):
     k = cKDTree(input_cas)
     idxs = list(range(len(target_cas)))
@@ -142,6 +149,7 @@ def kdtree_correspondence(input_cas, target_cas, max_dist=3, repeat=3):
     return final_corrs
 
 
+@profile_step("get_correspondence")
 def get_correspondence(
     input_cas,
     target_cas,
@@ -155,7 +163,8 @@ def get_correspondence(
     final_corrs = kdtree_correspondence(
         input_cas, target_cas, max_dist=3, repeat=repeat
     )
-    if two_rounds:
+    # Nothing to superimpose on if the first round matched nothing
+    if two_rounds and len(final_corrs) > 0:
         target_correspondence, input_correspondence = (
             list(final_corrs.keys()),
             list(final_corrs.values()),
@@ -179,8 +188,8 @@ def get_correspondence(
     target_idxs = set(list(range(len(target_cas))))
     matched_input_idxs = set(list(final_corrs.values()))
     matched_target_idxs = set(list(final_corrs.keys()))
-    unmatched_input_idxs = np.array(list(input_idxs.difference(matched_input_idxs)))
-    unmatched_target_idxs = np.array(list(target_idxs.difference(matched_target_idxs)))
+    unmatched_input_idxs = np.array(list(input_idxs.difference(matched_input_idxs)), dtype=np.int64)
+    unmatched_target_idxs = np.array(list(target_idxs.difference(matched_target_idxs)), dtype=np.int64)
 
     if len(unmatched_input_idxs) < len(matched_input_idxs):
         unmatched_input_cas = input_cas[unmatched_input_idxs]
@@ -202,8 +211,8 @@ def get_correspondence(
 
     matched_input_idxs = set(list(final_corrs.values()))
     matched_target_idxs = set(list(final_corrs.keys()))
-    unmatched_input_idxs = np.array(list(input_idxs.difference(matched_input_idxs)))
-    unmatched_target_idxs = np.array(list(target_idxs.difference(matched_target_idxs)))
+    unmatched_input_idxs = np.array(list(input_idxs.difference(matched_input_idxs)), dtype=np.int64)
+    unmatched_target_idxs = np.array(list(target_idxs.difference(matched_target_idxs)), dtype=np.int64)
 
     target_correspondence, input_correspondence = (
         np.array(list(final_corrs.keys())),
@@ -226,6 +235,8 @@ ResidueCoordinateSystem = namedtuple(
 
 
 def get_residue_coordinate_systems(ca_positions, c_positions, n_positions):
+    import torch
+
     ca_c_vec = c_positions - ca_positions  # B x 3
     ca_n_vec = n_positions - ca_positions  # B x 3
     orth_basis = torch.linalg.qr(
@@ -245,28 +256,47 @@ def get_residue_coordinate_systems(ca_positions, c_positions, n_positions):
     )
 
 
-def get_lddt(input, target, cutoff=15.0):
+@profile_step("get_lddt")
+def get_lddt(input, target, cutoff=15.0, chunk_size=4096):
     """
     The approximate lDDT score, based on AlphaFold2's code
+    Only the pairs closer than the cutoff in the target are scored. They are
+    found with a KD-tree, a chunk of residues at a time, so the memory grows
+    with the number of neighbours instead of the square of the number of
+    residues. Returns the per-residue scores as a NumPy array.
     """
-    input_dmat = torch.norm(input[..., None, :] - input, dim=-1, p=2)
-    target_dmat = torch.norm(target[..., None, :] - target, dim=-1, p=2)
-    dists_mask = (target_dmat < cutoff).float() * (1 - torch.eye(target_dmat.shape[-2]))
-
-    dists_l1 = (target_dmat - input_dmat).abs()
-    score = 0.25 * (
-        (dists_l1 < 0.5).float()
-        + (dists_l1 < 1.0).float()
-        + (dists_l1 < 2.0).float()
-        + (dists_l1 < 4.0).float()
-    )
-    norm = 1 / (1e-10 + torch.sum(dists_mask, dim=-1))
-    score = norm * (1e-10 + torch.sum(dists_mask * score, dim=-1))
-    return score
+    input = np.asarray(input.detach().cpu() if hasattr(input, "detach") else input, dtype=np.float64)
+    target = np.asarray(target.detach().cpu() if hasattr(target, "detach") else target, dtype=np.float64)
+    num_residues = len(target)
+    target_tree = cKDTree(target)
+
+    num_pairs = np.zeros(num_residues)
+    score_sum = np.zeros(num_residues)
+    for start in range(0, num_residues, chunk_size):
+        pairs = cKDTree(target[start : start + chunk_size]).sparse_distance_matrix(
+            target_tree, cutoff, output_type="ndarray"
+        )
+        i, j, target_dists = pairs["i"] + start, pairs["j"], pairs["v"]
+        keep = (i != j) & (target_dists < cutoff)
+        i, j, target_dists = i[keep], j[keep], target_dists[keep]
+
+        input_dists = np.linalg.norm(input[i] - input[j], axis=-1)
+        dists_l1 = np.abs(target_dists - input_dists)
+        score = 0.25 * (
+            (dists_l1 < 0.5).astype(np.float64)
+            + (dists_l1 < 1.0)
+            + (dists_l1 < 2.0)
+            + (dists_l1 < 4.0)
+        )
+        num_pairs += np.bincount(i, minlength=num_residues)
+        score_sum += np.bincount(i, weights=score, minlength=num_residues)
+
+    norm = 1 / (1e-10 + num_pairs)
+    return norm * (1e-10 + score_sum)
 
 
 def rot_matrix_to_residue_coordinate_system(
-    rot_matrix: torch.Tensor,
+    rot_matrix: "torch.Tensor",
 ) -> ResidueCoordinateSystem:
     inv_basis_matrix = rot_matrix.transpose(-2, -1)
     return ResidueCoordinateSystem(
@@ -275,29 +305,33 @@ def rot_matrix_to_residue_coordinate_system(
 
 
 def transform_tensor_to_coordinate_system(
-    tensor: torch.Tensor, residue_coordinate_system: ResidueCoordinateSystem
-) -> torch.Tensor:
+    tensor: "torch.Tensor", residue_coordinate_system: ResidueCoordinateSystem
+) -> "torch.Tensor":
     """
     The tensor is assumed to come from the usual Euclidean coordinate system
     """
+    import torch
+
     return torch.einsum(
         "b...ac, b...c -> b...a", residue_coordinate_system.inv_basis_matrix, tensor
     )
 
 
 def transform_tensor_from_coordinate_system(
-    tensor: torch.Tensor, residue_coordinate_system: ResidueCoordinateSystem
-) -> torch.Tensor:
+    tensor: "torch.Tensor", residue_coordinate_system: ResidueCoordinateSystem
+) -> "torch.Tensor":
     """
     The tensor is assumed to go to the usual Euclidean coordinate system
     """
+    import torch
+
     return torch.einsum(
         "b...ac, b...c -> b...a", residue_coordinate_system.basis_matrix, tensor
     )
 
 
 def rotate_coordinate_system(
-    rotation_matrix: torch.Tensor, residue_coordinate_system: ResidueCoordinateSystem
+    rotation_matrix: "torch.Tensor", residue_coordinate_system: ResidueCoordinateSystem
 ) -> ResidueCoordinateSystem:
     X = residue_coordinate_system.basis_matrix
     X_inv = residue_coordinate_system.inv_basis_matrix
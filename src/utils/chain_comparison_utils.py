@@ -0,0 +1,200 @@
+"""
+In-process equivalent of phenix.chain_comparison
+Reproduces the matching of mmtbx.validation.chain_comparison.run on already
+parsed `Protein` objects, so the chain comparison metrics are available without
+a PHENIX install. It compares the whole target, i.e. it is the counterpart of
+phenix.chain_comparison with test_unique_part_of_target_only=False.
+
+Definitions follow the chain_comparison summary line:
+  - each predicted CA (P for chain_type RNA/DNA), in file order, is matched to
+    the closest target atom that is not matched yet; it is close if that atom
+    is within max_dist, else it counts in far_n
+  - rmsd: over the close pairs
+  - forward / reverse / mixed: close residues continuing a run of target
+    residues that goes up, goes down, or neither
+  - found: percentage of target residues that are matched
+  - seq_match: percentage of the close pairs with the same residue type
+  - ca_score = found / 100 / max(0.1, rmsd), seq_score = found * seq_match / 10000
+  - mean_length: close_n over the number of forward and reverse runs
+  - fragments: pieces of the predicted model, split at gaps > 2 * distance_per_site
+  - bad_connections: consecutive runs that jump back or change direction
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+from utils.protein import Protein
+from utils.profile_utils import profile_step
+from utils.residue_constants import atom_order
+
+# Maximum distance spanned by a pair of residues, as in chain_comparison
+PROTEIN_DISTANCE_PER_SITE = 3.8
+NUCLEOTIDE_DISTANCE_PER_SITE = 8.0
+# Avoid blowing up the scores of near perfect models
+MIN_RMSD = 0.1
+
+
+def get_backbone_atoms(protein: Protein, chain_type: str = "PROTEIN"):
+    """
+    CA positions of the protein residues, or P positions of the nucleotides for
+    chain_type RNA/DNA, together with the indices of the residues that have them
+    """
+    if chain_type == "PROTEIN":
+        atom_idx, residue_mask = atom_order["CA"], protein.prot_mask
+    else:
+        atom_idx, residue_mask = atom_order["P"], ~protein.prot_mask
+    residue_idxs = np.nonzero(residue_mask & (protein.atom_mask[:, atom_idx] > 0.5))[0]
+    return protein.atom_positions[residue_idxs, atom_idx], residue_idxs
+
+
+def get_close_pairs(target_positions, predicted_positions, max_dist):
+    """
+    Greedy one-to-one matching of chain_comparison: the closest target atom, or
+    the second closest when that one is taken, else the residue is far away
+    """
+    k = min(2, len(target_positions))
+    distances, closest = cKDTree(target_positions).query(predicted_positions, k=k)
+    distances = distances.reshape(len(predicted_positions), k)
+    closest = closest.reshape(len(predicted_positions), k)
+
+    used = np.zeros(len(target_positions), dtype=bool)
+    pairs = []
+    for i in range(len(predicted_positions)):
+        for distance, j in zip(distances[i], closest[i]):
+            if not used[j]:
+                break
+        else:
+            continue
+        if distance > max_dist:
+            continue
+        used[j] = True
+        pairs.append((i, int(j), float(distance)))
+    return pairs
+
+
+def classify_pairs(pairs):
+    """
+    Splits the close pairs into forward, reverse and mixed (unaligned) ones
+    """
+    forward, reverse, mixed = [], [], []
+    last = None
+    for (i, j, _), next_pair in zip(pairs, pairs[1:] + [None]):
+        found = None
+        if last is None:
+            # A run starts only if the next pair continues it
+            if next_pair is not None and next_pair[0] == i + 1:
+                found = {j + 1: forward, j - 1: reverse}.get(next_pair[1])
+        elif i == last[0] + 1:
+            found = {last[1] + 1: forward, last[1] - 1: reverse}.get(j)
+        if found is None:
+            mixed.append((i, j))
+            last = None
+        else:
+            found.append((i, j))
+            last = (i, j)
+    return forward, reverse, mixed
+
+
+def get_run_count(matches):
+    """
+    Number of runs of consecutive predicted residues
+    """
+    return sum(1 for k, (i, _) in enumerate(matches) if k == 0 or i != matches[k - 1][0] + 1)
+
+
+def get_bad_connections(pairs):
+    """
+    Runs of the target that follow each other in the wrong direction or order,
+    ignoring single residue runs
+    """
+    runs = []
+    for _, j, _ in pairs:
+        if runs and runs[-1]["forward"] in (True, None) and runs[-1]["end"] + 1 == j:
+            runs[-1].update(end=j, forward=True)
+        elif runs and runs[-1]["forward"] in (False, None) and runs[-1]["end"] - 1 == j:
+            runs[-1].update(end=j, forward=False)
+        else:
+            runs.append({"end": j, "forward": None})
+    runs = [run for run in runs if run["forward"] is not None]
+
+    bad_connections = 0
+    for run, next_run in zip(runs[:-1], runs[1:]):
+        if (
+            run["forward"] != next_run["forward"]
+            or (run["forward"] and next_run["end"] <= run["end"])
+            or (not run["forward"] and next_run["end"] > run["end"])
+        ):
+            bad_connections += 1
+    return bad_connections
+
+
+@profile_step("chain_comparison")
+def chain_comparison(
+    target_protein: Protein,
+    predicted_protein: Protein,
+    max_dist: float = 3.0,
+    chain_type: str = "PROTEIN",
+) -> dict:
+    target_positions, target_idxs = get_backbone_atoms(target_protein, chain_type)
+    predicted_positions, predicted_idxs = get_backbone_atoms(predicted_protein, chain_type)
+    target_n, predicted_n = len(target_idxs), len(predicted_idxs)
+
+    output = {
+        "rmsd": 0.0,
+        "close_n": 0,
+        "far_n": 0,
+        "forward": 0,
+        "reverse": 0,
+        "mixed": 0,
+        "found": 0.0,
+        "ca_score": 0.0,
+        "seq_match": 0.0,
+        "seq_score": 0.0,
+        "mean_length": 0.0,
+        "fragments": 0,
+        "bad_connections": 0,
+    }
+    if target_n == 0 or predicted_n == 0:
+        return output
+
+    distance_per_site = (
+        PROTEIN_DISTANCE_PER_SITE if chain_type == "PROTEIN" else NUCLEOTIDE_DISTANCE_PER_SITE
+    )
+    gaps = np.linalg.norm(predicted_positions[1:] - predicted_positions[:-1], axis=-1)
+    pairs = get_close_pairs(target_positions, predicted_positions, max_dist)
+    forward, reverse, mixed = classify_pairs(pairs)
+    close_n = len(pairs)
+
+    output.update(
+        {
+            "close_n": close_n,
+            "far_n": predicted_n - close_n,
+            "forward": len(forward),
+            "reverse": len(reverse),
+            "mixed": len(mixed),
+            "fragments": int(np.sum(gaps > 2 * distance_per_site)) + 1,
+            "bad_connections": get_bad_connections(pairs),
+        }
+    )
+    if close_n == 0:
+        return output
+
+    i, j, distance = (np.array(values) for values in zip(*pairs))
+    rmsd = float(np.sqrt(np.mean(np.square(distance))))
+    found = 100.0 * close_n / target_n
+    seq_match = 100.0 * float(
+        np.mean(
+            target_protein.aatype[target_idxs[j]]
+            == predicted_protein.aatype[predicted_idxs[i]]
+        )
+    )
+    output.update(
+        {
+            "rmsd": rmsd,
+            "found": found,
+            "ca_score": found / 100 / max(MIN_RMSD, rmsd),
+            "seq_match": seq_match,
+            "seq_score": seq_match * found / 10000,
+            "mean_length": close_n / max(1, get_run_count(forward) + get_run_count(reverse)),
+        }
+    )
+    return output
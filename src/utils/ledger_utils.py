@@ -0,0 +1,127 @@
+"""
+Job ledger for batch evaluations
+A small SQLite database recording every (prediction, target, options) job of a
+batch, keyed by the content hashes of the inputs and of the option set, so an
+interrupted batch can be resumed: finished jobs are skipped and failed ones are
+retried up to a limit.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_options(options: dict) -> str:
+    return hashlib.sha256(json.dumps(options, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_job_key(predicted_hash: str, target_hash: str, options_hash: str) -> str:
+    return hashlib.sha256(f"{predicted_hash}:{target_hash}:{options_hash}".encode()).hexdigest()
+
+
+class JobLedger:
+    """
+    A job is "running" from start() until finish() or fail(), so jobs that are
+    still running when a batch is resumed were interrupted and count as failed
+    attempts
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Committed on every update, so the ledger survives the process dying
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_key TEXT PRIMARY KEY,
+                predicted_structure TEXT,
+                target_structure TEXT,
+                predicted_hash TEXT,
+                target_hash TEXT,
+                options_hash TEXT,
+                status TEXT,
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                durations TEXT,
+                output_file TEXT,
+                updated_at REAL
+            )
+            """
+        )
+
+    def get(self, job_key: str):
+        row = self.connection.execute(
+            "SELECT * FROM jobs WHERE job_key = ?", (job_key,)
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    def should_run(self, job_key: str, max_attempts: int) -> bool:
+        job = self.get(job_key)
+        if job is None:
+            return True
+        return job["status"] != "done" and job["attempts"] < max_attempts
+
+    def start(
+        self, job_key, predicted_structure, target_structure,
+        predicted_hash, target_hash, options_hash, output_file,
+    ):
+        self.connection.execute(
+            """
+            INSERT INTO jobs (job_key, predicted_structure, target_structure,
+                predicted_hash, target_hash, options_hash, status, attempts,
+                output_file, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, 'running', 1, ?, ?)
+            ON CONFLICT(job_key) DO UPDATE SET
+                predicted_structure = excluded.predicted_structure,
+                target_structure = excluded.target_structure,
+                status = 'running',
+                attempts = attempts + 1,
+                error = NULL,
+                output_file = excluded.output_file,
+                updated_at = excluded.updated_at
+            """,
+            (
+                job_key, predicted_structure, target_structure, predicted_hash,
+                target_hash, options_hash, output_file, time.time(),
+            ),
+        )
+
+    def finish(self, job_key: str, durations: dict):
+        self.connection.execute(
+            "UPDATE jobs SET status = 'done', durations = ?, updated_at = ? WHERE job_key = ?",
+            (json.dumps(durations), time.time(), job_key),
+        )
+
+    def fail(self, job_key: str, error: str, durations: dict = None):
+        self.connection.execute(
+            "UPDATE jobs SET status = 'failed', error = ?, durations = ?, updated_at = ? WHERE job_key = ?",
+            (error, json.dumps(durations or {}), time.time(), job_key),
+        )
+
+    def summary(self) -> dict:
+        return {
+            row["status"]: row["count"]
+            for row in self.connection.execute(
+                "SELECT status, COUNT(*) AS count FROM jobs GROUP BY status"
+            )
+        }
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,86 @@
+"""
+Long-running chain_comparison worker, run with phenix.python
+Reads one JSON job per line from stdin, {"target": path, "predicted": path,
+"max_memory": GB, "max_cpu_time": seconds}, and answers each with one JSON line
+on stdout, {"output": log} on success or {"error": message} on failure.
+PHENIX/cctbx is imported only once per process, every job runs in a forked
+child with the job's limits, so they apply to that pair alone.
+"""
+import contextlib
+import inspect
+import io
+import json
+import os
+import resource
+import sys
+import traceback
+
+
+def run_chain_comparison(run, target, predicted):
+    buffer = io.StringIO()
+    kwargs = {}
+    parameters = inspect.signature(run).parameters
+    # The log stream argument is named differently across PHENIX versions
+    for name in ("out", "log"):
+        if name in parameters:
+            kwargs[name] = buffer
+            break
+    with contextlib.redirect_stdout(buffer):
+        run([target, predicted], **kwargs)
+    return buffer.getvalue()
+
+
+def set_limits(max_memory=None, max_cpu_time=None):
+    if max_memory is not None:
+        # In GB
+        max_bytes = int(max_memory * (1 << 30))
+        resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+    if max_cpu_time is not None:
+        # In seconds, SIGXCPU and then SIGKILL one second later
+        seconds = int(max_cpu_time)
+        resource.setrlimit(resource.RLIMIT_CPU, (seconds, seconds + 1))
+
+
+def run_job(run, job):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            set_limits(job.get("max_memory"), job.get("max_cpu_time"))
+            result = {"output": run_chain_comparison(run, job["target"], job["predicted"])}
+        except BaseException:
+            result = {"error": traceback.format_exc()}
+        with os.fdopen(write_fd, "w") as f:
+            f.write(json.dumps(result))
+        # Skip the cleanup of the worker's state the child shares
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        reply = f.read()
+    _, status = os.waitpid(pid, 0)
+    if reply:
+        return json.loads(reply)
+    if os.WIFSIGNALED(status):
+        return {"error": "chain_comparison was killed by signal %d" % os.WTERMSIG(status)}
+    return {"error": "chain_comparison exited with status %d" % os.WEXITSTATUS(status)}
+
+
+def main():
+    from mmtbx.validation.chain_comparison import run
+
+    # Keep the protocol stream clean of anything PHENIX prints on its own
+    protocol = sys.stdout
+    sys.stdout = sys.stderr
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        result = run_job(run, json.loads(line))
+        protocol.write(json.dumps(result) + "\n")
+        protocol.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Per-step instrumentation of an evaluation
+The profiler of the running evaluation is kept in a context variable, so the
+utilities mark their sub-steps with `profile_step` without the profiler being
+passed down to them, and the mark costs next to nothing when no evaluation is
+being profiled. Every step records its wall time, the CPU time of the calling
+thread and how much the peak RSS of the process grew while it ran, and steps
+running external tools the CPU time of those, aggregated per step path
+(e.g. "modelangelo.get_correspondence.kdtree_correspondence") for the result
+record and kept per call for a Chrome trace timeline.
+"""
+import contextlib
+import contextvars
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+_profiler = contextvars.ContextVar("profiler", default=None)
+_step_path = contextvars.ContextVar("step_path", default=())
+
+
+def get_peak_rss_mb() -> float:
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak_rss / (1 << 20) if sys.platform == "darwin" else peak_rss / (1 << 10)
+
+
+def get_children_cpu_seconds() -> float:
+    # Only counts the child processes that ended and were waited for
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Profiler:
+    """
+    Stages running in worker threads are only profiled if the thread runs in a
+    copy of the caller's context, see contextvars.copy_context(). The peak RSS
+    growth is how much the high-water mark of the whole process rose during the
+    step: 0 for a step staying under an earlier peak, and with concurrent
+    stages it is shared between them. Likewise the child CPU time counts every
+    child process of the process that ended during the step.
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.totals = {}
+        self.events = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def activate(self):
+        # Steps of a profiler activated inside a step of another start at the root
+        token = _profiler.set(self)
+        path_token = _step_path.set(())
+        try:
+            yield self
+        finally:
+            _step_path.reset(path_token)
+            _profiler.reset(token)
+
+    @contextlib.contextmanager
+    def step(self, name: str, child_cpu: bool = False):
+        path = _step_path.get() + (name,)
+        token = _step_path.set(path)
+        start_peak_rss = get_peak_rss_mb()
+        start_children_cpu = get_children_cpu_seconds() if child_cpu else None
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.thread_time() - start_cpu
+            children_cpu = get_children_cpu_seconds() - start_children_cpu if child_cpu else None
+            _step_path.reset(token)
+            self.add(path, start_wall, wall, cpu, get_peak_rss_mb() - start_peak_rss, children_cpu)
+
+    def add(self, path, start, wall, cpu, peak_rss_growth_mb, children_cpu=None):
+        key = ".".join(path)
+        with self.lock:
+            total = self.totals.setdefault(
+                key, {"seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_growth_mb": 0.0, "calls": 0}
+            )
+            total["seconds"] += wall
+            total["cpu_seconds"] += cpu
+            total["peak_rss_growth_mb"] = max(total["peak_rss_growth_mb"], peak_rss_growth_mb)
+            total["calls"] += 1
+            args = {"path": key, "cpu_seconds": cpu, "peak_rss_growth_mb": peak_rss_growth_mb}
+            if children_cpu is not None:
+                total["child_cpu_seconds"] = total.get("child_cpu_seconds", 0.0) + children_cpu
+                args["child_cpu_seconds"] = children_cpu
+            self.events.append({
+                "name": path[-1],
+                "cat": path[0],
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": wall * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_native_id(),
+                "args": args,
+            })
+
+    def get_record_fields(self) -> dict:
+        """
+        Flat fields for the result record, e.g. modelangelo.get_lddt_seconds
+        """
+        fields = {}
+        with self.lock:
+            for key, total in self.totals.items():
+                fields[f"{key}_seconds"] = total["seconds"]
+                fields[f"{key}_cpu_seconds"] = total["cpu_seconds"]
+                fields[f"{key}_peak_rss_growth_mb"] = total["peak_rss_growth_mb"]
+                if "child_cpu_seconds" in total:
+                    fields[f"{key}_child_cpu_seconds"] = total["child_cpu_seconds"]
+                if total["calls"] > 1:
+                    fields[f"{key}_calls"] = total["calls"]
+        return fields
+
+    def write_trace(self, path: str):
+        """
+        Chrome trace event format, opens in chrome://tracing or ui.perfetto.dev
+        """
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event["ts"])
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+@contextlib.contextmanager
+def profile_step(name: str, child_cpu: bool = False):
+    """
+    Context manager, or decorator, marking a step of the profiled evaluation,
+    with child_cpu also recording the CPU time of the child processes it waited for
+    """
+    profiler = _profiler.get()
+    if profiler is None:
+        yield
+        return
+    with profiler.step(name, child_cpu):
+        yield
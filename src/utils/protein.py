@@ -4,12 +4,12 @@
 
 
 import dataclasses
+import functools
 import pickle
 import warnings
 from typing import Dict, List
 
 import numpy as np
-import torch
 from Bio.PDB import MMCIFParser, PDBParser
 
 import utils.residue_constants as _rc
@@ -21,7 +21,9 @@ from utils.affine_utils import (
     affine_mul_vecs,
     fill_rotation_matrix,
     invert_affine,
+    is_numpy,
 )
+from utils.profile_utils import profile_step
 
 # Complete sequence of chain IDs supported by the PDB format.
 PDB_CHAIN_IDS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
@@ -52,6 +54,14 @@ PROTEIN_KEYS = [
     "chain_idx_to_residues",
     "prot_mask",
 ]
+# Fields of a Protein that are not indexed by residue
+PROTEIN_NON_RESIDUE_KEYS = [
+    "chain_id",
+    "unified_seq",
+    "unified_seq_len",
+    "residue_to_lm_embedding",
+    "chain_idx_to_residues",
+]
 
 
 @dataclasses.dataclass(frozen=False)
@@ -145,6 +155,7 @@ class Protein:
     keys = PROTEIN_KEYS
 
 
+@profile_step("get_protein_from_file_path")
 def get_protein_from_file_path(file_path: str, chain_id: str = None) -> Protein:
     """Takes a file path containing a PDB/mmCIF file and constructs a Protein object.
     WARNING: All non-standard residue types will be ignored. All
@@ -156,6 +167,45 @@ def get_protein_from_file_path(file_path: str, chain_id: str = None) -> Protein:
     Returns:
       A new `Protein` parsed from the pdb contents.
     """
+    protein_fields = parse_protein_fields(file_path, chain_id)
+    frames = atomf_to_frames(
+        aatype=protein_fields["aatype"],
+        all_atom_positions=protein_fields["atom_positions"],
+        all_atom_mask=protein_fields["atom_mask"],
+    )
+    torsion_angles = atomf_to_torsion_angles(
+        aatype=protein_fields["aatype"][None],
+        all_atom_positions=protein_fields["atom_positions"][None],
+        all_atom_mask=protein_fields["atom_mask"][None],
+    )
+    return Protein(**protein_fields, **frames, **torsion_angles)
+
+
+@profile_step("get_proteins_from_file_paths")
+def get_proteins_from_file_paths(file_paths: List[str], chain_id: str = None) -> List[Protein]:
+    """
+    get_protein_from_file_path for many structures, with the frames and
+    torsion angles of all of them computed in one vectorized call
+    """
+    proteins_fields = [parse_protein_fields(file_path, chain_id) for file_path in file_paths]
+    frames_and_torsion_angles = batch_atomf_to_frames_and_torsion_angles(
+        [protein_fields["aatype"] for protein_fields in proteins_fields],
+        [protein_fields["atom_positions"] for protein_fields in proteins_fields],
+        [protein_fields["atom_mask"] for protein_fields in proteins_fields],
+    )
+    return [
+        Protein(**protein_fields, **protein_frames_and_torsion_angles)
+        for protein_fields, protein_frames_and_torsion_angles in zip(
+            proteins_fields, frames_and_torsion_angles
+        )
+    ]
+
+
+def parse_protein_fields(file_path: str, chain_id: str = None) -> dict:
+    """
+    The Protein fields of a PDB/mmCIF file but the frames and torsion angles,
+    see get_protein_from_file_path
+    """
     if file_path.split(".")[-1][-3:] == "pdb":
         parser = PDBParser(QUIET=True)
     elif file_path.split(".")[-1][-3:] == "cif":
@@ -267,16 +317,8 @@ def get_protein_from_file_path(file_path: str, chain_id: str = None) -> Protein:
     aatype = np.array(aatype)
     residue_index = np.array(residue_index)
     b_factors = np.array(b_factors)
-    frames = atomf_to_frames(
-        aatype=aatype, all_atom_positions=atom_positions, all_atom_mask=atom_mask
-    )
-    torsion_angles = atomf_to_torsion_angles(
-        aatype=aatype[None],
-        all_atom_positions=atom_positions[None],
-        all_atom_mask=atom_mask[None],
-    )
 
-    return Protein(
+    return dict(
         atom_positions=atom_positions,
         atomc_positions=atomc_positions,
         atom_mask=atom_mask,
@@ -292,8 +334,6 @@ def get_protein_from_file_path(file_path: str, chain_id: str = None) -> Protein:
         residue_to_lm_embedding=None,
         chain_idx_to_residues=chain_idx_to_residues,
         prot_mask=aatype < _rc.num_prot,
-        **frames,
-        **torsion_angles,
     )
 
 
@@ -304,35 +344,11 @@ def get_protein_empty_except(**kwargs) -> Protein:
     return Protein(**protein_dict)
 
 
-def atomf_to_frames(
-    aatype: np.ndarray,  # (...)
-    all_atom_positions: np.ndarray,  # (..., 37, 3)
-    all_atom_mask: np.ndarray,  # (..., 37)
-) -> Dict[str, np.ndarray]:
-    """Computes the frames for the up to 9 rigid groups for each residue.
-    The rigid groups are defined by the possible torsions in a given amino acid.
-    We group the atoms according to their dependence on the torsion angles into
-    "rigid groups".  E.g., the position of atoms in the chi2-group depend on
-    chi1 and chi2, but do not depend on chi3 or chi4.
-    Jumper et al. (2021) Suppl. Table 2 and corresponding text.
-    Args:
-      aatype: Amino acid type, given as array with integers.
-      all_atom_positions: atomf representation of all atom coordinates.
-      all_atom_mask: atomf representation of mask on all atom coordinates.
-    Returns:
-      Dictionary containing:
-        * 'rigidgroups_gt_frames': 9 Frames corresponding to 'all_atom_positions'
-             represented as flat 12 dimensional array.
-        * 'rigidgroups_gt_exists': Mask denoting whether the atom positions for
-            the given frame are available in the ground truth, e.g. if they were
-            resolved in the experiment.
-        * 'rigidgroups_group_exists': Mask denoting whether given group is in
-            principle present for given amino acid type.
-        * 'rigidgroups_group_is_ambiguous': Mask denoting whether frame is
-            affected by naming ambiguity.
-        * 'rigidgroups_alt_gt_frames': 9 Frames with alternative atom renaming
-            corresponding to 'all_atom_positions' represented as flat
-            12 dimensional array.
+@functools.lru_cache(maxsize=None)
+def get_restype_rigidgroup_tables() -> Dict[str, np.ndarray]:
+    """
+    Per restype tables of atomf_to_frames, built once. The arrays are shared
+    between calls and read-only
     """
     # Proteins:
     # 0: 'backbone group',
@@ -340,15 +356,6 @@ def atomf_to_frames(
     # 2: 'phi-group', (currently empty, because it defines only hydrogens)
     # 3: 'psi-group',
     # 4,5,6,7: 'chi1,2,3,4-group'
-    aatype_in_shape = aatype.shape
-
-    # If there is a batch axis, just flatten it away, and reshape everything
-    # back at the end of the function.
-    aatype = np.reshape(aatype, [-1])
-    all_atom_positions = np.reshape(all_atom_positions, [-1, _rc.num_atoms, 3])
-    all_atom_mask = np.reshape(all_atom_mask, [-1, _rc.num_atoms])
-    N = len(aatype)
-
     # Create an array with the atom names.
     # shape (num_restypes, num_rigidgroups, 3_atoms): (28, 9, 3)
     restype_rigidgroup_base_atom_names = np.full(
@@ -410,75 +417,117 @@ def atomf_to_frames(
         restype_rigidgroup_base_atom_names
     )
 
-    # Compute the gather indices for all residues in the chain.
-    # shape (N, 9, 3)
-    residx_rigidgroup_base_atomf_idx = restype_rigidgroup_base_atomf_idx[aatype]
+    # The frames for ambiguous rigid groups are rotated by 180 degree around
+    # the x-axis. The ambiguous group is always the last chi-group.
+    restype_rigidgroup_is_ambiguous = np.zeros(
+        [_rc.full_num_residues, _rc.num_frames], dtype=np.float32
+    )
+
+    for resname, _ in _rc.residue_atom_renaming_swaps.items():
+        restype = _rc.restype_order[_rc.restype_3to1[resname]]
+        chi_idx = int(sum(_rc.chi_angles_mask[restype]) - 1)
+        restype_rigidgroup_is_ambiguous[restype, chi_idx + 4] = 1
+
+    tables = {
+        "base_atomf_idx": restype_rigidgroup_base_atomf_idx,
+        "group_mask": restype_rigidgroup_mask,
+        "is_ambiguous": restype_rigidgroup_is_ambiguous,
+    }
+    for table in tables.values():
+        table.flags.writeable = False
+    return tables
+
+
+def atomf_to_frames(
+    aatype: np.ndarray,  # (...)
+    all_atom_positions: np.ndarray,  # (..., 37, 3)
+    all_atom_mask: np.ndarray,  # (..., 37)
+) -> Dict[str, np.ndarray]:
+    """Computes the frames for the up to 9 rigid groups for each residue.
+    The rigid groups are defined by the possible torsions in a given amino acid.
+    We group the atoms according to their dependence on the torsion angles into
+    "rigid groups".  E.g., the position of atoms in the chi2-group depend on
+    chi1 and chi2, but do not depend on chi3 or chi4.
+    Jumper et al. (2021) Suppl. Table 2 and corresponding text.
+    Args:
+      aatype: Amino acid type, given as array with integers.
+      all_atom_positions: atomf representation of all atom coordinates.
+      all_atom_mask: atomf representation of mask on all atom coordinates.
+    Returns:
+      Dictionary containing:
+        * 'rigidgroups_gt_frames': 9 Frames corresponding to 'all_atom_positions'
+             represented as flat 12 dimensional array.
+        * 'rigidgroups_gt_exists': Mask denoting whether the atom positions for
+            the given frame are available in the ground truth, e.g. if they were
+            resolved in the experiment.
+        * 'rigidgroups_group_exists': Mask denoting whether given group is in
+            principle present for given amino acid type.
+        * 'rigidgroups_group_is_ambiguous': Mask denoting whether frame is
+            affected by naming ambiguity.
+        * 'rigidgroups_alt_gt_frames': 9 Frames with alternative atom renaming
+            corresponding to 'all_atom_positions' represented as flat
+            12 dimensional array.
+    """
+    aatype_in_shape = aatype.shape
+
+    # If there is a batch axis, just flatten it away, and reshape everything
+    # back at the end of the function.
+    aatype = np.reshape(aatype, [-1])
+    all_atom_positions = np.reshape(all_atom_positions, [-1, _rc.num_atoms, 3])
+    all_atom_mask = np.reshape(all_atom_mask, [-1, _rc.num_atoms])
+    N = len(aatype)
+    tables = get_restype_rigidgroup_tables()
 
     # Gather the base atom positions for each rigid group.
     # Resulting shape: N, 9, 3, 3
     base_atom_pos_idx = (
-        residx_rigidgroup_base_atomf_idx
+        tables["base_atomf_idx"][aatype]
         + np.arange(N * _rc.num_atoms, step=_rc.num_atoms)[..., None, None]
     )
+    # The frames are float32, as the coordinates read by Biopython are
     base_atom_pos = np.take(
         all_atom_positions.reshape(-1, 3), base_atom_pos_idx, axis=0
-    )
+    ).astype(np.float32, copy=False)
 
     # Compute the Affines.
     gt_frames = affine_from_3_points(
-        point_on_neg_x_axis=torch.Tensor(base_atom_pos[:, :, 0, :]),
-        origin=torch.Tensor(base_atom_pos[:, :, 1, :]),
-        point_on_xy_plane=torch.Tensor(base_atom_pos[:, :, 2, :]),
+        point_on_neg_x_axis=base_atom_pos[:, :, 0, :],
+        origin=base_atom_pos[:, :, 1, :],
+        point_on_xy_plane=base_atom_pos[:, :, 2, :],
     )
 
     # Compute a mask whether the group exists.
     # (N, 9)
-    group_exists = restype_rigidgroup_mask[aatype]
+    group_exists = tables["group_mask"][aatype]
 
     # Compute a mask whether ground truth exists for the group
     # shape (N, 9, 3)
-    gt_atoms_exist = np.take(all_atom_mask.astype(np.float32), base_atom_pos_idx,)
+    gt_atoms_exist = np.take(all_atom_mask, base_atom_pos_idx)
 
-    gt_exists = np.min(gt_atoms_exist, axis=-1) * group_exists  # (N, 9)
+    gt_exists = np.min(gt_atoms_exist, axis=-1).astype(np.float32) * group_exists  # (N, 9)
 
     # Adapt backbone frame to old convention (mirror x-axis and z-axis).
-    rots = np.tile(np.eye(3, dtype=np.float32), [_rc.num_frames, 1, 1])
-    rots[0, 0, 0] = -1
-    rots[0, 2, 2] = -1
-    gt_frames = affine_mul_rots(gt_frames, rots)
+    # Right-multiplying by the diagonal rotation flips the sign of its columns
+    gt_frames[:, 0, :, 0] *= -1
+    gt_frames[:, 0, :, 2] *= -1
 
     # The frames for ambiguous rigid groups are just rotated by 180 degree around
     # the x-axis. The ambiguous group is always the last chi-group.
-    restype_rigidgroup_is_ambiguous = np.zeros(
-        [_rc.full_num_residues, _rc.num_frames], dtype=np.float32
-    )
-    restype_rigidgroup_rots = np.tile(
-        np.eye(3, dtype=np.float32), [_rc.full_num_residues, _rc.num_frames, 1, 1]
-    )
-
-    for resname, _ in _rc.residue_atom_renaming_swaps.items():
-        restype = _rc.restype_order[_rc.restype_3to1[resname]]
-        chi_idx = int(sum(_rc.chi_angles_mask[restype]) - 1)
-        restype_rigidgroup_is_ambiguous[restype, chi_idx + 4] = 1
-        restype_rigidgroup_rots[restype, chi_idx + 4, 1, 1] = -1
-        restype_rigidgroup_rots[restype, chi_idx + 4, 2, 2] = -1
-
-    # Gather the ambiguity information for each residue.
-    residx_rigidgroup_is_ambiguous = restype_rigidgroup_is_ambiguous[aatype]
-    residx_rigidgroup_ambiguity_rot = restype_rigidgroup_rots[aatype]
+    residx_rigidgroup_is_ambiguous = tables["is_ambiguous"][aatype]
 
     # Create the alternative ground truth frames.
-    alt_gt_frames = affine_mul_rots(gt_frames, residx_rigidgroup_ambiguity_rot)
+    alt_gt_frames = gt_frames.copy()
+    alt_gt_frames[residx_rigidgroup_is_ambiguous > 0, :, 1:3] *= -1
 
     # reshape back to original residue layout
-    gt_frames = np.reshape(gt_frames.numpy(), aatype_in_shape + (_rc.num_frames, 3, 4))
+    gt_frames = np.reshape(gt_frames, aatype_in_shape + (_rc.num_frames, 3, 4))
     gt_exists = np.reshape(gt_exists, aatype_in_shape + (_rc.num_frames,))
     group_exists = np.reshape(group_exists, aatype_in_shape + (_rc.num_frames,))
     residx_rigidgroup_is_ambiguous = np.reshape(
         residx_rigidgroup_is_ambiguous, aatype_in_shape + (_rc.num_frames,)
     )
     alt_gt_frames = np.reshape(
-        alt_gt_frames.numpy(), aatype_in_shape + (_rc.num_frames, 3, 4,),
+        alt_gt_frames, aatype_in_shape + (_rc.num_frames, 3, 4,),
     )
 
     return {
@@ -636,17 +685,17 @@ def atomf_to_torsion_angles(
     # Third atom: origin
     # Affine matrices (B, N, torsions=8, 3, 4)
     torsion_frames = affine_from_3_points(
-        point_on_neg_x_axis=torch.Tensor(torsions_atom_pos[:, :, :, 1, :]),
-        origin=torch.Tensor(torsions_atom_pos[:, :, :, 2, :]),
-        point_on_xy_plane=torch.Tensor(torsions_atom_pos[:, :, :, 0, :]),
+        point_on_neg_x_axis=torsions_atom_pos[:, :, :, 1, :],
+        origin=torsions_atom_pos[:, :, :, 2, :],
+        point_on_xy_plane=torsions_atom_pos[:, :, :, 0, :],
     )
 
     # Compute the position of the fourth atom in this frame (y and z coordinate
     # define the chi angle)
     # (B, N, torsions=7, 3)
     fourth_atom_rel_pos = affine_mul_vecs(
-        invert_affine(torsion_frames), torch.Tensor(torsions_atom_pos[:, :, :, 3, :])
-    ).numpy()
+        invert_affine(torsion_frames), torsions_atom_pos[:, :, :, 3, :]
+    )
 
     # Normalize to have the sin and cos of the torsion angle.
     # np.ndarray (B, N, torsions=8, sincos=2)
@@ -710,10 +759,56 @@ def atomf_to_torsion_angles(
     }
 
 
+def batch_atomf_to_frames_and_torsion_angles(
+    aatypes: List[np.ndarray],  # [(N_i)]
+    all_atom_positions: List[np.ndarray],  # [(N_i, 65, 3)]
+    all_atom_masks: List[np.ndarray],  # [(N_i, 65)]
+) -> List[Dict[str, np.ndarray]]:
+    """
+    atomf_to_frames and atomf_to_torsion_angles of many structures of any
+    length in one call. The structures are packed into one row, separated by
+    an empty residue so that the first residue of each one sees no previous
+    residue, as when computed alone, and the results are split back per structure.
+    """
+    lengths = [len(aatype) for aatype in aatypes]
+    separator_aatype = np.zeros(1, dtype=np.int64)
+    separator_positions = np.zeros((1, _rc.num_atoms, 3))
+    separator_mask = np.zeros((1, _rc.num_atoms))
+
+    def pack(arrays, separator, shape):
+        packed = []
+        for array in arrays:
+            packed.extend([separator, np.reshape(array, shape)])
+        return np.concatenate(packed) if packed else separator[:0]
+
+    aatype = pack(aatypes, separator_aatype, (-1,)).astype(np.int64)
+    atom_positions = pack(all_atom_positions, separator_positions, (-1, _rc.num_atoms, 3))
+    atom_mask = pack(all_atom_masks, separator_mask, (-1, _rc.num_atoms))
+
+    packed = atomf_to_frames(
+        aatype=aatype, all_atom_positions=atom_positions, all_atom_mask=atom_mask
+    )
+    torsion_angles = atomf_to_torsion_angles(
+        aatype=aatype[None],
+        all_atom_positions=atom_positions[None],
+        all_atom_mask=atom_mask[None],
+    )
+    # A single row comes back without its batch axis
+    packed.update(torsion_angles)
+
+    results = []
+    start = 0
+    for length in lengths:
+        start += 1
+        results.append({key: value[start : start + length] for key, value in packed.items()})
+        start += length
+    return results
+
+
 def torsion_angles_to_frames(
     aatype: np.ndarray,  # (N)
-    backb_to_global: torch.Tensor,  # (N, 3, 4)
-    torsion_angles_sin_cos: torch.Tensor,  # (N, 8, 2)
+    backb_to_global: "torch.Tensor",  # (N, 3, 4)
+    torsion_angles_sin_cos: "torch.Tensor",  # (N, 8, 2)
 ):  # (N, 9)
     """Compute rigid group frames from torsion angles.
     Jumper et al. (2021) Suppl. Alg. 24 "computeAllAtomCoordinates" lines 2-10
@@ -726,6 +821,8 @@ def torsion_angles_to_frames(
     Returns:
       Frames corresponding to all the Sidechain Rigid Transforms
     """
+    import torch
+
     assert len(aatype.shape) == 1
     assert len(torsion_angles_sin_cos.shape) == 3
     assert torsion_angles_sin_cos.shape[1] == 8
@@ -824,51 +921,58 @@ def torsion_angles_to_frames(
 
 
 def frames_and_literature_positions_to_atomc_pos(
-    aatype: np.ndarray, all_frames_to_global: torch.Tensor  # (N)  # (N, 9, 3, 4)
+    aatype: np.ndarray, all_frames_to_global: "torch.Tensor"  # (N)  # (N, 9, 3, 4)
 ):  # (N, 23, 3)
     """Put atom literature positions (atom23 encoding) in each rigid group.
     Jumper et al. (2021) Suppl. Alg. 24 "computeAllAtomCoordinates" line 11
     Args:
       aatype: aatype for each residue.
-      all_frames_to_global: All per residue coordinate frames.
+      all_frames_to_global: All per residue coordinate frames, a torch tensor
+        or a NumPy array.
     Returns:
       Positions of all atom coordinates in global frame.
     """
-
-    device = all_frames_to_global.device
-    # Pick the appropriate transform for every atom.
-    residx_to_group_idx = _rc.restype_atomc_to_rigid_group[aatype]
-    group_mask = torch.eye(9, device=device)[residx_to_group_idx.reshape(-1)].reshape(
-        *residx_to_group_idx.shape, 9
-    )  # shape (N, 23, 8)
-
-    # Affines with shape (N, 23, 3, 4)
-    # map_atoms_to_global = torch.sum(
-    #     all_frames_to_global[:, None] * group_mask[..., None, None], dim=1
-    # )
-    map_atoms_to_global = torch.einsum(
-        "nfij,npf->npij", all_frames_to_global, group_mask
-    )
+    # Pick the appropriate transform for every atom, gathered directly rather
+    # than summed over the 9 frames with a one-hot group mask.
+    # Indices into the (N * 9, 3, 4) frames, shape (N, 23)
+    (num_residues,) = aatype.shape
+    frame_idx = _rc.restype_atomc_to_rigid_group[aatype] + np.arange(
+        0, num_residues * _rc.num_frames, _rc.num_frames
+    )[:, None]
+    flat_frames = all_frames_to_global.reshape(-1, 3, 4)
 
     # Gather the literature atom positions for each residue.
     # Vectors with shape (N, 23, 3)
-    lit_positions = torch.Tensor(_rc.restype_atomc_rigid_group_positions[aatype]).to(
-        device
-    )
+    lit_positions = _rc.restype_atomc_rigid_group_positions[aatype]
+    mask = _rc.restype_atomc_mask[aatype]
+    if is_numpy(all_frames_to_global):
+        # Affines with shape (N, 23, 3, 4)
+        map_atoms_to_global = np.take(flat_frames, frame_idx, axis=0)
+        lit_positions = lit_positions.astype(all_frames_to_global.dtype, copy=False)
+        mask = mask.astype(all_frames_to_global.dtype, copy=False)
+    else:
+        import torch
+
+        device = all_frames_to_global.device
+        # Affines with shape (N, 23, 3, 4)
+        map_atoms_to_global = torch.index_select(
+            flat_frames, 0, torch.from_numpy(frame_idx.reshape(-1)).to(device)
+        ).reshape(*frame_idx.shape, 3, 4)
+        lit_positions = torch.from_numpy(lit_positions).to(device)
+        mask = torch.from_numpy(mask).to(device)
 
     # Transform each atom from its local frame to the global frame.
     # Vectors with shape (N, 23, 3)
     pred_positions = affine_mul_vecs(map_atoms_to_global, lit_positions)
 
     # Mask out non-existing atoms.
-    mask = torch.Tensor(_rc.restype_atomc_mask[aatype]).to(device)
     pred_positions = pred_positions * mask[..., None]
 
     return pred_positions
 
 
 def frames_and_literature_positions_to_atom3_pos(
-    aatype: np.ndarray, all_frames_to_global: torch.Tensor  # (N)  # (N, 3, 4)
+    aatype: np.ndarray, all_frames_to_global: "torch.Tensor"  # (N)  # (N, 3, 4)
 ):  # (N, 3, 3)
     """Put atom literature positions (atom3 encoding) in each rigid group.
     It should be in N,CA,C order.
@@ -879,6 +983,8 @@ def frames_and_literature_positions_to_atom3_pos(
     Returns:
       Positions of all atom coordinates in global frame.
     """
+    import torch
+
     if isinstance(aatype, torch.Tensor):
         aatype = aatype.cpu().detach().numpy()
 
@@ -958,13 +1064,50 @@ def make_up_fr_from_prot(prot: Protein):
     final_results["pred_affines"] = prot.rigidgroups_gt_frames[:, 0]
 
 
+class ProteinView:
+    """
+    Residues of a Protein selected without modifying or copying it. The fields
+    indexed by residue are sliced when first read and kept, a contiguous
+    selection gives views of the source arrays. chain_idx_to_residues is
+    remapped to the selected residues, a chain without any stays empty.
+    """
+
+    keys = PROTEIN_KEYS
+
+    def __init__(self, protein: Protein, slice_array: np.ndarray):
+        self.protein = protein
+        self.num_source_res = len(protein.aatype)
+        self.residues = np.arange(self.num_source_res)[slice_array]
+        if len(self.residues) > 0 and np.array_equal(
+            self.residues, np.arange(self.residues[0], self.residues[0] + len(self.residues))
+        ):
+            self.index = slice(self.residues[0], self.residues[0] + len(self.residues))
+        else:
+            self.index = self.residues
+
+    def __getattr__(self, key):
+        if key not in PROTEIN_KEYS:
+            raise AttributeError(key)
+        value = getattr(self.protein, key)
+        if key == "chain_idx_to_residues" and value is not None:
+            residue_map = np.full(self.num_source_res, -1, dtype=np.int64)
+            residue_map[self.residues] = np.arange(len(self.residues))
+            value = [
+                chain_residues[chain_residues >= 0]
+                for chain_residues in (residue_map[c] for c in value)
+            ]
+        elif key not in PROTEIN_NON_RESIDUE_KEYS and value is not None:
+            value = value[self.index]
+        setattr(self, key, value)
+        return value
+
+
 def slice_protein(protein: Protein, slice_array: np.ndarray) -> Protein:
-    num_res = len(protein.aatype)
-    for key in PROTEIN_KEYS:
-        value = getattr(protein, key)
-        if hasattr(value, "shape") and value.shape[0] == num_res:
-            setattr(protein, key, value[slice_array])
-    return protein
+    """
+    A new Protein with the selected residues, the input is left untouched
+    """
+    protein_view = ProteinView(protein, slice_array)
+    return Protein(**{key: getattr(protein_view, key) for key in PROTEIN_KEYS})
 
 
 if __name__ == "__main__":
@@ -11,13 +11,12 @@ Nucleotides come from
 https://github.com/uw-ipd/RoseTTAFold2NA/blob/main/network/chemical.py
 """
 import functools
+import hashlib
 import os
 from collections import namedtuple
 from typing import List, Mapping, Tuple
 
 import numpy as np
-import torch
-import einops
 
 restype_1to3 = {
     "A": "ALA",
@@ -1235,30 +1234,29 @@ def _make_rigid_transformation_4x4(ex, ey, translation):
 # and an array with (restype, atomtype, coord) for the atom positions
 # and compute affine transformation matrices (4,4) from one rigid group to the
 # previous group
-restype_atomf_to_rigid_group = np.zeros(
-    [full_num_residues, atom_type_num], dtype=np.int64
-)
-restype_atomf_mask = np.zeros([full_num_residues, atom_type_num], dtype=np.float32)
-restype_atomf_rigid_group_positions = np.zeros(
-    [full_num_residues, atom_type_num, 3], dtype=np.float32
-)
-restype_atomc_to_rigid_group = np.zeros(
-    [full_num_residues, num_atomc], dtype=np.int64
-)
-restype_atomc_mask = np.zeros([full_num_residues, num_atomc], dtype=np.float32)
-restype_atomc_rigid_group_positions = np.zeros(
-    [full_num_residues, num_atomc, 3], dtype=np.float32
-)
-restype_atom3_rigid_group_positions = np.zeros(
-    [full_num_residues, 3, 3], dtype=np.float32
-)
-restype_rigid_group_default_frame = np.zeros(
-    [full_num_residues, num_frames, 4, 4], dtype=np.float32
-)
-
-
 def _make_rigid_group_constants():
-    """Fill the arrays above."""
+    """Make the arrays above."""
+    restype_atomf_to_rigid_group = np.zeros(
+        [full_num_residues, atom_type_num], dtype=np.int64
+    )
+    restype_atomf_mask = np.zeros([full_num_residues, atom_type_num], dtype=np.float32)
+    restype_atomf_rigid_group_positions = np.zeros(
+        [full_num_residues, atom_type_num, 3], dtype=np.float32
+    )
+    restype_atomc_to_rigid_group = np.zeros(
+        [full_num_residues, num_atomc], dtype=np.int64
+    )
+    restype_atomc_mask = np.zeros([full_num_residues, num_atomc], dtype=np.float32)
+    restype_atomc_rigid_group_positions = np.zeros(
+        [full_num_residues, num_atomc, 3], dtype=np.float32
+    )
+    restype_atom3_rigid_group_positions = np.zeros(
+        [full_num_residues, 3, 3], dtype=np.float32
+    )
+    restype_rigid_group_default_frame = np.zeros(
+        [full_num_residues, num_frames, 4, 4], dtype=np.float32
+    )
+
     for restype_letter in index_to_restype_1:
         restype = restype_1_to_index[restype_letter]
         resname = restype_1to3[restype_letter]
@@ -1407,8 +1405,17 @@ def _make_rigid_group_constants():
             )
             restype_rigid_group_default_frame[restype, 8, :, :] = mat
 
+    return {
+        "restype_atomf_to_rigid_group": restype_atomf_to_rigid_group,
+        "restype_atomf_mask": restype_atomf_mask,
+        "restype_atomf_rigid_group_positions": restype_atomf_rigid_group_positions,
+        "restype_atomc_to_rigid_group": restype_atomc_to_rigid_group,
+        "restype_atomc_mask": restype_atomc_mask,
+        "restype_atomc_rigid_group_positions": restype_atomc_rigid_group_positions,
+        "restype_atom3_rigid_group_positions": restype_atom3_rigid_group_positions,
+        "restype_rigid_group_default_frame": restype_rigid_group_default_frame,
+    }
 
-_make_rigid_group_constants()
 
 # Naming swaps for ambiguous atom names.
 # Due to symmetries in the amino acids the naming of atoms is ambiguous in
@@ -1436,7 +1443,7 @@ van_der_waals_radius = {
 
 def sequence_to_onehot(
     sequence: str, mapping, map_unknown_to_x: bool = False
-) -> torch.LongTensor:
+) -> "torch.LongTensor":
     """Maps the given sequence into a one-hot encoded matrix.
     Args:
       sequence: An amino acid sequence.
@@ -1452,6 +1459,8 @@ def sequence_to_onehot(
       ValueError: If the mapping doesn't contain values from 0 to
         num_unique_aas - 1 without any gaps.
     """
+    import torch
+
     num_entries = max(mapping.values()) + 1
 
     if sorted(set(mapping.values())) != list(range(num_entries)):
@@ -1499,8 +1508,6 @@ def get_chi_atom_indices():
     return np.asarray(chi_atom_indices)
 
 
-chi_atom_indices = get_chi_atom_indices()
-
 Bond = namedtuple("Bond", ["atom1_name", "atom2_name", "length", "stddev"])
 BondAngle = namedtuple(
     "BondAngle", ["atom1_name", "atom2_name", "atom3name", "angle_rad", "stddev"]
@@ -1655,8 +1662,6 @@ def get_atomc_dists_bounds(overlap_tolerance=1.5, bond_length_tolerance_factor=1
     }
 
 
-atomc_dists_bounds = get_atomc_dists_bounds()
-
 # Between-residue bond lengths for general bonds (first element) and for Proline
 # (second element).
 between_res_bond_length_c_n = [1.329, 1.341]
@@ -1668,7 +1673,8 @@ between_res_cos_angles_ca_c_n = [-0.4473, 0.0311]  # degrees: 116.568 +- 1.995
 
 
 def rename_aatype_to_convention(aatype):
-    if torch.is_tensor(aatype):
+    if hasattr(aatype, "clone"):
+        # torch.Tensor
         new_aatype = aatype.clone()
     else:
         new_aatype = aatype.copy()
@@ -1679,6 +1685,9 @@ def rename_aatype_to_convention(aatype):
 
 
 def select_torsion_angles(input, aatype):
+    import einops
+    import torch
+
     new_aatype = rename_aatype_to_convention(aatype)
     chi_angles = einops.rearrange(
         input[..., 3:, :],
@@ -1728,3 +1737,91 @@ for resname in ["DA", "DC", "DG", "DT", "A", "C", "G", "U", "DN", "N"]:
     nuc_torsion_atom_mask.append(resname_torsion_atom_mask)
 nuc_torsion_atom_indices = np.array(nuc_torsion_atom_indices, dtype=np.int64)
 nuc_torsion_atom_mask = np.array(nuc_torsion_atom_mask, dtype=np.int64)
+
+
+# Derived tables that are not needed to parse or score a structure are only
+# built when first used. They are read from residue_constants_tables.npz next to
+# this file, which write_constant_tables() regenerates after the definitions
+# above change. The file is keyed by a hash of this module and
+# stereo_chemical_props.txt, and the tables are built from the definitions if
+# it is missing or was written from other definitions.
+CONSTANT_TABLES_VERSION = 1
+CONSTANT_TABLES_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "residue_constants_tables.npz"
+)
+CONSTANT_TABLES_INPUTS = [
+    os.path.abspath(__file__),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "stereo_chemical_props.txt"),
+]
+_RIGID_GROUP_TABLES = [
+    "restype_atomf_to_rigid_group",
+    "restype_atomf_mask",
+    "restype_atomf_rigid_group_positions",
+    "restype_atomc_to_rigid_group",
+    "restype_atomc_mask",
+    "restype_atomc_rigid_group_positions",
+    "restype_atom3_rigid_group_positions",
+    "restype_rigid_group_default_frame",
+]
+_LAZY_TABLES = _RIGID_GROUP_TABLES + ["chi_atom_indices", "atomc_dists_bounds"]
+
+
+def make_constant_tables() -> dict:
+    tables = _make_rigid_group_constants()
+    tables["chi_atom_indices"] = get_chi_atom_indices()
+    for key, value in get_atomc_dists_bounds().items():
+        tables[f"atomc_dists_bounds/{key}"] = value
+    return tables
+
+
+def get_constant_tables_key() -> str:
+    """
+    Hash of the files the tables are built from, and of the table format version
+    """
+    digest = hashlib.sha256(str(CONSTANT_TABLES_VERSION).encode())
+    for path in CONSTANT_TABLES_INPUTS:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def write_constant_tables(path: str = CONSTANT_TABLES_PATH):
+    np.savez_compressed(path, key=get_constant_tables_key(), **make_constant_tables())
+
+
+def read_constant_tables(path: str = CONSTANT_TABLES_PATH):
+    """
+    Tables saved in the file, None if it is missing or was written from other definitions
+    """
+    try:
+        with np.load(path) as f:
+            if str(f["key"]) == get_constant_tables_key():
+                return {key: f[key] for key in f.files if key != "key"}
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def load_constant_tables() -> dict:
+    tables = read_constant_tables()
+    if tables is None:
+        tables = make_constant_tables()
+    return tables
+
+
+def __getattr__(name):
+    # PEP 562, only called for names not found in the module
+    if name not in _LAZY_TABLES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    tables = load_constant_tables()
+    if name == "atomc_dists_bounds":
+        value = {
+            key.split("/", 1)[1]: array
+            for key, array in tables.items()
+            if key.startswith("atomc_dists_bounds/")
+        }
+    else:
+        value = tables[name]
+    globals()[name] = value
+    return value
@@ -0,0 +1,111 @@
+"""
+Structured evaluation results
+Every evaluated pair becomes one flat record with typed values, appended to a
+JSONL file and/or written in batches as Parquet part files into a directory,
+so large result sets can be loaded without re-parsing the text logs.
+"""
+import json
+import math
+import os
+import time
+import uuid
+
+import numpy as np
+
+
+def format_value(value):
+    """
+    How metric values are written to the text output files and the console
+    """
+    if isinstance(value, (float, np.floating)):
+        return "{:.3f}".format(value)
+    return value
+
+
+def to_builtin(value):
+    """
+    JSON-safe copy of a value, recursing into dicts, lists and tuples
+    """
+    if isinstance(value, dict):
+        return {key: to_builtin(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [to_builtin(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not math.isfinite(value):
+        # JSON has no NaN/Infinity
+        return None
+    return value
+
+
+class ResultSink:
+    def __init__(self, jsonl_path=None, parquet_dir=None, parquet_batch_size=1000):
+        self.jsonl_file = None
+        if jsonl_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(jsonl_path)), exist_ok=True)
+            self.jsonl_file = open(jsonl_path, "a")
+
+        self.parquet_dir = parquet_dir
+        self.parquet_batch_size = parquet_batch_size
+        self.parquet_records = []
+        if parquet_dir is not None:
+            # Fail before evaluating anything if pyarrow is missing
+            import pyarrow  # noqa: F401
+
+            os.makedirs(parquet_dir, exist_ok=True)
+        # Part files of concurrent writers into the same directory never collide
+        self.part_prefix = f"part-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.num_parts = 0
+
+    def write(self, record: dict):
+        record = {key: to_builtin(value) for key, value in record.items()}
+        if self.jsonl_file is not None:
+            self.jsonl_file.write(json.dumps(record) + "\n")
+            self.jsonl_file.flush()
+        if self.parquet_dir is not None:
+            self.parquet_records.append(record)
+            if len(self.parquet_records) >= self.parquet_batch_size:
+                self.flush_parquet()
+
+    def flush_parquet(self):
+        if not self.parquet_records:
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pylist(self.parquet_records)
+        pq.write_table(
+            table,
+            os.path.join(self.parquet_dir, f"{self.part_prefix}-{self.num_parts:05d}.parquet"),
+        )
+        self.num_parts += 1
+        self.parquet_records = []
+
+    def close(self):
+        if self.parquet_dir is not None:
+            self.flush_parquet()
+        if self.jsonl_file is not None:
+            self.jsonl_file.close()
+            self.jsonl_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RecordingSink:
+    """
+    Keeps the last record evaluate.main writes, e.g. for the stage timings,
+    and passes it on to another sink if there is one
+    """
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.record = {}
+
+    def write(self, record: dict):
+        self.record = record
+        if self.sink is not None:
+            self.sink.write(record)
@@ -5,15 +5,16 @@
 import glob
 import os
 import pickle
-from typing import List, Union
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Tuple, Union
 from copy import deepcopy
 
 import numpy as np
-import pandas as pd
 from Bio.PDB.mmcifio import MMCIFIO
 from Bio.PDB.StructureBuilder import StructureBuilder
 
 from utils.misc_utils import assertion_check
+from utils.profile_utils import profile_step
 from utils.protein import Protein, \
     frames_and_literature_positions_to_atom3_pos
 from utils.residue_constants import (
@@ -21,7 +22,6 @@ from utils.residue_constants import (
     restype_name_to_atomc_names,
     index_to_restype_1, num_atomc,
 )
-import torch
 
 
 PDB_CHAIN_IDS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
@@ -29,6 +29,35 @@ SEQUENCE_IDS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
 SEQUENCE_BASED_CHAIN_IDS = "abcdefghijklmnopqrstuvwxyz0123456789"
 
 
+ATOM_SITE_FIELDS = [
+    "group_PDB",
+    "id",
+    "type_symbol",
+    "label_atom_id",
+    "label_alt_id",
+    "label_comp_id",
+    "label_asym_id",
+    "label_entity_id",
+    "label_seq_id",
+    "pdbx_PDB_ins_code",
+    "Cartn_x",
+    "Cartn_y",
+    "Cartn_z",
+    "occupancy",
+    "B_iso_or_equiv",
+    "auth_seq_id",
+    "auth_asym_id",
+    "pdbx_PDB_model_num",
+]
+# Atom names and elements of atomc slot restype * num_atomc + slot
+ATOMC_NAMES = np.array([
+    atom_name for res_name_3 in index_to_restype_3
+    for atom_name in restype_name_to_atomc_names[res_name_3]
+])
+ATOMC_ELEMENTS = np.array([atom_name[:1] or "?" for atom_name in ATOMC_NAMES])
+RESTYPE_COMP_IDS = np.array(index_to_restype_3)
+
+
 
 class ModelAngeloMMCIFIO(MMCIFIO):
     def _save_dict(self, out_file):
@@ -84,6 +113,250 @@ def points_to_xyz(path_to_save, points, zyx_order=False):
                 f.write(f"C {point[2]} {point[1]} {point[0]}\n")
 
 
+def get_label_asym_id(entity_id: int) -> str:
+    """
+    As MMCIFIO._get_label_asym_id: A to Z, then AA to ZA, AB to ZB etc
+    """
+    out = ""
+    while entity_id > 0:
+        mod = (entity_id - 1) % 26
+        out += chr(65 + mod)
+        entity_id = (entity_id - mod) // 26
+    return out
+
+
+def quote_mmcif_values(values: np.ndarray) -> np.ndarray:
+    """
+    Vectorized MMCIFIO._requires_quote, the values needing quotes are then
+    formatted by MMCIFIO itself
+    """
+    values = np.asarray(values, dtype=str)
+    requires_quote = (
+        (np.char.find(values, " ") >= 0)
+        | (np.char.find(values, "'") >= 0)
+        | (np.char.find(values, '"') >= 0)
+        | np.isin(values.astype("U1"), ["_", "#", "$", "[", "]", ";"])
+        | np.char.startswith(values, "data_")
+        | np.char.startswith(values, "save_")
+        | np.isin(values, ["loop_", "stop_", "global_"])
+    )
+    if not requires_quote.any():
+        return values
+    io = MMCIFIO()
+    quoted = [io._format_mmcif_col(value, 0) for value in values[requires_quote]]
+    values = values.astype(f"U{max(values.itemsize // 4, max(map(len, quoted)))}")
+    values[requires_quote] = quoted
+    return values
+
+
+def get_fixed_point_width(values: np.ndarray) -> int:
+    # The "%.3f" strings only get longer with the magnitude, so the extremes are the longest
+    if len(values) == 0:
+        return 0
+    if np.isnan(values).any():
+        return int(np.char.str_len(np.char.mod("%.3f", values)).max())
+    return max(len(f"{values.min():.3f}"), len(f"{values.max():.3f}"))
+
+
+def quote_loop_rows(rows: dict) -> dict:
+    """
+    Quotes the string fields of a chain, only the values of its rows are kept
+    """
+    quoted = {}
+    for field, value in rows.items():
+        if isinstance(value, str):
+            quoted[field] = quote_mmcif_values([value])[0]
+        elif isinstance(value, tuple):
+            values, index = value
+            used = np.flatnonzero(np.bincount(index, minlength=len(values)))
+            remap = np.zeros(len(values), dtype=np.int64)
+            remap[used] = np.arange(len(used))
+            quoted[field] = (quote_mmcif_values(np.asarray(values)[used]), remap[index])
+        else:
+            quoted[field] = value
+    return quoted
+
+
+def get_loop_column_width(value) -> int:
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, tuple):
+        return int(np.char.str_len(value[0]).max()) if len(value[0]) > 0 else 0
+    if len(value) == 0:
+        return 0
+    if value.dtype.kind == "f":
+        return get_fixed_point_width(value)
+    return max(len(str(value.min())), len(str(value.max())))
+
+
+def format_loop_column(value, start: int, end: int):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, tuple):
+        values, index = value
+        return values[index[start:end]]
+    if value.dtype.kind == "f":
+        return np.char.mod("%.3f", value[start:end])
+    return value[start:end].astype(str)
+
+
+def get_num_loop_rows(rows: dict) -> int:
+    for value in rows.values():
+        if isinstance(value, tuple):
+            return len(value[1])
+        if not isinstance(value, str):
+            return len(value)
+    return 0
+
+
+def get_loop_widths(fields: List[str], get_rows: Callable[[], Iterable[dict]]) -> Tuple[int, dict]:
+    """
+    Number of rows and width of every column, as MMCIFIO pads them
+    """
+    num_rows = 0
+    widths = {field: 0 for field in fields}
+    for rows in get_rows():
+        num_chain_rows = get_num_loop_rows(rows)
+        if num_chain_rows == 0:
+            continue
+        num_rows += num_chain_rows
+        for field, value in quote_loop_rows(rows).items():
+            widths[field] = max(widths[field], get_loop_column_width(value))
+    return num_rows, widths
+
+
+def write_loop(
+    f,
+    category: str,
+    fields: List[str],
+    get_rows: Callable[[], Iterable[dict]],
+    widths: dict,
+    block_size: int = 1 << 16,
+):
+    """
+    Writes a loop as MMCIFIO does, a chain and a block of rows at a time.
+    get_rows() yields the rows of every chain as a dict of fields, each one
+    string shared by the rows of the chain, (values, index) with the value of
+    row i values[index[i]], or an array of numbers, floats written as "%.3f"
+    """
+    f.write("loop_\n")
+    f.write("".join(f"{category}.{field}\n" for field in fields))
+    for rows in get_rows():
+        num_rows = get_num_loop_rows(rows)
+        rows = quote_loop_rows(rows)
+        for start in range(0, num_rows, block_size):
+            end = min(start + block_size, num_rows)
+            lines = ""
+            for field in fields:
+                values = format_loop_column(rows[field], start, end)
+                lines = np.char.add(lines, np.char.ljust(values, widths[field] + 1))
+            f.write("\n".join(lines.tolist()))
+            f.write("\n")
+    f.write("#\n")
+
+
+def open_structure_file(path_to_save: str):
+    # Compressed on the fly when saving to e.g. structure.cif.gz
+    if path_to_save.endswith(".gz"):
+        import gzip
+
+        return gzip.open(path_to_save, "wt")
+    return open(path_to_save, "w")
+
+
+def write_atom_site_cif(
+    path_to_save,
+    get_chains: Callable[[], Iterable[Tuple[np.ndarray, dict]]],
+    data_name: str = "1",
+    categories: Dict[str, Tuple[List[str], Callable[[], Iterable[dict]]]] = None,
+    block_size: int = 1 << 16,
+):
+    """
+    Writes the _atom_site loop exactly as MMCIFIO writes it for the same atoms,
+    without building a Biopython structure. get_chains() yields the chains in
+    order as (positions (N, 3), atom_site), with the fields of
+    ATOM_SITE_FIELDS but id and Cartn_* in atom_site as in write_loop. The
+    atoms are numbered from 1. categories are further loops written after it,
+    as category name: (fields, get_rows).
+    It streams: every get_chains() or get_rows() is iterated once for the
+    column widths and once for the rows, so memory beyond the input arrays
+    does not grow with the structure. Saves to a file handle or a path,
+    gzipped if it ends in .gz.
+    """
+    def get_atom_rows():
+        atom_number = 1
+        for positions, atom_site in get_chains():
+            rows = dict(atom_site)
+            rows["id"] = np.arange(atom_number, atom_number + len(positions))
+            rows["Cartn_x"], rows["Cartn_y"], rows["Cartn_z"] = positions[:, 0], positions[:, 1], positions[:, 2]
+            atom_number += len(positions)
+            yield rows
+
+    num_atoms, widths = get_loop_widths(ATOM_SITE_FIELDS, get_atom_rows)
+
+    f = open_structure_file(path_to_save) if isinstance(path_to_save, str) else path_to_save
+    try:
+        if num_atoms <= 1:
+            # MMCIFIO writes a single atom as key-value pairs rather than a loop
+            dic = defaultdict(list, {"data_": data_name})
+            for rows in get_atom_rows():
+                if get_num_loop_rows(rows) == 0:
+                    continue
+                for field in ATOM_SITE_FIELDS:
+                    value = format_loop_column(rows[field], 0, 1)
+                    dic[f"_atom_site.{field}"] = [value if isinstance(value, str) else str(value[0])]
+            io = ModelAngeloMMCIFIO()
+            io.set_dict(dic)
+            io.save(f)
+        else:
+            f.write(f"data_{data_name}\n#\n")
+            write_loop(f, "_atom_site", ATOM_SITE_FIELDS, get_atom_rows, widths, block_size)
+        for category, (fields, get_rows) in (categories or {}).items():
+            _, widths = get_loop_widths(fields, get_rows)
+            write_loop(f, category, fields, get_rows, widths, block_size)
+    finally:
+        if isinstance(path_to_save, str):
+            f.close()
+
+
+def get_residue_atom_site(
+    aatype: np.ndarray,
+    atom_mask: np.ndarray,
+    bfactors: np.ndarray,
+    seq_ids: np.ndarray,
+    comp_ids: np.ndarray,
+    label_asym_id: str,
+    auth_asym_id: str,
+) -> Tuple[np.ndarray, dict]:
+    """
+    The atoms of a chain of residues, as written by StructureBuilder init_atom
+    with element the first letter of the atom name and occupancy 1.
+    Returns the atom mask and the atom_site fields for write_atom_site_cif
+    """
+    atom_exists = ~(atom_mask < 0.5)
+    atom_residue, atom_slot = np.nonzero(atom_exists)
+    atom_aatype = np.asarray(aatype, dtype=np.int64)[atom_residue]
+    atom_type = atom_aatype * num_atomc + atom_slot
+    seq_ids = np.asarray(seq_ids).astype(str)
+    return atom_exists, {
+        "group_PDB": "ATOM",
+        "type_symbol": (ATOMC_ELEMENTS, atom_type),
+        "label_atom_id": (ATOMC_NAMES, atom_type),
+        "label_alt_id": ".",
+        "label_comp_id": (comp_ids, atom_aatype),
+        "label_asym_id": label_asym_id,
+        "label_entity_id": "?",
+        # ModelAngeloMMCIFIO writes the residue numbers as label_seq_id too
+        "label_seq_id": (seq_ids, atom_residue),
+        "pdbx_PDB_ins_code": "?",
+        "occupancy": "1",
+        "B_iso_or_equiv": (np.asarray(bfactors).astype(str), atom_residue),
+        "auth_seq_id": (seq_ids, atom_residue),
+        "auth_asym_id": auth_asym_id,
+        "pdbx_PDB_model_num": "1",
+    }
+
+
 def save_structure_to_cif(structure, path_to_save: str):
     io = ModelAngeloMMCIFIO()
     io.set_structure(structure)
@@ -188,44 +461,28 @@ def atom14_to_cif(
         bfactors = np.zeros(len(aatype))
     if len(bfactors.shape) > 1:
         bfactors = bfactors[:, 0]
-    struct = StructureBuilder()
-    curr_chain = 0
-
-    struct.init_structure("1")
-    struct.init_seg("1")
-    struct.init_model("1")
-    struct.init_chain(number_to_chain_str(curr_chain))
-
-    prev_loc = atom14[0][0]
-    for i in range(aatype.shape[0]):
-        res_name_3 = index_to_restype_3[aatype[i]]
-        bfactor = bfactors[i]
-        atom_names = restype_name_to_atomc_names[res_name_3]
-        res_counter = 0
-        if np.linalg.norm(prev_loc - atom14[i][0]) > max_distance:
-            curr_chain += 1
-            struct.init_chain(number_to_chain_str(curr_chain))
-        prev_loc = atom14[i][0]
 
-        struct.init_residue(res_name_3, " ", i, " ")
-        for atom_name, pos, mask in zip(atom_names, atom14[i], atom_mask[i]):
-            if mask < 0.5:
-                continue
-            struct.set_line_counter(i + res_counter)
-            struct.init_atom(
-                name=atom_name,
-                coord=pos,
-                b_factor=bfactor,
-                occupancy=1,
-                altloc=" ",
-                fullname=atom_name,
-                element=atom_name[0],
+    # A new chain starts wherever the first atoms of consecutive residues are far apart
+    chain_breaks = np.linalg.norm(np.diff(atom14[:, 0], axis=0), axis=-1) > max_distance
+    chain_starts = np.concatenate([[0], np.flatnonzero(chain_breaks) + 1, [len(aatype)]])
+
+    def get_chains():
+        for chain_id, (start, end) in enumerate(zip(chain_starts[:-1], chain_starts[1:])):
+            atom_exists, atom_site = get_residue_atom_site(
+                aatype[start:end],
+                atom_mask[start:end],
+                bfactors[start:end],
+                np.arange(start, end),
+                RESTYPE_COMP_IDS,
+                get_label_asym_id(chain_id + 1),
+                number_to_chain_str(chain_id),
             )
-            res_counter += 1
-    struct = struct.get_structure()
-    save_structure_to_cif(struct, path_to_save)
+            yield atom14[start:end][atom_exists], atom_site
 
+    write_atom_site_cif(path_to_save, get_chains)
 
+
+@profile_step("protein_to_cif")
 def protein_to_cif(
     protein: Protein, path_to_save: str, split_chains: bool = False,
 ):
@@ -240,6 +497,8 @@ def protein_to_cif(
     if protein.atomc_positions is None:
         protein.atomc_positions = np.zeros((len(protein.rigidgroups_gt_frames), num_atomc, 3), dtype=np.float32)
         protein.atomc_mask = np.zeros((len(protein.rigidgroups_gt_frames), num_atomc))
+        import torch
+
         protein.atomc_positions[:, :3] = frames_and_literature_positions_to_atom3_pos(
             protein.aatype, torch.from_numpy(protein.rigidgroups_gt_frames[:, 0])
         ).numpy()
@@ -251,51 +510,50 @@ def protein_to_cif(
         bfactors = protein.b_factors
     if len(bfactors.shape) > 1:
         bfactors = bfactors[:, 0]
-    struct = StructureBuilder()
-    curr_chain = 0
-
-    struct.init_structure("1")
-    struct.init_seg("1")
-    struct.init_model("1")
-    struct.init_chain(protein.chain_id[0])
 
+    # The residues of every chain, as StructureBuilder.init_chain was called on them.
+    # Chains are written in the order they were first initialised, the first
+    # residues go to chain_id[0] and a chain met again is continued
+    chain_residues = {protein.chain_id[0]: []}
+    chain_name = protein.chain_id[0]
+    curr_chain = 0
     prev_chain = protein.chain_index[0]
     prev_residue_index = protein.residue_index[0]
     for i in range(protein.aatype.shape[0]):
-        res_name_3 = index_to_restype_3[protein.aatype[i]]
-        bfactor = bfactors[i]
-        atom_names = restype_name_to_atomc_names[res_name_3]
-        res_counter = 0
         if prev_chain != protein.chain_index[i]:
             curr_chain = 0
-            struct.init_chain(protein.chain_id[protein.chain_index[i]])
+            chain_name = protein.chain_id[protein.chain_index[i]]
+            chain_residues.setdefault(chain_name, [])
         if split_chains and protein.residue_index[i] != prev_residue_index + 1:
             curr_chain += 1
-            struct.init_chain(protein.chain_id[protein.chain_index[i]] + f"_{curr_chain}")
+            chain_name = protein.chain_id[protein.chain_index[i]] + f"_{curr_chain}"
+            chain_residues.setdefault(chain_name, [])
         prev_chain = protein.chain_index[i]
         prev_residue_index = protein.residue_index[i]
+        chain_residues[chain_name].append(i)
 
-        struct.init_residue(res_name_3, " ", i, " ")
-        for atom_name, pos, mask in zip(
-            atom_names, protein.atomc_positions[i], protein.atomc_mask[i]
-        ):
-            if mask < 0.5:
+    def get_chains():
+        entity_id = 0
+        for chain_name, residues in chain_residues.items():
+            if len(residues) == 0:
                 continue
-            struct.set_line_counter(i + res_counter)
-            struct.init_atom(
-                name=atom_name,
-                coord=pos,
-                b_factor=bfactor,
-                occupancy=1,
-                altloc=" ",
-                fullname=atom_name,
-                element=atom_name[0],
+            entity_id += 1
+            residues = np.array(residues)
+            atom_exists, atom_site = get_residue_atom_site(
+                protein.aatype[residues],
+                protein.atomc_mask[residues],
+                bfactors[residues],
+                residues,
+                RESTYPE_COMP_IDS,
+                get_label_asym_id(entity_id),
+                str(chain_name),
             )
-            res_counter += 1
-    struct = struct.get_structure()
-    save_structure_to_cif(struct, path_to_save)
+            yield protein.atomc_positions[residues][atom_exists], atom_site
+
+    write_atom_site_cif(path_to_save, get_chains)
 
 
+@profile_step("chain_atom14_to_cif")
 def chain_atom14_to_cif(
     aatype: List[np.ndarray],
     atom14: List[np.ndarray],
@@ -304,13 +562,12 @@ def chain_atom14_to_cif(
     bfactors: List[np.ndarray] = None,
     sequence_idxs: Union[List, np.ndarray] = None,
     res_idxs: List[np.ndarray] = None,
+    residue_annotations: Dict[str, List[np.ndarray]] = None,
 ):
-    struct = StructureBuilder()
-
-    struct.init_structure("1")
-    struct.init_seg("1")
-    struct.init_model("1")
-
+    """
+    residue_annotations, e.g. {"lddt": [per residue lDDT of every chain]}, are
+    written to a _cryoeval_residue loop after the atoms, one row per residue
+    """
     if bfactors is None:
         bfactors = [np.zeros(len(chain_aas)) for chain_aas in aatype]
     if res_idxs is None:
@@ -332,6 +589,7 @@ def chain_atom14_to_cif(
     for seq_id in np.unique(sequence_idxs):
         idx_per_sequence[seq_id] = 0
 
+    chain_names = []
     for chain_id in range(len(aatype)):
         seq_id = sequence_idxs[chain_id]
         if name_with_sequences:
@@ -341,40 +599,68 @@ def chain_atom14_to_cif(
         else:
             chain_name = number_to_chain_str(idx_per_sequence[seq_id])
         idx_per_sequence[seq_id] += 1
-        struct.init_chain(chain_name)
+        chain_names.append(chain_name)
 
         assertion_check(
             len(aatype[chain_id]) == len(res_idxs[chain_id]),
             f"{len(aatype[chain_id])}, {len(res_idxs[chain_id])}",
         )
-        for i in range(aatype[chain_id].shape[0]):
-            res_name_3 = index_to_restype_3[aatype[chain_id][i]]
-            bfactor = bfactors[chain_id][i]
-            atom_names = restype_name_to_atomc_names[res_name_3]
-            res_counter = 0
-            # res_name_3 = "N" if res_name_3 == "DN" else res_name_3
-            res_name_3 = "C" if res_name_3 == "N" else ("DC" if res_name_3 == "DN" else res_name_3)
-            field_name = " " if res_name_3 != "N" else "H"
-            struct.init_residue(res_name_3, field_name, res_idxs[chain_id][i], " ")
-            for atom_name, pos, mask in zip(
-                atom_names, atom14[chain_id][i], atom_mask[chain_id][i]
-            ):
-                if mask < 0.5:
-                    continue
-                struct.set_line_counter(i + res_counter)
-                struct.init_atom(
-                    name=atom_name,
-                    coord=pos,
-                    b_factor=bfactor,
-                    occupancy=1,
-                    altloc=" ",
-                    fullname=atom_name,
-                    element=atom_name[0],
-                )
-                res_counter += 1
 
-    struct = struct.get_structure()
-    save_structure_to_cif(struct, path_to_save)
+    # N and DN residues are written as C and DC
+    comp_ids = np.array([
+        "C" if res_name_3 == "N" else ("DC" if res_name_3 == "DN" else res_name_3)
+        for res_name_3 in index_to_restype_3
+    ])
+
+    def get_chains():
+        # MMCIFIO starts a new entity, so a new label_asym_id, at every chain with residues
+        entity_id = 0
+        for chain_id in range(len(aatype)):
+            entity_id += len(aatype[chain_id]) > 0
+            atom_exists, atom_site = get_residue_atom_site(
+                aatype[chain_id],
+                atom_mask[chain_id],
+                bfactors[chain_id],
+                res_idxs[chain_id],
+                comp_ids,
+                get_label_asym_id(entity_id),
+                chain_names[chain_id],
+            )
+            yield atom14[chain_id][atom_exists], atom_site
+
+    categories = None
+    if residue_annotations:
+        def get_residues():
+            for chain_id in range(len(aatype)):
+                residues = np.arange(len(aatype[chain_id]))
+                rows = {
+                    "auth_asym_id": chain_names[chain_id],
+                    "auth_seq_id": (np.asarray(res_idxs[chain_id]).astype(str), residues),
+                    "label_comp_id": (comp_ids, np.asarray(aatype[chain_id], dtype=np.int64)),
+                }
+                for name, values in residue_annotations.items():
+                    rows[name] = (format_annotation_values(values[chain_id]), residues)
+                yield rows
+
+        categories = {
+            "_cryoeval_residue": (
+                ["auth_asym_id", "auth_seq_id", "label_comp_id"] + list(residue_annotations),
+                get_residues,
+            )
+        }
+
+    write_atom_site_cif(path_to_save, get_chains, categories=categories)
+
+
+def format_annotation_values(values: np.ndarray) -> np.ndarray:
+    # Floats as "%.3f", missing values (NaN or empty) as the mmCIF inapplicable "."
+    values = np.asarray(values)
+    if values.dtype.kind == "f":
+        return np.where(np.isnan(values), ".", np.char.mod("%.3f", values))
+    if values.dtype.kind == "b":
+        values = values.astype(np.int64)
+    values = values.astype(str)
+    return np.where(values == "", ".", values)
 
 
 def write_chain_report(
@@ -385,46 +671,95 @@ def write_chain_report(
     chain_prune_length: int = 0,
     hmm_output_match_sequences: List[str] = None,
 ):
+    """
+    CSV with a row per chain, or Parquet (needs pyarrow) if path_to_save ends in .parquet
+    """
     if hmm_output_match_sequences is None:
         hmm_output_match_sequences = ["" for _ in bfactors]
+    sequence_idxs = np.asarray(sequence_idxs)
+    chain_lens = np.array([len(chain_bfactors) for chain_bfactors in bfactors], dtype=np.int64)
+
+    # The kept chains are numbered per sequence in chain order
+    kept = chain_lens >= chain_prune_length
+    idx_in_sequence = np.zeros(len(sequence_idxs), dtype=np.int64)
+    order = np.argsort(sequence_idxs[kept], kind="stable")
+    sorted_seq_ids = sequence_idxs[kept][order]
+    sequence_starts = np.flatnonzero(np.r_[True, sorted_seq_ids[1:] != sorted_seq_ids[:-1]])
+    run_lens = np.diff(np.r_[sequence_starts, len(order)])
+    idx_in_sequence[np.flatnonzero(kept)[order]] = (
+        np.arange(len(order)) - np.repeat(sequence_starts, run_lens)
+    )
 
     report = {
-        "chain_name": [],
-        "pruned_chain_name": [],
-        "average_confidence": [],
-        "sequence_match_score": [],
-        "chain_length": [],
-        "sequence_idx": [],
-        "hmm_output_match_sequences": [],
+        "chain_name": [number_to_chain_str(chain_id) for chain_id in range(len(sequence_idxs))],
+        "pruned_chain_name": [
+            seq_id_and_number_to_chain_str(seq_id, idx) if keep else "pruned"
+            for seq_id, idx, keep in zip(sequence_idxs.tolist(), idx_in_sequence.tolist(), kept)
+        ],
+        "average_confidence": np.array([chain_bfactors.mean() for chain_bfactors in bfactors]),
+        "sequence_match_score": np.asarray(match_scores),
+        "chain_length": chain_lens,
+        "sequence_idx": sequence_idxs,
+        "hmm_output_match_sequences": list(hmm_output_match_sequences),
     }
 
-    idx_per_sequence = {}
-    for seq_id in np.unique(sequence_idxs):
-        idx_per_sequence[seq_id] = 0
-
-    for chain_id in range(len(sequence_idxs)):
-        chain_len = len(bfactors[chain_id])
-        seq_id = sequence_idxs[chain_id]
-
-        report["chain_name"].append(number_to_chain_str(chain_id))
-        report["average_confidence"].append(bfactors[chain_id].mean())
-        report["sequence_match_score"].append(match_scores[chain_id])
-        report["chain_length"].append(chain_len)
-        report["sequence_idx"].append(seq_id)
-        report["hmm_output_match_sequences"].append(
-            hmm_output_match_sequences[chain_id]
+    if path_to_save.endswith(".parquet"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        pq.write_table(pa.table(report), path_to_save)
+        return
+
+    import csv
+
+    columns = []
+    for values in report.values():
+        values = np.asarray(values)
+        strs = values.astype(str)
+        # Missing values are empty cells, as pandas writes them, e.g. the
+        # confidence of a chain without residues or a chain without an HMM match
+        if values.dtype.kind == "f":
+            strs[np.isnan(values)] = ""
+        elif values.dtype.kind == "O":
+            strs[np.equal(values, None)] = ""
+        columns.append(strs.tolist())
+    with open(path_to_save, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(report.keys())
+        writer.writerows(zip(*columns))
+
+
+def join_value_strs(values: np.ndarray, run_lens: np.ndarray) -> List[str]:
+    """
+    ",".join(str(x) for x in run) for consecutive runs of values. With pyarrow
+    the values are formatted by its C++ cast wherever it writes what str()
+    writes, float32/64 that are not integers with 1e-4 <= |x| < 1e5, and by
+    numpy elsewhere
+    """
+    values = np.asarray(values)
+    offsets = np.r_[0, np.cumsum(run_lens)].astype(np.int64)
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+    except ImportError:
+        pa = None
+    if pa is None or values.dtype not in (np.float32, np.float64):
+        strs = values.astype(str).tolist()
+        return [",".join(strs[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+
+    # In float64 like numpy decides between positional and scientific notation,
+    # float32(1e-4) is just below 1e-4 and numpy writes it as 1e-04
+    abs_values = np.abs(values.astype(np.float64))
+    numpy_formatted = ~((abs_values >= 1e-4) & (abs_values < 1e5) & (values != np.trunc(values)))
+    strs = pc.cast(pa.array(values), pa.large_string())
+    if numpy_formatted.any():
+        strs = pc.replace_with_mask(
+            strs,
+            pa.array(numpy_formatted),
+            pa.array(values[numpy_formatted].astype(str).tolist(), pa.large_string()),
         )
-
-        if chain_len >= chain_prune_length:
-            report["pruned_chain_name"].append(
-                seq_id_and_number_to_chain_str(seq_id, idx_per_sequence[seq_id])
-            )
-            idx_per_sequence[seq_id] += 1
-        else:
-            report["pruned_chain_name"].append("pruned")
-
-    df = pd.DataFrame.from_dict(report)
-    df.to_csv(path_to_save, index=False)
+    runs = pa.LargeListArray.from_arrays(pa.array(offsets), strs)
+    return pc.binary_join(runs, pa.scalar(",", pa.large_string())).to_pylist()
 
 
 def write_chain_probabilities(
@@ -433,29 +768,43 @@ def write_chain_probabilities(
     aa_probs: List[np.ndarray],
     chain_prune_length: int = 0,
 ):
+    """
+    Text report per chain, or arrays of all chains concatenated if path_to_save ends in .npz
+    """
+    aa_names = index_to_restype_1[:-3]
+    chain_lens = np.array([len(chain_bfactors) for chain_bfactors in bfactors], dtype=np.int64)
+    if len(bfactors) == 0:
+        all_bfactors, all_aa_probs = np.zeros(0), np.zeros((0, len(aa_names)))
+    else:
+        all_bfactors = np.concatenate(bfactors)
+        all_aa_probs = np.concatenate([np.asarray(probs)[:, : len(aa_names)] for probs in aa_probs])
+
+    if path_to_save.endswith(".npz"):
+        np.savez(
+            path_to_save,
+            chain_length=chain_lens,
+            pruned=chain_lens < chain_prune_length,
+            confidence=all_bfactors,
+            aa_probs=all_aa_probs,
+            aa_names=np.array(aa_names),
+        )
+        return
+
+    confidence_strs = join_value_strs(all_bfactors, chain_lens)
+    # One run of values per amino acid and chain
+    aa_probs_strs = join_value_strs(all_aa_probs.T.ravel(), np.tile(chain_lens, len(aa_names)))
+    lines = []
+    for chain_id in range(len(chain_lens)):
+        lines.append("=" * 50)
+        lines.append(f"Chain id: {chain_id}")
+        lines.append("Not pruned" if chain_lens[chain_id] >= chain_prune_length else "Pruned")
+        lines.append(f"Chain length: {chain_lens[chain_id]}")
+        lines.append("Confidence per residue:" + confidence_strs[chain_id])
+        lines.append("Amino acid probability per residue:")
+        for i, aa in enumerate(aa_names):
+            lines.append(f"{aa}:" + aa_probs_strs[i * len(chain_lens) + chain_id])
     with open(path_to_save, "w") as file_handle:
-        for chain_id in range(len(bfactors)):
-            chain_len = len(bfactors[chain_id])
-
-            file_handle.write(f"=" * 50 + "\n")
-            file_handle.write(f"Chain id: {chain_id}\n")
-            if chain_len >= chain_prune_length:
-                file_handle.write(f"Not pruned\n")
-            else:
-                file_handle.write(f"Pruned\n")
-            file_handle.write(f"Chain length: {chain_len}\n")
-            file_handle.write(
-                "Confidence per residue:"
-                + ",".join([str(x) for x in bfactors[chain_id]])
-                + "\n"
-            )
-            file_handle.write("Amino acid probability per residue:" + "\n")
-            for i, aa in enumerate(index_to_restype_1[:-3]):
-                file_handle.write(
-                    f"{aa}:"
-                    + ",".join([str(x) for x in aa_probs[chain_id][:, i]])
-                    + "\n"
-                )
+        file_handle.write("".join(line + "\n" for line in lines))
 
 
 if __name__ == "__main__":
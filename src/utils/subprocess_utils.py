@@ -0,0 +1,97 @@
+"""
+Running external tools (USalign, phenix.chain_comparison) with a wall-clock
+timeout and memory/CPU limits, so a single pathological structure cannot hang
+an evaluation.
+"""
+import os
+import signal
+import subprocess
+
+from utils.profile_utils import profile_step
+
+
+def get_limits(parsed_args) -> dict:
+    return {
+        "timeout": getattr(parsed_args, "timeout", None),
+        "max_memory": getattr(parsed_args, "max_memory", None),
+        "max_cpu_time": getattr(parsed_args, "max_cpu_time", None),
+    }
+
+
+def get_limits_prefix(max_memory=None, max_cpu_time=None):
+    """
+    sh wrapper setting the limits (memory in GB, CPU time in seconds) before
+    it execs the command, so they are in place before the command starts and
+    are inherited by anything it spawns
+    """
+    ulimits = []
+    if max_memory is not None:
+        # Address space in kB
+        ulimits.append(f"ulimit -v {int(max_memory * (1 << 20))}")
+    if max_cpu_time is not None:
+        # The command gets SIGXCPU and then SIGKILL one second later, the soft
+        # limit is set first as it can not exceed the hard one
+        seconds = int(max_cpu_time)
+        ulimits.append(f"ulimit -S -t {seconds} && ulimit -H -t {seconds + 1}")
+    if not ulimits:
+        return []
+    return ["/bin/sh", "-c", " && ".join(ulimits) + ' && exec "$@"', "sh"]
+
+
+def kill_process_group(process: subprocess.Popen):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def popen_with_limits(
+    command, max_memory=None, max_cpu_time=None, **popen_kwargs,
+) -> subprocess.Popen:
+    """
+    Starts command in its own process group with the given limits (memory in
+    GB, CPU time in seconds) applied to it and everything it spawns
+    """
+    return subprocess.Popen(
+        get_limits_prefix(max_memory, max_cpu_time) + list(command),
+        text=True,
+        start_new_session=True,
+        **popen_kwargs,
+    )
+
+
+@profile_step("run_command", child_cpu=True)
+def run_command(
+    command, timeout=None, max_memory=None, max_cpu_time=None,
+) -> subprocess.CompletedProcess:
+    """
+    Same as subprocess.run(command, capture_output=True, text=True, check=True)
+    but with a timeout (seconds) and rlimits (memory in GB, CPU time in seconds).
+    The child runs in its own process group, so on a timeout or on cancellation
+    (e.g. KeyboardInterrupt) it is killed together with anything it spawned,
+    phenix.chain_comparison being a shell wrapper around phenix.python.
+    Raises subprocess.TimeoutExpired or subprocess.CalledProcessError.
+    """
+    process = popen_with_limits(
+        command,
+        max_memory=max_memory,
+        max_cpu_time=max_cpu_time,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_process_group(process)
+        stdout, stderr = process.communicate()
+        raise subprocess.TimeoutExpired(command, timeout, output=stdout, stderr=stderr)
+    except BaseException:
+        kill_process_group(process)
+        process.wait()
+        raise
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(
+            process.returncode, command, output=stdout, stderr=stderr
+        )
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
@@ -0,0 +1,366 @@
+"""
+In-process TM-score engine
+Scores a predicted model against a target model the way US-align/TM-score does,
+working directly on the CA (protein) and C3' (nucleotide) coordinates of
+already parsed `Protein` objects instead of shelling out to the USalign binary.
+
+The initial superpositions come from the structures themselves, as TM-align's
+initial alignments do: short fragments of the prediction are matched to the
+target fragments with the most similar internal CA distances, and the
+superposition of every match is a candidate, next to the input frame. Instead
+of a sequence-order dynamic programming alignment, the residues are then paired
+one-to-one by proximity after each superposition, so chains may be in any
+order, as with US-align -mm 1 -ter 0.
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+from utils.profile_utils import profile_step
+from utils.protein import Protein
+from utils.residue_constants import atom_order
+
+# Same search schedule as TM-score: seed fragments of length L, L/2, ..., L/32,
+# never shorter than 4 residues, each refined for up to 20 iterations
+MAX_SEED_LENGTHS = 6
+MIN_SEED_LENGTH = 4
+MAX_ITERATIONS = 20
+# Fragment search: fragments of FRAGMENT_LENGTH consecutive residues, up to
+# MAX_FRAGMENTS of the prediction, each matched to its FRAGMENT_MATCHES most
+# similar target fragments. The candidates are ranked on up to
+# MAX_SCORED_RESIDUES predicted residues and the best MAX_REFINED refined
+FRAGMENT_LENGTH = 8
+MAX_FRAGMENTS = 32
+FRAGMENT_MATCHES = 4
+MAX_SCORED_RESIDUES = 2000
+MAX_REFINED = 4
+MAX_REMAPS = 5
+
+
+def get_tm_d0(length: int, nucleotide: bool = False) -> float:
+    """
+    TM-score distance scale d0 for a structure of the given length
+    """
+    if nucleotide:
+        if length <= 11:
+            return 0.3
+        elif length <= 15:
+            return 0.4
+        elif length <= 19:
+            return 0.5
+        elif length <= 23:
+            return 0.6
+        elif length < 30:
+            return 0.7
+        return 0.6 * np.sqrt(length - 0.5) - 2.5
+    if length <= 21:
+        return 0.5
+    return max(1.24 * np.cbrt(length - 15) - 1.8, 0.5)
+
+
+def get_representative_atoms(protein: Protein):
+    """
+    CA positions for protein residues and C3' positions for nucleotides,
+    together with a mask of the residues that actually have that atom
+    """
+    atom_idxs = np.where(protein.prot_mask, atom_order["CA"], atom_order["C3'"])
+    residue_idxs = np.arange(len(protein.aatype))
+    positions = protein.atom_positions[residue_idxs, atom_idxs]
+    mask = protein.atom_mask[residue_idxs, atom_idxs] > 0.5
+    return positions, mask
+
+
+def batched_kabsch(x, y, weights):
+    """
+    Weighted least-squares superposition of x onto y for a batch of weightings.
+    x, y: (n, 3), weights: (B, n)
+    Returns rot (B, 3, 3) and trans (B, 3) such that x @ rot + trans ~ y,
+    the same convention as SVDSuperimposer.get_rotran
+    """
+    w = weights / np.maximum(weights.sum(axis=-1, keepdims=True), 1e-8)
+    x_mean = w @ x
+    y_mean = w @ y
+    cov = np.einsum("bn,ni,nj->bij", w, x, y) - x_mean[:, :, None] * y_mean[:, None]
+    u, _, vt = np.linalg.svd(cov)
+    # Avoid reflections
+    u[:, :, -1] *= np.sign(np.linalg.det(u @ vt))[:, None]
+    rot = u @ vt
+    trans = y_mean - np.einsum("bi,bij->bj", x_mean, rot)
+    return rot, trans
+
+
+def get_seed_fragments(num_pairs: int):
+    seeds = []
+    fragment_length = num_pairs
+    for _ in range(MAX_SEED_LENGTHS):
+        fragment_length = max(fragment_length, min(MIN_SEED_LENGTH, num_pairs))
+        last_start = num_pairs - fragment_length
+        starts = list(range(0, last_start + 1, max(1, fragment_length // 2)))
+        if starts[-1] != last_start:
+            starts.append(last_start)
+        seeds.extend((start, fragment_length) for start in starts)
+        if fragment_length <= MIN_SEED_LENGTH:
+            break
+        fragment_length //= 2
+    return seeds
+
+
+def tm_superpose(x, y, d0, d0_search, max_batch_elements=1 << 22):
+    """
+    TM-score superposition search over aligned pairs x[i] <-> y[i].
+    Every seed fragment is superposed and then iteratively refined on the pairs
+    closer than d0_search; all seeds in a batch are refined together.
+    Returns the best raw score (sum over pairs, not yet normalised), rot and trans
+    """
+    num_pairs = len(x)
+    seeds = get_seed_fragments(num_pairs)
+    batch_size = max(1, max_batch_elements // (3 * num_pairs))
+
+    best_score, best_rot, best_trans = -1.0, np.eye(3), np.zeros(3)
+    for batch_start in range(0, len(seeds), batch_size):
+        batch = seeds[batch_start : batch_start + batch_size]
+        weights = np.zeros((len(batch), num_pairs), dtype=bool)
+        for b, (start, fragment_length) in enumerate(batch):
+            weights[b, start : start + fragment_length] = True
+
+        for _ in range(MAX_ITERATIONS):
+            rot, trans = batched_kabsch(x, y, weights.astype(np.float64))
+            x_sup = np.einsum("ni,bij->bnj", x, rot) + trans[:, None]
+            dist2 = np.sum(np.square(x_sup - y[None]), axis=-1)
+
+            scores = np.sum(1.0 / (1.0 + dist2 / d0 ** 2), axis=-1)
+            b = np.argmax(scores)
+            if scores[b] > best_score:
+                best_score, best_rot, best_trans = scores[b], rot[b], trans[b]
+
+            new_weights = dist2 < d0_search ** 2
+            # Always keep at least the three closest pairs to superpose on
+            too_few = np.sum(new_weights, axis=-1) < 3
+            if np.any(too_few) and num_pairs >= 3:
+                closest = np.argpartition(dist2[too_few], 2, axis=-1)[:, :3]
+                new_weights[np.nonzero(too_few)[0][:, None], closest] = True
+            if np.array_equal(new_weights, weights):
+                break
+            weights = new_weights
+
+    return best_score, best_rot, best_trans
+
+
+def get_fragments(positions, chain_index, fragment_length=FRAGMENT_LENGTH):
+    """
+    Start indices of the runs of fragment_length consecutive residues of one
+    chain, and their internal distances, a descriptor that does not depend on
+    the frame of the structure
+    """
+    if len(positions) < fragment_length:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 0))
+    # Number of chain changes before every residue
+    breaks = np.r_[0, np.cumsum(chain_index[1:] != chain_index[:-1])]
+    starts = np.arange(len(positions) - fragment_length + 1)
+    starts = starts[breaks[starts + fragment_length - 1] == breaks[starts]]
+
+    i, j = np.triu_indices(fragment_length, k=1)
+    descriptors = np.linalg.norm(
+        positions[starts[:, None] + i] - positions[starts[:, None] + j], axis=-1
+    )
+    return starts, descriptors
+
+
+def get_candidate_superpositions(input_cas, target_cas, input_fragments, target_fragments):
+    """
+    Superpositions of the predicted fragments on their most similar target
+    fragments, (rot, trans) stacked, with the identity first
+    """
+    rots, trans = [np.eye(3)[None]], [np.zeros((1, 3))]
+    input_starts, input_descriptors = input_fragments
+    target_starts, target_descriptors = target_fragments
+    if len(input_starts) and len(target_starts):
+        picked = np.unique(np.linspace(0, len(input_starts) - 1, MAX_FRAGMENTS).astype(np.int64))
+        k = min(FRAGMENT_MATCHES, len(target_starts))
+        _, matches = cKDTree(target_descriptors).query(input_descriptors[picked], k=k)
+        matches = matches.reshape(len(picked), k)
+        offsets = np.arange(FRAGMENT_LENGTH)
+        x = input_cas[input_starts[np.repeat(picked, k)][:, None] + offsets]
+        y = target_cas[target_starts[matches.ravel()][:, None] + offsets]
+        # One Kabsch per fragment match, through the batched weighted version
+        # on the concatenated fragments
+        num_matches = len(x)
+        weights = np.kron(np.eye(num_matches), np.ones(FRAGMENT_LENGTH))
+        fragment_rots, fragment_trans = batched_kabsch(
+            x.reshape(-1, 3), y.reshape(-1, 3), weights
+        )
+        rots.append(fragment_rots)
+        trans.append(fragment_trans)
+    return np.concatenate(rots), np.concatenate(trans)
+
+
+def get_one_to_one_pairs(x_sup, y, max_dist, k=4):
+    """
+    Pairs of superposed predicted and target residues closer than max_dist,
+    each residue used at most once, the closest pairs first
+    """
+    if len(x_sup) == 0 or len(y) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    k = min(k, len(y))
+    distance, closest = cKDTree(y).query(x_sup, k=k, distance_upper_bound=max_dist)
+    distance, closest = distance.reshape(len(x_sup), k), closest.reshape(len(x_sup), k)
+    input_idxs = np.repeat(np.arange(len(x_sup)), k)
+    target_idxs = closest.ravel()
+    distance = distance.ravel()
+    keep = np.isfinite(distance)
+    input_idxs, target_idxs, distance = input_idxs[keep], target_idxs[keep], distance[keep]
+
+    # Greedy over the pairs sorted by distance, in rounds: a pair that is the
+    # closest remaining one of both its residues is taken by the greedy pass
+    order = np.argsort(distance, kind="stable")
+    input_idxs, target_idxs = input_idxs[order], target_idxs[order]
+    taken_input, taken_target = [], []
+    while len(input_idxs):
+        first_of_input = np.zeros(len(input_idxs), dtype=bool)
+        first_of_input[np.unique(input_idxs, return_index=True)[1]] = True
+        first_of_target = np.zeros(len(input_idxs), dtype=bool)
+        first_of_target[np.unique(target_idxs, return_index=True)[1]] = True
+        mutual = first_of_input & first_of_target
+        taken_input.append(input_idxs[mutual])
+        taken_target.append(target_idxs[mutual])
+        keep = ~np.isin(input_idxs, input_idxs[mutual]) & ~np.isin(target_idxs, target_idxs[mutual])
+        input_idxs, target_idxs = input_idxs[keep], target_idxs[keep]
+    if not taken_input:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    input_correspondence = np.concatenate(taken_input).astype(np.int64)
+    target_correspondence = np.concatenate(taken_target).astype(np.int64)
+    # Seed fragments of tm_superpose are contiguous stretches of the target
+    order = np.argsort(target_correspondence, kind="stable")
+    return input_correspondence[order], target_correspondence[order]
+
+
+def get_tm_sum(x_sup, target_tree, d0, max_dist):
+    """
+    TM-score sum of every predicted residue with its closest target residue,
+    a cheap upper estimate used to rank the candidate superpositions
+    """
+    distance, _ = target_tree.query(x_sup, k=1, distance_upper_bound=max_dist)
+    distance = distance[np.isfinite(distance)]
+    return float(np.sum(1.0 / (1.0 + np.square(distance) / d0 ** 2)))
+
+
+def refine_superposition(input_cas, target_cas, rot, trans, d0, d0_search, pair_dist):
+    """
+    Alternates pairing the residues and superposing the pairs closer than
+    d0_search while the TM-score sum improves, like the iterations of a single
+    tm_superpose seed. Returns the sum with its rot and trans
+    """
+    best_score, best = -1.0, (rot, trans)
+    for _ in range(MAX_REMAPS):
+        input_correspondence, target_correspondence = get_one_to_one_pairs(
+            input_cas @ rot + trans, target_cas, pair_dist
+        )
+        if len(input_correspondence) < 3:
+            break
+        x = input_cas[input_correspondence].astype(np.float64)
+        y = target_cas[target_correspondence].astype(np.float64)
+        dist2 = np.sum(np.square(x @ rot + trans - y), axis=-1)
+        score = float(np.sum(1.0 / (1.0 + dist2 / d0 ** 2)))
+        if score <= best_score + 1e-8:
+            break
+        best_score, best = score, (rot, trans)
+
+        weights = dist2 < d0_search ** 2
+        if np.sum(weights) < 3:
+            weights[np.argsort(dist2)[:3]] = True
+        rots, transes = batched_kabsch(x, y, weights[None].astype(np.float64))
+        rot, trans = rots[0], transes[0]
+    return best_score, best[0], best[1]
+
+
+@profile_step("tm_align")
+def tm_align(
+    predicted_protein: Protein, target_protein: Protein, d_cut: float = 3.0,
+):
+    """
+    Aligns the predicted model to the target model and returns the quantities
+    cryoEVAL reads from the US-align output, with the TM-score normalised by the
+    length of the target
+    """
+    input_cas, input_mask = get_representative_atoms(predicted_protein)
+    target_cas, target_mask = get_representative_atoms(target_protein)
+    input_idxs = np.nonzero(input_mask)[0]
+    target_idxs = np.nonzero(target_mask)[0]
+    input_cas, target_cas = input_cas[input_idxs], target_cas[target_idxs]
+    len_predict, len_target = len(input_cas), len(target_cas)
+
+    nucleotide = np.mean(~target_protein.prot_mask[target_idxs]) > 0.5
+    d0 = get_tm_d0(len_target, nucleotide=nucleotide)
+    d0_search = min(max(d0, 4.5), 8.0)
+
+    output = {
+        "tm_score": 0.0,
+        "rmsd": 0.0,
+        "aligned_length": 0,
+        "aligned_length_all": 0,
+        "aa_match": 0,
+        "len_predict": len_predict,
+        "len_target": len_target,
+        "d0": float(d0),
+    }
+    if len_predict < 3 or len_target < 3:
+        return output
+
+    rots, transes = get_candidate_superpositions(
+        input_cas, target_cas,
+        get_fragments(input_cas, predicted_protein.chain_index[input_idxs]),
+        get_fragments(target_cas, target_protein.chain_index[target_idxs]),
+    )
+    # Rank the candidates on a subset of the prediction, refine the best ones
+    target_tree = cKDTree(target_cas)
+    pair_dist = max(d_cut, d0_search)
+    scored = input_cas[np.unique(np.linspace(0, len_predict - 1, MAX_SCORED_RESIDUES).astype(np.int64))]
+    estimates = [
+        get_tm_sum(scored @ rot + trans, target_tree, d0, pair_dist) for rot, trans in zip(rots, transes)
+    ]
+
+    best_score, best = -1.0, None
+    for c in np.argsort(estimates)[::-1][:MAX_REFINED]:
+        score, rot, trans = refine_superposition(
+            input_cas, target_cas, rots[c], transes[c], d0, d0_search, pair_dist
+        )
+        if score > best_score:
+            best_score, best = score, (rot, trans)
+    if best_score < 0:
+        return output
+
+    # Full TM-score search only on the pairs of the best candidate
+    rot, trans = best
+    input_correspondence, target_correspondence = get_one_to_one_pairs(
+        input_cas @ rot + trans, target_cas, pair_dist
+    )
+    x = input_cas[input_correspondence].astype(np.float64)
+    y = target_cas[target_correspondence].astype(np.float64)
+    score, new_rot, new_trans = tm_superpose(x, y, d0, d0_search)
+    if score > best_score:
+        rot, trans = new_rot, new_trans
+        input_correspondence, target_correspondence = get_one_to_one_pairs(
+            input_cas @ rot + trans, target_cas, pair_dist
+        )
+    if len(input_correspondence) < 3:
+        return output
+    x = input_cas[input_correspondence].astype(np.float64)
+    y = target_cas[target_correspondence].astype(np.float64)
+    distance = np.linalg.norm(x @ rot + trans - y, axis=-1)
+    close = distance < d_cut
+    same_type = (
+        predicted_protein.aatype[input_idxs[input_correspondence]]
+        == target_protein.aatype[target_idxs[target_correspondence]]
+    )
+
+    output.update(
+        {
+            "tm_score": float(np.sum(1.0 / (1.0 + np.square(distance) / d0 ** 2)) / len_target),
+            "rmsd": float(np.sqrt(np.mean(np.square(distance)))),
+            "aligned_length": int(np.sum(close)),
+            "aligned_length_all": len(distance),
+            "aa_match": int(np.sum(close & same_type)),
+            "rot": rot,
+            "trans": trans,
+        }
+    )
+    return output
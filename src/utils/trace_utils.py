@@ -0,0 +1,93 @@
+"""
+Trace log of an evaluation job
+One buffered handle per job that the stages write into, instead of each stage
+reopening the log file and flushing after every write. The log can be gzip or
+zstd compressed, and the raw tool outputs (USalign alignments, PHENIX tables)
+can be left out of it entirely.
+"""
+import gzip
+import io
+import threading
+
+VERBOSITY = {"summary": 1, "full": 2}
+COMPRESSION_SUFFIX = {"gzip": ".gz", "zstd": ".zst"}
+
+
+def get_log_path(path, compression=None):
+    suffix = COMPRESSION_SUFFIX.get(compression, "")
+    if path is None or path.endswith(suffix):
+        return path
+    return path + suffix
+
+
+def open_log(path, compression=None):
+    """
+    Binary append handle, compressed logs are appended to as new members/frames
+    """
+    if compression == "gzip":
+        return gzip.open(path, "ab")
+    if compression == "zstd":
+        import zstandard
+
+        return zstandard.ZstdCompressor().stream_writer(open(path, "ab"))
+    return open(path, "ab")
+
+
+class TraceLog:
+    """
+    Without a path the log is only kept in memory, which is what the stages
+    write into when they run concurrently, see child()
+    """
+
+    def __init__(self, path=None, compression=None, verbosity="full", buffer_size=1 << 20):
+        if compression not in (None, "none", *COMPRESSION_SUFFIX):
+            raise ValueError(f"Unknown log compression {compression}")
+        self.compression = None if compression == "none" else compression
+        self.path = get_log_path(path, self.compression)
+        self.verbosity = verbosity
+        self.buffer_size = buffer_size
+        self.buffer = io.StringIO()
+        self.file = None
+        self.lock = threading.Lock()
+
+    @property
+    def full(self):
+        # Raw tool outputs are only written at full verbosity
+        return VERBOSITY[self.verbosity] >= VERBOSITY["full"]
+
+    def write(self, text: str):
+        with self.lock:
+            self.buffer.write(text)
+            if self.path is not None and self.buffer.tell() >= self.buffer_size:
+                self._flush()
+
+    def child(self):
+        return TraceLog(verbosity=self.verbosity)
+
+    def getvalue(self) -> str:
+        return self.buffer.getvalue()
+
+    def _flush(self):
+        if self.path is None or self.buffer.tell() == 0:
+            return
+        if self.file is None:
+            self.file = open_log(self.path, self.compression)
+        self.file.write(self.buffer.getvalue().encode("utf-8"))
+        self.buffer = io.StringIO()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()